@@ -1,13 +1,17 @@
 import logging
+import multiprocessing
 
 import os
+import time
 import shutil
-from collections import Counter
+import traceback
+from collections import Counter, OrderedDict
+from itertools import islice
+import theano
 from theano import tensor
 from toolz import merge
 import numpy
-import pickle
-from subprocess import Popen, PIPE
+from six.moves import queue
 import codecs
 
 from blocks.algorithms import (GradientDescent, StepClipping,
@@ -20,18 +24,22 @@ from blocks.initialization import IsotropicGaussian, Orthogonal, Constant
 from blocks.main_loop import MainLoop
 from blocks.model import Model
 from blocks.select import Selector
-from blocks.search import BeamSearch
 from blocks.roles import WEIGHT
 from blocks_extras.extensions.plot import Plot
 
-from machine_translation.checkpoint import CheckpointNMT, LoadNMT
+from machine_translation.checkpoint import LoadNMT
 from machine_translation.model import BidirectionalEncoder
-from machine_translation.stream import _ensure_special_tokens
 
+from mmmt.cache import LRUCache, TranslationCache, array_key, fingerprint
+from mmmt.extensions import AsyncCheckpointNMT
 from mmmt.model import InitialContextDecoder
 # user can specify which target GRU they want
 from mmmt.model import GRUInitialState, GRUInitialStateWithInitialStateConcatContext, GRUInitialStateWithInitialStateSumContext
-from mmmt.sample import BleuValidator, Sampler, SamplingBase, MeteorValidator
+from mmmt.sample import (AsyncMultiMetricValidator, BatchedBeamSearch, BleuMetric, MeteorMetric, MultiMetricValidator,
+                         Sampler, SamplingBase)
+from mmmt.stream import load_context_features
+from mmmt.tokenizer import LineProcessPool, moses_detokenizer_command, moses_tokenizer_command
+from mmmt.vocab import Vocabulary
 
 try:
     from blocks_extras.extensions.plot import Plot
@@ -146,21 +154,24 @@ def main(config, tr_stream, dev_stream, source_vocab, target_vocab, use_bokeh=Fa
         FinishAfter(after_n_batches=config['finish_after']),
         TrainingDataMonitoring([cost], after_batch=True),
         Printing(after_batch=True),
-        CheckpointNMT(config['saveto'],
-                      every_n_batches=config['save_freq'])
+        AsyncCheckpointNMT(config['saveto'],
+                           every_n_batches=config['save_freq'])
     ]
 
     # Create the theano variables that we need for the sampling graph
     sampling_input = tensor.lmatrix('input')
+    sampling_input_mask = tensor.matrix('input_mask')
     sampling_context = tensor.matrix('context_input')
 
     # Set up beam search and sampling computation graphs if necessary
-    if config['hook_samples'] >= 1 or config.get('bleu_script', None) is not None:
+    if (config['hook_samples'] >= 1 or config.get('bleu_script', None) is not None or
+            config.get('meteor_directory', None) is not None):
         logger.info("Building sampling model")
         sampling_representation = encoder.apply(
-            sampling_input, tensor.ones(sampling_input.shape))
+            sampling_input, sampling_input_mask)
 
-        generated = decoder.generate(sampling_input, sampling_representation, sampling_context)
+        generated = decoder.generate(sampling_input, sampling_representation, sampling_context,
+                                     source_sentence_mask=sampling_input_mask)
         search_model = Model(generated)
         _, samples = VariableFilter(
             bricks=[decoder.sequence_generator], name="outputs")(
@@ -176,34 +187,32 @@ def main(config, tr_stream, dev_stream, source_vocab, target_vocab, use_bokeh=Fa
                     src_vocab=source_vocab,
                     trg_vocab=target_vocab,
                     src_vocab_size=config['src_vocab_size'],
+                    trg_vocab_size=config['trg_vocab_size'],
+                    unk_idx=config['unk_id'],
                    ))
 
 
-    # Add early stopping based on bleu
+    # Add early stopping based on BLEU and/or METEOR, both are computed from the same decoding of the dev set
+    validation_metrics = []
     if config.get('bleu_script', None) is not None:
-        logger.info("Building bleu validator")
-        extensions.append(
-            BleuValidator(sampling_input, sampling_context, samples=samples, config=config,
-                          model=search_model, data_stream=dev_stream,
-                          src_vocab=source_vocab,
-                          trg_vocab=target_vocab,
-                          normalize=config['normalized_bleu'],
-                          every_n_batches=config['bleu_val_freq']))
-
-    
-    # Add early stopping based on Meteor
+        validation_metrics.append(BleuMetric(config, trg_vocab=target_vocab))
     if config.get('meteor_directory', None) is not None:
-        logger.info("Building meteor validator")
+        validation_metrics.append(MeteorMetric(config))
+
+    if validation_metrics:
+        logger.info("Building validator for {}".format(', '.join(metric.key for metric in validation_metrics)))
+        # the async validator decodes parameter snapshots in another process while training goes on
+        validator_class = AsyncMultiMetricValidator if config.get('async_validation', False) else MultiMetricValidator
         extensions.append(
-            MeteorValidator(sampling_input, sampling_context, samples=samples,
-                            config=config,
+            validator_class(sampling_input, sampling_context, samples=samples, config=config,
+                            metrics=validation_metrics,
                             model=search_model, data_stream=dev_stream,
+                            source_sentence_mask=sampling_input_mask,
                             src_vocab=source_vocab,
                             trg_vocab=target_vocab,
                             normalize=config['normalized_bleu'],
                             every_n_batches=config['bleu_val_freq']))
 
-
     # Reload model if necessary
     if config['reload']:
         extensions.append(LoadNMT(config['saveto']))
@@ -268,29 +277,70 @@ def load_params_and_get_beam_search(exp_config):
     # Create Theano variables
     logger.info('Creating theano variables')
     sampling_input = tensor.lmatrix('source')
+    sampling_input_mask = tensor.matrix('source_mask')
     sampling_context = tensor.matrix('context_input')
 
+    # if the transition sums a projection of the context into the initial state, that projection gets its own
+    # function, so that its outputs can be cached, and the search graph takes the projection as its context input
+    context_projection = None
+    if hasattr(decoder.transition, 'precomputed_context_projection'):
+        context_features = sampling_context
+        context_projection = decoder.transition.context_transformer.apply(context_features)
+        decoder.transition.precomputed_context_projection = True
+        sampling_context = tensor.matrix('context_projection')
+
     logger.info("Building sampling model")
     sampling_representation = encoder.apply(
-        sampling_input, tensor.ones(sampling_input.shape))
+        sampling_input, sampling_input_mask)
 
-    generated = decoder.generate(sampling_input, sampling_representation, sampling_context)
+    generated = decoder.generate(sampling_input, sampling_representation, sampling_context,
+                                 source_sentence_mask=sampling_input_mask)
     _, samples = VariableFilter(
         bricks=[decoder.sequence_generator], name="outputs")(
             ComputationGraph(generated[1]))  # generated[1] is next_outputs
 
-    beam_search = BeamSearch(samples=samples)
+    beam_search = BatchedBeamSearch(samples, sampling_input, sampling_context,
+                                    source_sentence_mask=sampling_input_mask, beam_size=exp_config['beam_size'])
 
     # Set the parameters
     logger.info("Creating Model...")
-    model = Model(generated)
+    model_outputs = list(generated)
+    if context_projection is not None:
+        model_outputs.append(context_projection)
+    model = Model(model_outputs)
     logger.info("Loading parameters from model: {}".format(exp_config['saved_parameters']))
 
     # load the parameter values from an .npz file
     param_values = LoadNMT.load_parameter_values(exp_config['saved_parameters'])
     LoadNMT.set_model_parameters(model, param_values)
 
-    return beam_search, sampling_input, sampling_context
+    context_projection_fn = None
+    if context_projection is not None:
+        context_projection_fn = theano.function([context_features], context_projection, name='context_projection')
+
+    return beam_search, sampling_input, sampling_context, context_projection_fn
+
+
+def length_sorted_batches(lengths, batch_size=16, batch_tokens=None):
+    """Split segment indices into batches of segments with similar lengths
+
+    Segments are sorted by length (stable, so equal lengths keep their order). A batch holds at most `batch_size`
+    segments, and if `batch_tokens` is given, at most `batch_tokens` tokens once padded to its longest segment.
+
+    """
+    order = numpy.argsort(numpy.asarray(lengths, dtype='int64'), kind='mergesort')
+    batches = []
+    batch = []
+    for i in order:
+        # lengths only grow within the sorted order, so the new segment is the longest of the batch
+        if batch and (len(batch) >= batch_size or
+                      (batch_tokens is not None and (len(batch) + 1) * lengths[i] > batch_tokens)):
+            batches.append(batch)
+            batch = []
+        batch.append(int(i))
+    if batch:
+        batches.append(batch)
+    return batches
 
 
 class NMTPredictor:
@@ -301,25 +351,33 @@ class NMTPredictor:
     def __init__(self, exp_config):
 
         search_vars = load_params_and_get_beam_search(exp_config)
-        self.beam_search, self.sampling_input, self.sampling_context = search_vars
+        self.beam_search, self.sampling_input, self.sampling_context, self.context_projection_fn = search_vars
+        # captions of the same image share the projection of its features, so it is cached per image
+        self.context_projection_cache = LRUCache(exp_config.get('context_cache_size', 1024))
 
         self.exp_config = exp_config
+        self.beam_size = exp_config['beam_size']
         # how many hyps should be output (only used in file prediction mode)
         self.n_best = exp_config.get('n_best', 1)
 
         self.source_lang = exp_config.get('source_lang', 'en')
         self.target_lang = exp_config.get('target_lang', 'es')
 
+        # the tokenizer and detokenizer are long-lived processes, `tokenizer_command` and `detokenizer_command` can
+        # replace the moses scripts (e.g. with `python -m mmmt.tokenizer.fake_tokenizer` for tests)
         tokenize_script = exp_config.get('tokenize_script', None)
         detokenize_script = exp_config.get('detokenize_script', None)
+        self.tokenizer_cmd = exp_config.get('tokenizer_command', None)
+        self.detokenizer_cmd = exp_config.get('detokenizer_command', None)
         if tokenize_script is not None and detokenize_script is not None:
-            self.tokenizer_cmd = [tokenize_script, '-l', self.source_lang, '-q', '-', '-no-escape', '1']
-            self.detokenizer_cmd = [detokenize_script, '-l', self.target_lang, '-q', '-']
-        else:
-            self.tokenizer_cmd = None
-            self.detokenizer_cmd = None
-
-        # this index will get overwritten with the EOS token by _ensure_special_tokens
+            self.tokenizer_cmd = self.tokenizer_cmd or moses_tokenizer_command(tokenize_script, self.source_lang)
+            self.detokenizer_cmd = self.detokenizer_cmd or moses_detokenizer_command(detokenize_script,
+                                                                                     self.target_lang)
+        pool_size = exp_config.get('tokenizer_pool_size', 1)
+        self.tokenizer = LineProcessPool(self.tokenizer_cmd, size=pool_size) if self.tokenizer_cmd else None
+        self.detokenizer = LineProcessPool(self.detokenizer_cmd, size=pool_size) if self.detokenizer_cmd else None
+
+        # this index will get overwritten with the EOS token by Vocabulary.load
         # IMPORTANT: the index must be created in the same way it was for training,
         # otherwise the predicted indices will be nonsense
         # Make sure that src_vocab_size and trg_vocab_size are correct in your configuration
@@ -328,171 +386,442 @@ class NMTPredictor:
 
         self.unk_idx = exp_config['unk_id']
 
-        # Get vocabularies and inverse indices
-        self.src_vocab = _ensure_special_tokens(
-            pickle.load(open(exp_config['src_vocab'])), bos_idx=0,
-            eos_idx=self.src_eos_idx, unk_idx=self.unk_idx)
-        self.src_ivocab = {v: k for k, v in self.src_vocab.items()}
-        self.trg_vocab = _ensure_special_tokens(
-            pickle.load(open(exp_config['trg_vocab'])), bos_idx=0,
-            eos_idx=self.trg_eos_idx, unk_idx=self.unk_idx)
-        self.trg_ivocab = {v: k for k, v in self.trg_vocab.items()}
-
-        self.unk_idx = self.unk_idx
+        # Get vocabularies, these also hold the inverse indices
+        self.src_vocab = Vocabulary.load(exp_config['src_vocab'], exp_config['src_vocab_size'],
+                                         unk_idx=self.unk_idx)
+        self.trg_vocab = Vocabulary.load(exp_config['trg_vocab'], exp_config['trg_vocab_size'],
+                                         unk_idx=self.unk_idx)
+
+        # repeated requests are answered from a cache of translations, which can be persisted in an sqlite file
+        cache_size = exp_config.get('translation_cache_size', 0)
+        cache_file = exp_config.get('translation_cache_file', None)
+        self.translation_cache = None
+        if cache_size > 0 or cache_file is not None:
+            self.translation_cache = TranslationCache(cache_size, ttl=exp_config.get('translation_cache_ttl', None),
+                                                      path=cache_file, model_fingerprint=self.model_fingerprint())
+
+    def model_fingerprint(self):
+        """A fingerprint of the parameters, vocabularies and settings which the translations depend on"""
+        return fingerprint(self.exp_config['saved_parameters'], self.exp_config.get('target_transition', None),
+                           self.exp_config['src_vocab'], self.exp_config['src_vocab_size'],
+                           self.exp_config['trg_vocab'], self.exp_config['trg_vocab_size'], self.unk_idx,
+                           self.exp_config['normalized_bleu'], self.tokenizer_cmd, self.detokenizer_cmd)
 
     @staticmethod
-    def get_numpy_array(filename):
-        return numpy.load(filename)['arr_0']
+    def get_numpy_array(filename, ids_file=None):
+        return load_context_features(filename, ids_file)
 
-    def map_idx_or_unk(self, sentence, index, unknown_token='<UNK>'):
-        if type(sentence) is str:
-            sentence = sentence.split()
-        return [index.get(w, unknown_token) for w in sentence]
+    def project_contexts(self, contexts):
+        """Map context features to the context input of the beam search
 
+        If the model projects the context features outside of the search graph, the projections are looked up in
+        the cache by the hash of the features, and the missing ones are computed with a single call. Otherwise the
+        features are the input of the search.
 
-    # WORKING: add the contexts into prediction
-    # Contexts are currently *.npz files (need to fit into memory)
-    def predict_files(self, source_input_file, context_input_file, output_file=None, output_costs=False):
-        tokenize = self.tokenizer_cmd is not None
-        detokenize = self.detokenizer_cmd is not None
+        """
+        contexts = numpy.asarray(contexts, dtype=theano.config.floatX)
+        if self.context_projection_fn is None:
+            return contexts
+
+        keys = [array_key(context) for context in contexts]
+        projections = [self.context_projection_cache.get(key) for key in keys]
+        missing = OrderedDict()
+        for i, (key, projection) in enumerate(zip(keys, projections)):
+            if projection is None:
+                missing.setdefault(key, i)
+        if missing:
+            new_projections = self.context_projection_fn(contexts[list(missing.values())])
+            for key, projection in zip(missing, new_projections):
+                self.context_projection_cache.put(key, projection)
+            new_projections = dict(zip(missing, new_projections))
+            projections = [new_projections[key] if projection is None else projection
+                           for key, projection in zip(keys, projections)]
+        return numpy.array(projections)
+
+    # Contexts are *.npy feature stores (memory-mapped) or legacy *.npz files (need to fit into memory)
+    # If context_ids_file is given, the context input is a deduplicated feature table, see mmmt.stream.load_context_features
+    def predict_files(self, source_input_file, context_input_file, output_file=None, output_costs=False,
+                      context_ids_file=None, batch_size=None, batch_tokens=None, window_size=None):
+        """Translate a file with one source segment per line, and write the translations in the same order
+
+        The source file is read `window_size` lines at a time (by default `predict_window_size` from the config, the
+        whole file at once if it is set to None), and the translations of each window are written and flushed before the
+        next one is read, so memory use doesn't grow with the size of the input, and the output of an interrupted run
+        holds the translations of all the finished windows. With a `.npy` feature store, the context features are
+        memory-mapped too. The number of source segments is checked against the number of context rows before
+        anything is translated.
+
+        Within a window, segments are sorted by length and translated `batch_size` at a time, or in batches of at
+        most `batch_tokens` source tokens including padding, if that is given (by default, `predict_batch_size` and
+        `predict_batch_tokens` from the config). With n_best > 1, the n-best list of each segment is followed by
+        a blank line.
+
+        """
+        if window_size is None:
+            window_size = self.exp_config.get('predict_window_size', 1000)
 
-        if output_file is not None:
-            ftrans = codecs.open(output_file, 'wb', encoding='utf8')
-        else:
+        if output_file is None:
             # cut off the language suffix to make output file name
             output_file = '.'.join(source_input_file.split('.')[:-1]) + '.trans.out'
-            ftrans = codecs.open(output_file, 'wb', encoding='utf8')
 
         logger.info("Started translation, will output {} translations for each segment"
                     .format(self.n_best))
-        total_cost = 0.0
+        start_time = time.time()
+
+        context_features = self.get_numpy_array(context_input_file, context_ids_file)
+        # a mismatched input should fail now, not after hours of decoding
+        num_segments = self.count_source_segments(source_input_file)
+        if num_segments != len(context_features):
+            raise ValueError('{} has {} segments but {} has {} context rows'.format(
+                source_input_file, num_segments, context_input_file, len(context_features)))
 
         # TODO: the tokenizer throws an error when the input file is opened with encoding='utf8'
         # TODO: why would that error happen?
-        # TODO: WORKING: send both source and context to beam search
-        with codecs.open(source_input_file) as source_inp:
-            source_lines = source_inp.read().strip().split('\n')
-            context_features = self.get_numpy_array(context_input_file)
-            assert len(source_lines) == len(context_features), 'lens {} and {} do not match'.format(
-                len(source_lines), len(context_features)
-            )
-
-            for i, inputs in enumerate(zip(source_lines, context_features)):
-                source, context = inputs
-                logger.info("Translating segment: {}".format(i))
-
-                translations, costs = self.predict_segment(source, context, n_best=self.n_best,
-                                                           tokenize=tokenize, detokenize=detokenize)
-
-                # predict_segment returns a list of hyps, we just take the best one
-                nbest_translations = translations[:self.n_best]
-                nbest_costs = costs[:self.n_best]
-
-                if self.n_best == 1:
-                    if output_costs:
-                        ftrans.write((nbest_translations[0] + '\t' + str(nbest_costs[0]) + '\n').decode('utf8'))
-                    else:
-                        ftrans.write((nbest_translations[0] + '\n').decode('utf8'))
-                    total_cost += nbest_costs[0]
-                else:
-                    # one blank line to separate each nbest list
-                    ftrans.write('\n'.join(nbest_translations) + '\n\n')
-                    total_cost += sum(nbest_costs)
-
-                if i != 0 and i % 100 == 0:
-                    logger.info("Translated {} lines of test set...".format(i))
-
-        logger.info("Saved translated output to: {}".format(ftrans.name))
+        with codecs.open(source_input_file) as source_inp, codecs.open(output_file, 'wb', encoding='utf8') as ftrans:
+            num_translated, total_cost = self.translate_windows(
+                self._source_windows(source_inp, window_size), context_features, ftrans, output_costs=output_costs,
+                batch_size=batch_size, batch_tokens=batch_tokens,
+                progress=lambda n: logger.info("Translated {} lines of test set...".format(n)))
+
+        assert num_translated == len(context_features), 'lens {} and {} do not match'.format(
+            num_translated, len(context_features)
+        )
+
+        logger.info("Saved translated output to: {}".format(output_file))
         logger.info("Total cost of the test: {}".format(total_cost))
-        ftrans.close()
+        logger.info("Translating {} segments took {:.1f} seconds".format(num_translated, time.time() - start_time))
+        if self.translation_cache is not None:
+            logger.info("Translation cache: {}".format(self.translation_cache.stats()))
 
         return output_file
 
+    @staticmethod
+    def count_source_segments(source_input_file):
+        """Count the segments of a source file in a single pass, i.e. its lines without the blank lines at the end"""
+        num_segments = 0
+        # opened like in predict_files, so lines count as blank exactly when `_source_windows` skips them
+        with codecs.open(source_input_file) as source_inp:
+            for line_number, line in enumerate(source_inp, 1):
+                if line.strip():
+                    num_segments = line_number
+        return num_segments
+
+    @staticmethod
+    def _source_windows(source_inp, window_size=None):
+        # yields lists of at most `window_size` lines (all lines if it is None), without the blank lines at the end
+        # of the file, which the whole-file reading used to strip
+        window = []
+        blank_lines = []
+        for line in source_inp:
+            line = line.rstrip('\n')
+            if not line.strip():
+                blank_lines.append(line)
+                continue
+            window.extend(blank_lines)
+            blank_lines = []
+            window.append(line)
+            if window_size and len(window) >= window_size:
+                yield window
+                window = []
+        if window:
+            yield window
+
+    def translate_windows(self, source_windows, context_features, ftrans, output_costs=False, batch_size=None,
+                          batch_tokens=None, progress=None):
+        """Translate each list of source lines in `source_windows` and write it to `ftrans` before reading the next
+
+        The context features of the windows are the consecutive rows of `context_features`. After each window,
+        `progress` is called with the number of lines translated so far. Returns that number and the total cost.
+
+        """
+        total_cost = 0.0
+        num_translated = 0
+        for source_lines in source_windows:
+            window_end = num_translated + len(source_lines)
+            assert window_end <= len(context_features), 'lens {} and {} do not match'.format(
+                window_end, len(context_features))
+
+            results = self.translate_segments(source_lines, context_features[num_translated:window_end],
+                                              batch_size=batch_size, batch_tokens=batch_tokens)
+            total_cost += self._write_translations(ftrans, results, output_costs)
+            ftrans.flush()
+
+            num_translated = window_end
+            if progress is not None:
+                progress(num_translated)
+        return num_translated, total_cost
+
+    def translate_segments(self, source_lines, contexts, batch_size=None, batch_tokens=None):
+        """Translate a list of source segments (tokenizing them first if there is a tokenizer)
+
+        Segments are sorted by length and translated in batches, see `predict_files`. Returns a (translations, costs)
+        tuple with the n best translations of each segment, in the order of `source_lines`.
+
+        """
+        if batch_size is None:
+            batch_size = self.exp_config.get('predict_batch_size', 16)
+        if batch_tokens is None:
+            batch_tokens = self.exp_config.get('predict_batch_tokens', None)
+
+        if self.tokenizer is not None:
+            source_lines = self.tokenize(source_lines)
+        source_seqs = [self.src_vocab.encode(line) for line in source_lines]
+
+        results = [None] * len(source_seqs)
+        for batch_idxs in length_sorted_batches([len(seq) for seq in source_seqs], batch_size=batch_size,
+                                                batch_tokens=batch_tokens):
+            batch_results = self.predict_batch([source_seqs[i] for i in batch_idxs],
+                                               contexts[numpy.array(batch_idxs)],
+                                               n_best=self.n_best, detokenize=self.detokenizer is not None)
+            for i, result in zip(batch_idxs, batch_results):
+                results[i] = result
+        return results
+
+    def _write_translations(self, ftrans, results, output_costs=False):
+        # returns the total cost of the written translations
+        total_cost = 0.0
+        for nbest_translations, nbest_costs in results:
+            total_cost += sum(nbest_costs)
+            if output_costs:
+                lines = [trans + '\t' + str(cost) for trans, cost in zip(nbest_translations, nbest_costs)]
+            else:
+                lines = nbest_translations
+            # one blank line to separate each nbest list
+            ftrans.write(('\n'.join(lines) + ('\n' if self.n_best == 1 else '\n\n')).decode('utf8'))
+        return total_cost
+
+    def tokenize(self, segments):
+        """Tokenize a list of segments with the tokenizer process"""
+        return self.tokenizer.process_lines(segments)
+
+    def detokenize(self, segments):
+        """Detokenize a list of segments with the detokenizer process"""
+        # strip off the eol symbols
+        return [line.strip() for line in self.detokenizer.process_lines(segments)]
+
+    def predict_batch(self, source_seqs, contexts, n_best=1, detokenize=False):
+        """
+        Do prediction for a batch of segments which are already mapped to indices, with a single beam search
+
+        Parameters
+        ----------
+        source_seqs: list[list[int]] : the source segments as indices, ending with the EOS index (see `Vocabulary.encode`)
+        contexts: 2d array : the context features of each segment
+        n_best: int or list[int] : how many hypotheses to return for each segment (must be <= beam_size), or one
+          number per segment
+        detokenize: bool or list[bool] : do the output hypotheses need to be detokenized? (or one flag per segment)
+
+        Returns
+        -------
+        a (translations, costs) tuple for each segment, with the n best translations and their costs
+
+        The options only change how the hypotheses of the search are selected and post-processed, so segments with
+        different options are still searched together. If there is a translation cache, only the segments which
+        are not in it are searched for.
+
+        """
+        n_bests = list(n_best) if isinstance(n_best, (list, tuple)) else [n_best] * len(source_seqs)
+        detokenizes = list(detokenize) if isinstance(detokenize, (list, tuple)) else [detokenize] * len(source_seqs)
+        if self.translation_cache is None:
+            return self._search_batch(source_seqs, contexts, n_bests, detokenizes)
+
+        contexts = numpy.asarray(contexts)
+        keys = [self.translation_cache.key(seq, context, self.beam_size, seq_n_best, seq_detokenize)
+                for seq, context, seq_n_best, seq_detokenize in zip(source_seqs, contexts, n_bests, detokenizes)]
+        results = [self.translation_cache.get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            search_results = self._search_batch([source_seqs[i] for i in missing], contexts[numpy.array(missing)],
+                                                [n_bests[i] for i in missing], [detokenizes[i] for i in missing])
+            for i, (best_n_hyps, best_n_costs) in zip(missing, search_results):
+                results[i] = (tuple(best_n_hyps), tuple(float(cost) for cost in best_n_costs))
+                self.translation_cache.put(keys[i], results[i])
+        # callers get their own lists, the cached tuples are never modified
+        return [(list(best_n_hyps), list(best_n_costs)) for best_n_hyps, best_n_costs in results]
+
+    def _search_batch(self, source_seqs, contexts, n_bests, detokenizes):
+        search_results = self.beam_search.search_batch(
+            [numpy.asarray(seq) for seq in source_seqs], self.project_contexts(contexts),
+            eol_symbol=self.trg_eos_idx, ignore_first_eol=True)
+
+        results = []
+        for seq, (trans, costs), n_best in zip(source_seqs, search_results, n_bests):
+            # normalize costs according to the sequence lengths
+            if self.exp_config['normalized_bleu']:
+                lengths = numpy.array([len(s) for s in trans])
+                costs = costs / lengths
+
+            best_n_hyps = []
+            best_n_costs = []
+            for idx in numpy.argsort(costs)[:n_best]:
+                best_n_hyps.append(self._decode_hypothesis(trans[idx], seq))
+                best_n_costs.append(costs[idx])
+            results.append((best_n_hyps, best_n_costs))
+
+        to_detokenize = [best_n_hyps for (best_n_hyps, _), detokenize in zip(results, detokenizes) if detokenize]
+        if to_detokenize:
+            all_hyps = self.detokenize([hyp for best_n_hyps in to_detokenize for hyp in best_n_hyps])
+            for best_n_hyps in to_detokenize:
+                best_n_hyps[:], all_hyps = all_hyps[:len(best_n_hyps)], all_hyps[len(best_n_hyps):]
+
+        for best_n_hyps, _ in results:
+            # TODO: remove this quick hack
+            best_n_hyps[:] = [trans_out.replace('<UNK>', 'UNK') for trans_out in best_n_hyps]
+
+        return results
+
+    def _decode_hypothesis(self, trans_out, source_seq):
+        # convert idx to words, without the EOS symbol
+        if len(trans_out) == 0:
+            logger.info("Can NOT find a translation for line: {}".format(self.src_vocab.decode(source_seq)))
+            return '<UNK>'
+        if trans_out[-1] != self.trg_eos_idx:
+            logger.error("ERROR: {} does not end with the EOS symbol".format(self.trg_vocab.decode(trans_out)))
+            logger.error("I'm continuing anyway...")
+            return self.trg_vocab.decode(trans_out)
+        return self.trg_vocab.decode(trans_out[:-1])
+
     def predict_segment(self, segment, context, n_best=1, tokenize=False, detokenize=False):
         """
-        Do prediction for a single segment, which is a list of token idxs
+        Do prediction for a single segment
 
         Parameters
         ----------
-        segment: list[int] : a list of int indexes representing the input sequence in the source language
+        segment: str : the input sequence in the source language
         n_best: int : how many hypotheses to return (must be <= beam_size)
         tokenize: bool : does the source segment need to be tokenized first?
         detokenize: bool : do the output hypotheses need to be detokenized?
 
         Returns
         -------
-        trans_out: str : the best translation according to beam search
-        cost: float : the cost of the best translation
+        trans_out: list[str] : the n best translations according to beam search
+        cost: list[float] : their costs
 
         """
 
         if tokenize:
-            tokenizer = Popen(self.tokenizer_cmd, stdin=PIPE, stdout=PIPE)
-            segment, _ = tokenizer.communicate(segment)
-
-        segment = self.map_idx_or_unk(segment, self.src_vocab, self.unk_idx)
-        segment += [self.src_eos_idx]
-
-        seq = NMTPredictor.sutils._oov_to_unk(
-            segment, self.exp_config['src_vocab_size'], self.unk_idx)
-
-        input_ = numpy.tile(seq, (self.exp_config['beam_size'], 1))
-        context_input_ = numpy.tile(context, (self.exp_config['beam_size'], 1))
-
-        # WORKING: change beam search to use the context as well
-        # draw sample, checking to ensure we don't get an empty string back
-        trans, costs = \
-            self.beam_search.search(
-                input_values={self.sampling_input: input_,
-                              self.sampling_context: context_input_},
-                max_length=3*len(seq), eol_symbol=self.trg_eos_idx,
-                ignore_first_eol=True)
-
-        # normalize costs according to the sequence lengths
-        if self.exp_config['normalized_bleu']:
-            lengths = numpy.array([len(s) for s in trans])
-            costs = costs / lengths
-
-        best_n_hyps = []
-        best_n_costs = []
-        best_n_idxs = numpy.argsort(costs)[:n_best]
-        for j, idx in enumerate(best_n_idxs):
-            try:
-                trans_out = trans[idx]
-                cost = costs[idx]
-
-                # convert idx to words
-                # `line` is a tuple with one item
-                try:
-                    assert trans_out[-1] == self.trg_eos_idx, 'Target hypothesis should end with the EOS symbol'
-                    trans_out = trans_out[:-1]
-                    src_in = NMTPredictor.sutils._idx_to_word(segment, self.src_ivocab)
-                    trans_out = NMTPredictor.sutils._idx_to_word(trans_out, self.trg_ivocab)
-                except AssertionError as e:
-                    src_in = NMTPredictor.sutils._idx_to_word(segment, self.src_ivocab)
-                    trans_out = NMTPredictor.sutils._idx_to_word(trans_out, self.trg_ivocab)
-                    logger.error("ERROR: {} does not end with the EOS symbol".format(trans_out))
-                    logger.error("I'm continuing anyway...")
-            # TODO: why would this error happen?
-            except ValueError:
-                logger.info("Can NOT find a translation for line: {}".format(src_in))
-                trans_out = '<UNK>'
-                cost = 0.
-
-            if detokenize:
-                detokenizer = Popen(self.detokenizer_cmd, stdin=PIPE, stdout=PIPE)
-                trans_out, _ = detokenizer.communicate(trans_out)
-                # strip off the eol symbol
-                trans_out = trans_out.strip()
+            segment = self.tokenize([segment])[0]
 
-            # TODO: remove this quick hack
-            trans_out = trans_out.replace('<UNK>', 'UNK')
+        # map to indices, add EOS, and replace out of vocabulary indices with UNK
+        seq = self.src_vocab.encode(segment)
 
-            logger.info("Source: {}".format(src_in))
-            logger.info("Target Hypothesis: {}".format(trans_out))
+        best_n_hyps, best_n_costs = self.predict_batch([seq], numpy.asarray(context)[None, :], n_best=n_best,
+                                                       detokenize=detokenize)[0]
 
-            best_n_hyps.append(trans_out)
-            best_n_costs.append(cost)
+        logger.info("Source: {}".format(self.src_vocab.decode(seq)))
+        for trans_out in best_n_hyps:
+            logger.info("Target Hypothesis: {}".format(trans_out))
 
         return best_n_hyps, best_n_costs
 
+
+def _predict_shard_worker(exp_config, shard, source_input_file, context_input_file, context_ids_file, start, end,
+                          shard_file, output_costs, batch_size, batch_tokens, window_size, messages):
+    # translates lines [start, end) of the source into shard_file, and reports to the parent through `messages`
+    try:
+        predictor = NMTPredictor(exp_config)
+        # the rows of each window are only read and dequantized when it is translated
+        context_features = predictor.get_numpy_array(context_input_file, context_ids_file).segment_range(start, end)
+        with codecs.open(source_input_file) as source_inp, codecs.open(shard_file, 'wb', encoding='utf8') as ftrans:
+            source_lines = (line.rstrip('\n') for line in islice(source_inp, start, end))
+            windows = iter(lambda: list(islice(source_lines, window_size or None)), [])
+            num_translated, total_cost = predictor.translate_windows(
+                windows, context_features, ftrans, output_costs=output_costs, batch_size=batch_size,
+                batch_tokens=batch_tokens, progress=lambda n: messages.put(('progress', shard, n)))
+        if num_translated != end - start:
+            raise ValueError('Shard {} has {} source lines but {} contexts'.format(shard, num_translated, end - start))
+        messages.put(('done', shard, total_cost))
+    except Exception:
+        messages.put(('error', shard, traceback.format_exc()))
+
+
+def predict_files_in_parallel(exp_config, source_input_file, context_input_file, output_file=None,
+                              output_costs=False, context_ids_file=None, workers=2, batch_size=None,
+                              batch_tokens=None, window_size=None):
+    """Like `NMTPredictor.predict_files`, but the input is split into `workers` contiguous shards, which are translated
+    by separate processes
+
+    Each process builds its own `NMTPredictor` (and compiles its own search graph), translates its shard of the source
+    and context rows into a temporary file next to `output_file`, and reports its progress after each window. The
+    shards are then concatenated in order, so the output is the same as with a single process. If a worker fails or
+    dies, the others are stopped, the temporary files are removed and a RuntimeError is raised.
+
+    """
+    if window_size is None:
+        window_size = exp_config.get('predict_window_size', 1000)
+    if output_file is None:
+        output_file = '.'.join(source_input_file.split('.')[:-1]) + '.trans.out'
+
+    # the shards are cut by line number, so the source and the context rows must match exactly, the rows of a .npy
+    # store are memory-mapped
+    num_segments = len(load_context_features(context_input_file, context_ids_file))
+    num_source_segments = NMTPredictor.count_source_segments(source_input_file)
+    if num_source_segments != num_segments:
+        raise ValueError('{} has {} segments but {} has {} context rows'.format(
+            source_input_file, num_source_segments, context_input_file, num_segments))
+    bounds = [num_segments * i // workers for i in range(workers + 1)]
+    shards = [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+    shard_files = ['{}.shard{}'.format(output_file, i) for i in range(len(shards))]
+
+    logger.info("Translating {} segments with {} worker processes".format(num_segments, len(shards)))
+    start_time = time.time()
+
+    context = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') \
+        else multiprocessing
+    messages = context.Queue()
+    processes = []
+    for shard, ((start, end), shard_file) in enumerate(zip(shards, shard_files)):
+        process = context.Process(target=_predict_shard_worker,
+                                  args=(exp_config, shard, source_input_file, context_input_file, context_ids_file,
+                                        start, end, shard_file, output_costs, batch_size, batch_tokens, window_size,
+                                        messages))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+
+    translated = [0] * len(shards)
+    finished = set()
+    total_cost = 0.0
+    try:
+        while len(finished) < len(shards):
+            try:
+                kind, shard, value = messages.get(timeout=1.)
+            except queue.Empty:
+                # a worker which exits normally has put its last message first, only a crash goes unreported
+                for shard, process in enumerate(processes):
+                    if shard not in finished and process.exitcode not in (None, 0):
+                        raise RuntimeError('Worker {} died with exit code {}'.format(shard, process.exitcode))
+                continue
+
+            if kind == 'error':
+                raise RuntimeError('Worker {} failed:\n{}'.format(shard, value))
+            elif kind == 'progress':
+                translated[shard] = value
+                logger.info("Shard {}: translated {}/{} lines, {}/{} in total".format(
+                    shard, value, shards[shard][1] - shards[shard][0], sum(translated), num_segments))
+            else:
+                finished.add(shard)
+                total_cost += value
+                logger.info("Shard {} is done".format(shard))
+
+        with open(output_file, 'wb') as ftrans:
+            for shard_file in shard_files:
+                with open(shard_file, 'rb') as shard_trans:
+                    shutil.copyfileobj(shard_trans, ftrans)
+    except BaseException:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        raise
+    finally:
+        for process in processes:
+            process.join()
+        for shard_file in shard_files:
+            if os.path.exists(shard_file):
+                os.remove(shard_file)
+
+    logger.info("Saved translated output to: {}".format(output_file))
+    logger.info("Total cost of the test: {}".format(total_cost))
+    logger.info("Translating {} segments took {:.1f} seconds".format(num_segments, time.time() - start_time))
+
+    return output_file
@@ -2,15 +2,13 @@ from __future__ import print_function
 import argparse
 import logging
 import pprint
-import codecs
-import re
 import os
 import time
-from subprocess import Popen, PIPE, check_output
 
 from machine_translation import configurations
 
-from mmmt import main, NMTPredictor
+from mmmt import main, predict_files_in_parallel, NMTPredictor
+from mmmt.evaluation import CorpusBleu, MeteorScorer, iter_segments
 from mmmt.stream import get_tr_stream_with_context_features, get_dev_stream_with_context_features
 
 logging.basicConfig()
@@ -24,6 +22,18 @@ parser.add_argument("-m", "--mode", default='train',
                     help="The mode we are in [train,predict,server] -- default=train")
 parser.add_argument("--bokeh",  default=False, action="store_true",
                     help="Use bokeh server for plotting")
+parser.add_argument("--batch-size", type=int, default=None,
+                    help="How many segments are translated at once in predict and evaluate modes "
+                         "-- default=predict_batch_size from the config")
+parser.add_argument("--batch-tokens", type=int, default=None,
+                    help="Limit prediction batches to this many source tokens "
+                         "-- default=predict_batch_tokens from the config")
+parser.add_argument("--window-size", type=int, default=None,
+                    help="How many source segments are read, translated and written at a time in predict and "
+                         "evaluate modes -- default=predict_window_size from the config")
+parser.add_argument("--workers", type=int, default=None,
+                    help="Split the test set between this many processes in predict and evaluate modes "
+                         "-- default=predict_workers from the config, or 1")
 
 if __name__ == "__main__":
     # Get configurations for model
@@ -36,6 +46,7 @@ if __name__ == "__main__":
     # add the config file name into config_obj
     config_obj['config_file'] = configuration_file
     logger.info("Model Configuration:\n{}".format(pprint.pformat(config_obj)))
+    workers = args.workers or config_obj.get('predict_workers', 1)
 
     # TODO: organize mmmt code so that we can implement train for mmmt
     # TODO: support specifying target transition via config
@@ -48,10 +59,17 @@ if __name__ == "__main__":
         main(config_obj, train_stream, dev_stream, source_vocab, target_vocab, args.bokeh)
 
     elif mode == 'predict':
-        predictor = NMTPredictor(config_obj)
-        predictor.predict_files(config_obj['test_set'], config_obj['test_context_features'],
-                                output_file=config_obj.get('translated_output_file', None),
-                                output_costs=config_obj.get('output_cost', False))
+        predict_kwargs = dict(output_file=config_obj.get('translated_output_file', None),
+                              output_costs=config_obj.get('output_cost', False),
+                              context_ids_file=config_obj.get('test_context_feature_ids', None),
+                              batch_size=args.batch_size, batch_tokens=args.batch_tokens,
+                              window_size=args.window_size)
+        if workers > 1:
+            predict_files_in_parallel(config_obj, config_obj['test_set'], config_obj['test_context_features'],
+                                      workers=workers, **predict_kwargs)
+        else:
+            predictor = NMTPredictor(config_obj)
+            predictor.predict_files(config_obj['test_set'], config_obj['test_context_features'], **predict_kwargs)
 
     elif mode == 'evaluate':
         logger.info("Started Evaluation: ")
@@ -64,63 +82,49 @@ if __name__ == "__main__":
                             'reference that you provided: {}'.format(translated_output_file,
                                                                      config_obj['test_gold_refs']))
         else:
-            predictor = NMTPredictor(config_obj)
             logger.info('Translating: {}'.format(config_obj['test_set']))
-            translated_output_file = predictor.predict_files(config_obj['test_set'],
-                                                             config_obj['test_context_features'],
-                                                             translated_output_file)
+            predict_kwargs = dict(context_ids_file=config_obj.get('test_context_feature_ids', None),
+                                  batch_size=args.batch_size, batch_tokens=args.batch_tokens,
+                                  window_size=args.window_size)
+            if workers > 1:
+                translated_output_file = predict_files_in_parallel(config_obj, config_obj['test_set'],
+                                                                   config_obj['test_context_features'],
+                                                                   translated_output_file, workers=workers,
+                                                                   **predict_kwargs)
+            else:
+                predictor = NMTPredictor(config_obj)
+                translated_output_file = predictor.predict_files(config_obj['test_set'],
+                                                                 config_obj['test_context_features'],
+                                                                 translated_output_file, **predict_kwargs)
             logger.info('Translated: {}, output was written to: {}'.format(config_obj['test_set'],
                                                                            translated_output_file))
 
-        # BLEU
-        multibleu_cmd = ['perl', config_obj['bleu_script'],
-                         config_obj['test_gold_refs'], '<']
-
-        mb_subprocess = Popen(multibleu_cmd, stdin=PIPE, stdout=PIPE)
-
-        with codecs.open(translated_output_file, encoding='utf8') as hyps:
-            for l in hyps.read().strip().split('\n'):
-                # send the line to the BLEU script
-                print(l.encode('utf8'), file=mb_subprocess.stdin)
-
-        mb_subprocess.stdin.flush()
-
-        # send end of file, read output.
-        mb_subprocess.stdin.close()
-        stdout = mb_subprocess.stdout.readline()
-        logger.info(stdout)
-        out_parse = re.match(r'BLEU = [-.0-9]+', stdout)
+        # BLEU, the hypotheses and references are read line by line, so memory doesn't grow with the test set
+        bleu_report, bleu_score = CorpusBleu.score_files(translated_output_file, [config_obj['test_gold_refs']])
+        logger.info(bleu_report)
         logger.info("Validation Took: {} minutes".format(
             float(time.time() - val_start_time) / 60.))
-        assert out_parse is not None
-
-        # extract the score
-        bleu_score = float(out_parse.group()[6:])
         logger.info('BLEU SCORE: {}'.format(bleu_score))
-        mb_subprocess.terminate()
 
         # Meteor
-        meteor_directory = config_obj.get('meteor_directory', None)
-        if meteor_directory is not None:
-            target_language = config_obj.get('target_lang', 'de')
-            # java -Xmx2G -jar meteor-*.jar test reference - l en - norm
-            # Note: not using the `-norm` parameter with METEOR since the references are already tokenized
-            meteor_cmd = ['java', '-Xmx4G', '-jar', os.path.join(meteor_directory, 'meteor-1.5.jar'),
-                          translated_output_file, config_obj['test_gold_refs'], '-l', target_language, '-norm']
-
-            meteor_output = check_output(meteor_cmd)
-            meteor_score = float(meteor_output.strip().split('\n')[-1].split()[-1])
+        if config_obj.get('meteor_directory', None) is not None or config_obj.get('meteor_command', None) is not None:
+            meteor_scorer = MeteorScorer.from_config(config_obj)
+            # zip stops at the last hypothesis, so a partial translation is scored against the matching references
+            meteor_score = meteor_scorer.corpus_score(iter_segments(translated_output_file),
+                                                      iter_segments(config_obj['test_gold_refs']))
+            meteor_scorer.close()
             logger.info('METEOR SCORE: {}'.format(meteor_score))
 
 
     elif mode == 'server':
+        from mmmt.server import run_nmt_server
 
-        import sys
-        sys.path.append('.')
-        from server import run_nmt_server
-
-        # start restful server and log its port
+        # start the http server, it logs its port
         predictor = NMTPredictor(config_obj)
-        run_nmt_server(predictor)
+        run_nmt_server(predictor, host=config_obj.get('server_host', '0.0.0.0'),
+                       port=config_obj.get('server_port', 5000),
+                       max_batch_size=config_obj.get('server_max_batch_size', 16),
+                       max_wait=config_obj.get('server_max_wait', 0.01),
+                       max_body_size=config_obj.get('server_max_body_size', 16 * 1024 * 1024))
 
 
@@ -0,0 +1,220 @@
+"""
+Caches for values which are expensive to recompute at inference time
+
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy
+import six
+from six.moves import cPickle
+
+logger = logging.getLogger(__name__)
+
+
+def array_key(array):
+    """A key for the content of an array, e.g. a context feature vector: the sha1 of its float32 bytes"""
+    return hashlib.sha1(numpy.ascontiguousarray(array, dtype='float32').tobytes()).hexdigest()
+
+
+def fingerprint(*values):
+    """A key for the identity of a model and its settings, e.g. to tell whether cached outputs are still valid
+
+    Values which are paths to existing files stand for the file, through its absolute path, size and modification
+    time, so the fingerprint changes when a file is replaced.
+
+    """
+    parts = []
+    for value in values:
+        if isinstance(value, six.string_types) and os.path.isfile(value):
+            stat = os.stat(value)
+            value = 'file:{}:{}:{}'.format(os.path.abspath(value), stat.st_size, stat.st_mtime)
+        parts.append(repr(value))
+    return hashlib.sha1('\n'.join(parts).encode('utf8')).hexdigest()
+
+
+class LRUCache(object):
+    """A dict with at most `max_size` items, the least recently used item is evicted first
+
+    Parameters
+    ----------
+    max_size: int : how many items the cache holds, 0 disables the cache
+    ttl: float : if given, items are dropped this many seconds after they were put in the cache
+
+    """
+
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (value, time it was put)
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        try:
+            value, put_time = self.items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        if self.ttl is not None and time.time() - put_time > self.ttl:
+            self.misses += 1
+            return default
+        # move the item to the most recently used end
+        self.items[key] = (value, put_time)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        self.items.pop(key, None)
+        self.items[key] = (value, time.time())
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+
+class SqliteCache(object):
+    """A persistent key-value store in an sqlite file, the values are pickled
+
+    Parameters
+    ----------
+    path: str : the sqlite file, it is created if it doesn't exist
+    ttl: float : if given, items are dropped this many seconds after they were put in the cache, expired items
+      are deleted when the file is opened
+    fingerprint: str : if given, it is stored in the file, and a file holding another fingerprint is emptied when it
+      is opened (e.g. the `fingerprint` of the model which produced the values)
+
+    """
+
+    def __init__(self, path, ttl=None, fingerprint=None):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # the connection is shared by the threads of a server, `lock` serializes its use
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, time REAL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)')
+            if fingerprint is not None:
+                row = self.connection.execute("SELECT value FROM metadata WHERE name = 'fingerprint'").fetchone()
+                if row is not None and row[0] != fingerprint:
+                    logger.info('{} was written with other settings, clearing it'.format(path))
+                    self.connection.execute('DELETE FROM cache')
+                self.connection.execute("INSERT OR REPLACE INTO metadata VALUES ('fingerprint', ?)", (fingerprint,))
+            if ttl is not None:
+                self.connection.execute('DELETE FROM cache WHERE time < ?', (time.time() - ttl,))
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def get(self, key, default=None):
+        with self.lock:
+            row = self.connection.execute('SELECT value, time FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None or (self.ttl is not None and time.time() - row[1] > self.ttl):
+            return default
+        return cPickle.loads(bytes(row[0]))
+
+    def put(self, key, value):
+        data = sqlite3.Binary(cPickle.dumps(value, protocol=cPickle.HIGHEST_PROTOCOL))
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?)', (key, data, time.time()))
+
+    def clear(self):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM cache')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class TranslationCache(object):
+    """The translations of source segments, in an `LRUCache` backed by an optional `SqliteCache`
+
+    Items which are missing from memory are looked up on disk, and put back in memory when they are found there, so a
+    restarted server starts with the translations of the previous runs. Every new item is written to both tiers.
+
+    `model_fingerprint` identifies the model and everything else which changes its outputs (see `fingerprint`). It is
+    part of every key, and the sqlite file is cleared when it was written with another one, so a server restarted
+    with new parameters or settings never serves the translations of the old ones.
+
+    Parameters
+    ----------
+    max_size: int : how many translations are kept in memory
+    ttl: float : if given, translations expire this many seconds after they were computed
+    path: str : if given, the sqlite file of the persistent tier
+    model_fingerprint: str : the fingerprint of the model and its decoding settings
+
+    """
+
+    def __init__(self, max_size=1024, ttl=None, path=None, model_fingerprint=''):
+        self.model_fingerprint = model_fingerprint
+        self.memory = LRUCache(max_size, ttl=ttl)
+        self.disk = SqliteCache(path, ttl=ttl, fingerprint=model_fingerprint) if path is not None else None
+        # the predictor may be called from the threads of a server
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, source_seq, context, beam_size, n_best, detokenize=False):
+        """A key for the translations of a source segment (as indices) with the context features `context`"""
+        return hashlib.sha1('{} {} {} {} {} {}'.format(self.model_fingerprint,
+                                                       ' '.join(str(idx) for idx in source_seq), array_key(context),
+                                                       beam_size, n_best, int(detokenize)).encode('utf8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            value = self.memory.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                with self.lock:
+                    self.memory.put(key, value)
+                    self.disk_hits += 1
+                return value
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.memory.put(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    def stats(self):
+        """The hit and miss counts, and the fraction of lookups which were found in either tier"""
+        lookups = self.hits + self.disk_hits + self.misses
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'size': len(self.memory),
+                'hit_rate': float(self.hits + self.disk_hits) / lookups if lookups else 0.}
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
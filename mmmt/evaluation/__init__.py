@@ -0,0 +1,351 @@
+"""
+Evaluation metrics for MMMT models
+
+"""
+
+import codecs
+import logging
+import math
+import os
+from collections import Counter
+from itertools import islice
+from subprocess import Popen, PIPE
+
+import six
+
+logger = logging.getLogger(__name__)
+
+
+def count_ngrams(tokens, max_order=4):
+    """Count all n-grams of `tokens` up to length `max_order`, n-grams are tuples"""
+    tokens = tuple(tokens)
+    return Counter(tokens[start:start + n] for n in range(1, max_order + 1)
+                   for start in range(len(tokens) - n + 1))
+
+
+def read_segments(filename, encoding='utf8'):
+    """Read a file with one segment per line (with encoding=None, lines are read as native strings)"""
+    segments_file = open(filename) if encoding is None else codecs.open(filename, encoding=encoding)
+    with segments_file:
+        segments = segments_file.read().split('\n')
+    if segments[-1] == '':
+        segments = segments[:-1]
+    return segments
+
+
+def iter_segments(filename, encoding='utf8'):
+    """Like `read_segments`, but the lines are read one at a time"""
+    segments_file = open(filename) if encoding is None else codecs.open(filename, encoding=encoding)
+    with segments_file:
+        for line in segments_file:
+            yield line[:-1] if line.endswith('\n') else line
+
+
+def _my_log(x):
+    # the same as my_log in multi-bleu.perl
+    if not x:
+        return -9999999999
+    return math.log(x)
+
+
+class CorpusBleu(object):
+    """Corpus BLEU computed exactly like moses' multi-bleu.perl, without starting a subprocess
+
+    The n-gram counts of the references are computed once, so the same object can score any number of hypothesis
+    sets against them. Hypotheses and references can be strings (split on whitespace), token lists, or index
+    sequences. If a vocabulary is given, references are mapped to indices so that hypotheses can be scored straight
+    from the output of the beam search. Reference words that the vocabulary doesn't cover get the index -1, so they
+    never match anything, just like their text never matches an <UNK> in a hypothesis.
+
+    Parameters
+    ----------
+    references: list : one item per segment, each item is the list of references for that segment
+    vocab: mmmt.vocab.Vocabulary : if given, references are mapped to indices with it
+    max_order: int : the longest n-grams that are counted
+
+    """
+
+    def __init__(self, references, vocab=None, max_order=4):
+        self.max_order = max_order
+        self.vocab = vocab
+
+        self.ref_lengths = []
+        self.ref_ngram_counts = []
+        for segment_refs in references:
+            ref_lengths, ref_counts = self._reference_counts(segment_refs)
+            self.ref_lengths.append(ref_lengths)
+            self.ref_ngram_counts.append(ref_counts)
+
+    @classmethod
+    def from_files(cls, reference_files, vocab=None, max_order=4):
+        """Load references from one file per reference, with one segment per line"""
+        # with a vocabulary, read the lines the same way as fuel's TextFile, so they match the vocabulary keys
+        ref_lines = [read_segments(reference_file, encoding=None if vocab is not None else 'utf8')
+                     for reference_file in reference_files]
+        return cls(list(zip(*ref_lines)), vocab=vocab, max_order=max_order)
+
+    @classmethod
+    def score_files(cls, hypothesis_file, reference_files, max_order=4):
+        """Score a file of hypotheses in a single pass, reading it and the reference files one line at a time
+
+        Unlike `from_files`, nothing is kept in memory from one segment to the next, so this works for test sets of
+        any size. Returns the line that multi-bleu.perl would print, and the score.
+
+        """
+        corpus_bleu = cls([], max_order=max_order)
+        missing = object()
+        segments = six.moves.zip_longest(iter_segments(hypothesis_file),
+                                         *[iter_segments(reference_file) for reference_file in reference_files],
+                                         fillvalue=missing)
+        statistics = corpus_bleu._empty_statistics()
+        for segment in segments:
+            hyp, segment_refs = segment[0], segment[1:]
+            if hyp is missing:
+                break
+            if missing in segment_refs:
+                raise ValueError('{} has more lines than the references'.format(hypothesis_file))
+            ref_lengths, ref_counts = corpus_bleu._reference_counts(segment_refs)
+            corpus_bleu._add_statistics(statistics, hyp, ref_lengths, ref_counts)
+        return corpus_bleu._report(statistics), corpus_bleu._score(statistics)
+
+    @staticmethod
+    def _tokens(segment):
+        if isinstance(segment, six.string_types):
+            return segment.split()
+        return list(segment)
+
+    def _to_idxs(self, tokens):
+        idxs = []
+        for word in tokens:
+            idx = self.vocab.get(word, -1)
+            idxs.append(idx if idx < self.vocab.vocab_size else -1)
+        return idxs
+
+    def _reference_counts(self, segment_refs):
+        segment_refs = [self._tokens(ref) for ref in segment_refs]
+        if self.vocab is not None:
+            segment_refs = [self._to_idxs(ref) for ref in segment_refs]
+
+        # the clipping counts are the max counts of each n-gram over all the references
+        max_counts = Counter()
+        for ref in segment_refs:
+            for ngram, count in count_ngrams(ref, self.max_order).items():
+                max_counts[ngram] = max(max_counts[ngram], count)
+        return [len(ref) for ref in segment_refs], max_counts
+
+    def _empty_statistics(self):
+        # correct, total, hyp_length, ref_length, updated in place by `_add_statistics`
+        return [[0] * self.max_order, [0] * self.max_order, 0, 0]
+
+    def _add_statistics(self, statistics, hyp, ref_lengths, ref_counts):
+        correct, total = statistics[0], statistics[1]
+        hyp = self._tokens(hyp)
+        statistics[2] += len(hyp)
+        statistics[3] += min(ref_lengths, key=lambda length: (abs(len(hyp) - length), length))
+
+        for ngram, count in count_ngrams(hyp, self.max_order).items():
+            n = len(ngram) - 1
+            total[n] += count
+            correct[n] += min(count, ref_counts[ngram])
+
+    def statistics(self, hypotheses):
+        """Get the matching and total n-gram counts, and the hypothesis and reference lengths
+
+        Returns
+        -------
+        correct: list[int] : the clipped n-gram matches for each order
+        total: list[int] : the number of hypothesis n-grams for each order
+        hyp_length: int
+        ref_length: int : the sum of the closest reference lengths (ties go to the shorter reference)
+
+        """
+        statistics = self._empty_statistics()
+        # hypotheses may be any iterable, e.g. the lines of a file read by `iter_segments`
+        for i, hyp in enumerate(hypotheses):
+            if i >= len(self.ref_ngram_counts):
+                raise ValueError('There are more hypotheses than the {} references'.format(
+                    len(self.ref_ngram_counts)))
+            self._add_statistics(statistics, hyp, self.ref_lengths[i], self.ref_ngram_counts[i])
+        return tuple(statistics)
+
+    def _compute(self, statistics):
+        correct, total, hyp_length, ref_length = statistics
+        precisions = [float(c) / t if t else 0. for c, t in zip(correct, total)]
+
+        brevity_penalty = 1.
+        if hyp_length < ref_length:
+            brevity_penalty = math.exp(1. - float(ref_length) / hyp_length) if hyp_length else 0.
+        bleu = brevity_penalty * math.exp(sum(_my_log(p) for p in precisions) / self.max_order)
+        return bleu, precisions, brevity_penalty, hyp_length, ref_length
+
+    def _report(self, statistics):
+        bleu, precisions, brevity_penalty, hyp_length, ref_length = self._compute(statistics)
+        if ref_length == 0:
+            return 'BLEU = 0, 0/0/0/0 (BP=0, ratio=0, hyp_len=0, ref_len=0)'
+        return 'BLEU = {:.2f}, {} (BP={:.3f}, ratio={:.3f}, hyp_len={}, ref_len={})'.format(
+            100 * bleu, '/'.join('{:.1f}'.format(100 * p) for p in precisions), brevity_penalty,
+            float(hyp_length) / ref_length, hyp_length, ref_length)
+
+    def _score(self, statistics):
+        return float('{:.2f}'.format(100 * self._compute(statistics)[0]))
+
+    def compute(self, hypotheses):
+        """Get BLEU (in [0, 1]), the n-gram precisions, the brevity penalty and the lengths"""
+        return self._compute(self.statistics(hypotheses))
+
+    def report(self, hypotheses):
+        """Get the line that multi-bleu.perl would print for `hypotheses`"""
+        return self._report(self.statistics(hypotheses))
+
+    def score(self, hypotheses):
+        """Get BLEU as multi-bleu.perl reports it, i.e. multiplied by 100 and rounded to two decimals"""
+        return self._score(self.statistics(hypotheses))
+
+
+class MeteorScorer(object):
+    """A long-lived METEOR process, driven through its `-stdio` protocol
+
+    Starting the JVM and loading the paraphrase tables is done once, and the process is reused for every call.
+    Segments are sent as `SCORE ||| reference(s) ||| hypothesis` lines in batches of `batch_size`, and the
+    statistics that come back are turned into scores with `EVAL` lines. If the process dies, it is restarted and the
+    batch is sent again.
+
+    Parameters
+    ----------
+    meteor_cmd: list[str] : the command that starts a scorer speaking the METEOR stdio protocol, e.g. the output of
+      `meteor_command`, or `['python', '-m', 'mmmt.evaluation.fake_meteor']` for tests
+    batch_size: int : how many segments are written before their statistics are read back
+
+    """
+
+    def __init__(self, meteor_cmd, batch_size=100):
+        self.meteor_cmd = meteor_cmd
+        self.batch_size = batch_size
+        self.meteor_process = None
+
+    @staticmethod
+    def meteor_command(meteor_directory, language, max_memory='4G', normalize=True):
+        """Get the command which starts meteor-1.5 in stdio mode"""
+        meteor_cmd = ['java', '-Xmx{}'.format(max_memory), '-jar', os.path.join(meteor_directory, 'meteor-1.5.jar'),
+                      '-', '-', '-stdio', '-l', language]
+        if normalize:
+            meteor_cmd.append('-norm')
+        return meteor_cmd
+
+    @classmethod
+    def from_config(cls, config):
+        """Run `meteor_command` from an experiment config if it is set, otherwise meteor-1.5 in `meteor_directory`"""
+        meteor_cmd = config.get('meteor_command', None)
+        if meteor_cmd is None:
+            meteor_cmd = cls.meteor_command(config['meteor_directory'], config.get('target_lang', 'de'))
+        elif isinstance(meteor_cmd, six.string_types):
+            meteor_cmd = meteor_cmd.split()
+        return cls(meteor_cmd)
+
+    def _start(self):
+        self.close()
+        logger.info('Starting METEOR: {}'.format(' '.join(self.meteor_cmd)))
+        self.meteor_process = Popen(self.meteor_cmd, stdin=PIPE, stdout=PIPE, universal_newlines=True)
+
+    def close(self):
+        if self.meteor_process is not None:
+            try:
+                self.meteor_process.stdin.close()
+                self.meteor_process.wait()
+            except (IOError, OSError):
+                pass
+            self.meteor_process = None
+
+    @staticmethod
+    def _clean(segment):
+        # the protocol is line based and uses ||| as a separator
+        if six.PY2 and isinstance(segment, six.text_type):
+            segment = segment.encode('utf8')
+        return ' '.join(segment.replace('|||', '').split())
+
+    def _communicate(self, lines, num_outputs, retries=1):
+        """Write `lines` and read `num_outputs` lines back, restarting the process if it has died"""
+        for attempt in range(retries + 1):
+            if self.meteor_process is None or self.meteor_process.poll() is not None:
+                self._start()
+            try:
+                self.meteor_process.stdin.write(''.join(line + '\n' for line in lines))
+                self.meteor_process.stdin.flush()
+                outputs = [self.meteor_process.stdout.readline() for _ in range(num_outputs)]
+                if all(outputs):
+                    return [output.strip() for output in outputs]
+                error = 'METEOR exited with code {}'.format(self.meteor_process.poll())
+            except (IOError, OSError) as e:
+                error = e
+            logger.warning('METEOR failed ({}), restarting it'.format(error))
+            self.close()
+        raise RuntimeError('METEOR failed {} times: {}'.format(retries + 1, error))
+
+    def _batch_statistics(self, hypotheses, references):
+        # yields the METEOR statistics of each batch of `batch_size` segments
+        if hasattr(hypotheses, '__len__') and hasattr(references, '__len__'):
+            assert len(hypotheses) == len(references), 'lens {} and {} do not match'.format(
+                len(hypotheses), len(references))
+        segments = six.moves.zip(hypotheses, references)
+        while True:
+            lines = []
+            for hyp, refs in islice(segments, self.batch_size):
+                if isinstance(refs, six.string_types):
+                    refs = [refs]
+                lines.append(' ||| '.join(['SCORE'] + [self._clean(ref) for ref in refs] + [self._clean(hyp)]))
+            if not lines:
+                return
+            yield self._communicate(lines, len(lines))
+
+    def statistics(self, hypotheses, references):
+        """Get the METEOR statistics of each hypothesis, `references` has a reference or a list of them per segment
+
+        Both can be any iterables, e.g. the lines of files read by `iter_segments`.
+
+        """
+        return [stats for batch_stats in self._batch_statistics(hypotheses, references) for stats in batch_stats]
+
+    def _eval(self, stats):
+        # EVAL prints the score of a single set of statistics, or the score of each of several sets followed by the
+        # score of their aggregate, which is dropped here
+        num_outputs = len(stats) + 1 if len(stats) > 1 else 1
+        scores = self._communicate([' ||| '.join(['EVAL'] + stats)], num_outputs)
+        return [float(score) for score in scores[:len(stats)]]
+
+    def _evaluate(self, hypotheses, references, sentence_scores=True):
+        # METEOR aggregates statistics by summing them, so only the running sum is kept for the corpus score
+        scores = []
+        total = None
+        for batch_stats in self._batch_statistics(hypotheses, references):
+            if sentence_scores:
+                scores.extend(self._eval(batch_stats))
+            for stats in batch_stats:
+                values = [float(value) for value in stats.split()]
+                total = values if total is None else [a + b for a, b in zip(total, values)]
+        if total is None:
+            return scores, 0.
+        return scores, self._eval([' '.join(repr(value) for value in total)])[0]
+
+    def evaluate(self, hypotheses, references):
+        """Get the score of each segment, and the corpus-level score"""
+        return self._evaluate(hypotheses, references)
+
+    def sentence_scores(self, hypotheses, references):
+        return self._evaluate(hypotheses, references)[0]
+
+    def corpus_score(self, hypotheses, references):
+        """Get the corpus-level score, the memory it takes doesn't grow with the number of segments"""
+        return self._evaluate(hypotheses, references, sentence_scores=False)[1]
+
+    def sentence_level_meteor(self, source, reference, samples, trg_vocab=None, **kwargs):
+        """Score each sample against the reference, for use as the score function of min-risk training
+
+        This has the interface of `machine_translation.evaluation.sentence_level_meteor`, the reference and the
+        samples are index sequences which are mapped to words with `trg_vocab`.
+
+        """
+        hypotheses = trg_vocab.decode_batch(samples)
+        return self.sentence_scores(hypotheses, [trg_vocab.decode(reference)] * len(hypotheses))
+
+    def __del__(self):
+        self.close()
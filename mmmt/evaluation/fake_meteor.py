@@ -0,0 +1,57 @@
+"""
+A stand-in for `java -jar meteor-1.5.jar - - -stdio`, which speaks the same stdio protocol
+
+Usage:
+    python -m mmmt.evaluation.fake_meteor
+
+`SCORE ||| ref1 ||| ... ||| hyp` prints the statistics of the hypothesis: unigram matches against the best
+reference, hypothesis length and reference length. `EVAL ||| stats1 ||| ... ||| statsN` prints the unigram
+F-mean of each set of statistics, then the F-mean of their sum (like METEOR, a single set only gets its own score).
+This is much cruder than METEOR, but it is deterministic and fast, which is what tests of the scoring client need.
+
+"""
+
+from __future__ import division
+
+import sys
+from collections import Counter
+
+
+def segment_stats(refs, hyp):
+    hyp = hyp.split()
+    best = None
+    for ref in refs:
+        ref = ref.split()
+        matches = sum((Counter(hyp) & Counter(ref)).values())
+        if best is None or matches > best[0]:
+            best = (matches, len(hyp), len(ref))
+    return best
+
+
+def f_mean(matches, hyp_len, ref_len):
+    if not matches:
+        return 0.
+    precision = matches / hyp_len
+    recall = matches / ref_len
+    return 10 * precision * recall / (recall + 9 * precision)
+
+
+def main(stdin, stdout):
+    for line in iter(stdin.readline, ''):
+        fields = [field.strip() for field in line.rstrip('\n').split('|||')]
+        command, args = fields[0], fields[1:]
+        if command == 'SCORE':
+            stdout.write('{:.1f} {:.1f} {:.1f}\n'.format(*segment_stats(args[:-1], args[-1])))
+        elif command == 'EVAL':
+            all_stats = [[float(x) for x in stats.split()] for stats in args]
+            for stats in all_stats:
+                stdout.write('{}\n'.format(f_mean(*stats)))
+            if len(all_stats) > 1:
+                stdout.write('{}\n'.format(f_mean(*[sum(column) for column in zip(*all_stats)])))
+        else:
+            stdout.write('Error: unknown command {}\n'.format(command))
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    main(sys.stdin, sys.stdout)
@@ -0,0 +1,199 @@
+"""
+Training extensions for MMMT models
+
+"""
+
+import atexit
+import io
+import logging
+import os
+import tempfile
+import threading
+import time
+import traceback
+
+import numpy
+from six.moves import cPickle, queue
+
+from blocks.extensions.saveload import SAVED_TO
+from blocks.serialization import BRICK_DELIMITER, dump
+from machine_translation.checkpoint import CheckpointNMT
+
+logger = logging.getLogger(__name__)
+
+
+def _fsync_directory(directory):
+    # makes a rename in `directory` durable, not every platform can open a directory
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path, write_func):
+    """Write a file through `write_func(file)` so that `path` holds either its old or its complete new content
+
+    The content is written to a temporary file in the same directory, which is flushed to disk and then renamed
+    to `path`.
+
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            write_func(tmp_file)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.rename(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    _fsync_directory(directory)
+
+
+class AsyncCheckpointWriter(object):
+    """Writes checkpoints in a background thread, so that training doesn't wait for the disk
+
+    Jobs are run in the order they are submitted: the data of a job must be a snapshot which the training process
+    doesn't modify afterwards (e.g. the output of `get_parameter_values`, which copies the values). Every file is
+    written with `atomic_write`, and a `remove` only runs once all the files submitted before it are on disk, so
+    deleting an old checkpoint after saving its replacement never leaves the directory without one.
+
+    The thread is only started by the first job, so a writer can be created before processes are forked (e.g. by
+    `AsyncMultiMetricValidator`) without the children inheriting a running thread. If a job fails, the error is raised
+    by the next call to the writer. Pending jobs are finished at exit.
+
+    Parameters
+    ----------
+    max_pending: int : how many jobs may wait to be written before submitting another one blocks
+
+    """
+
+    def __init__(self, max_pending=2):
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = None
+        self.closed = False
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                func, args = job
+                func(*args)
+            except Exception:
+                self.error = traceback.format_exc()
+                logger.error('Writing a checkpoint failed:\n{}'.format(self.error))
+            finally:
+                self.jobs.task_done()
+
+    def _submit(self, func, *args):
+        self._check()
+        if self.closed:
+            raise RuntimeError('The checkpoint writer has been closed')
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='AsyncCheckpointWriter')
+            self.thread.daemon = True
+            self.thread.start()
+        self.jobs.put((func, args))
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Writing a checkpoint failed:\n{}'.format(error))
+
+    @staticmethod
+    def _write_npz(path, arrays):
+        start = time.time()
+        atomic_write(path, lambda npz_file: numpy.savez(npz_file, **arrays))
+        logger.info('Wrote {} in {:.1f} seconds'.format(path, time.time() - start))
+
+    @staticmethod
+    def _write_bytes(path, data):
+        atomic_write(path, lambda out_file: out_file.write(data))
+
+    @staticmethod
+    def _remove(path):
+        if os.path.isfile(path):
+            logger.info('Deleting old model {}'.format(path))
+            os.remove(path)
+
+    def save_parameter_values(self, param_values, path):
+        """Save parameters in the format of `SaveLoadUtils.save_parameter_values`"""
+        self.save_arrays(dict((name.replace('/', BRICK_DELIMITER), value)
+                              for name, value in param_values.items()), path)
+
+    def save_arrays(self, arrays, path):
+        """Save a dict of arrays to an npz file, `path` is used as it is (numpy.savez would add .npz to it)"""
+        self._submit(self._write_npz, path, arrays)
+
+    def save_bytes(self, data, path):
+        self._submit(self._write_bytes, path, data)
+
+    def remove(self, path):
+        """Delete `path` once everything submitted so far has been written"""
+        self._submit(self._remove, path)
+
+    def wait(self):
+        """Block until all submitted jobs are done"""
+        self.jobs.join()
+        self._check()
+
+    def close(self):
+        self.closed = True
+        if self.thread is not None and self.thread.is_alive():
+            self.jobs.put(None)
+            self.thread.join()
+        self._check()
+
+
+class AsyncCheckpointNMT(CheckpointNMT):
+    """Like `CheckpointNMT`, but the files are written by an `AsyncCheckpointWriter`
+
+    The parameters, iteration state and log are copied into memory in the main loop, and written atomically in the
+    background, to the file names of `CheckpointNMT` and in the formats `LoadNMT` reads: an npz file for the
+    parameters, a blocks tar archive for the iteration state, and a plain pickle for the log. After training, the
+    extension waits until everything is on disk.
+
+    """
+
+    def __init__(self, saveto, checkpoint_writer=None, **kwargs):
+        super(AsyncCheckpointNMT, self).__init__(saveto, **kwargs)
+        self.checkpoint_writer = checkpoint_writer or AsyncCheckpointWriter()
+
+    @staticmethod
+    def _serialize(obj):
+        # blocks' dump writes a tar archive, which can be put in memory
+        buf = io.BytesIO()
+        dump(obj, buf)
+        return buf.getvalue()
+
+    def dump(self, main_loop):
+        if not os.path.exists(self.path_to_folder):
+            os.mkdir(self.path_to_folder)
+        start = time.time()
+        self.checkpoint_writer.save_parameter_values(main_loop.model.get_parameter_values(),
+                                                     self.path_to_parameters)
+        self.checkpoint_writer.save_bytes(self._serialize(main_loop.iteration_state), self.path_to_iteration_state)
+        self.checkpoint_writer.save_bytes(cPickle.dumps(main_loop.log, protocol=cPickle.HIGHEST_PROTOCOL),
+                                          self.path_to_log)
+        logger.info("Model snapshot taken in {} seconds, writing it in the background".format(time.time() - start))
+
+    def do(self, callback_name, *args):
+        try:
+            self.dump(self.main_loop)
+            if callback_name == 'after_training':
+                self.checkpoint_writer.wait()
+        finally:
+            already_saved_to = self.main_loop.log.current_row.get(SAVED_TO, ())
+            self.main_loop.log.current_row[SAVED_TO] = (already_saved_to + (self.path_to_parameters,))
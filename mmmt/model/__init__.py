@@ -1,6 +1,8 @@
 
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
 
+import theano
 from theano import tensor
 from six import add_metaclass
 
@@ -114,6 +116,10 @@ class GRUInitialStateWithInitialStateSumContext(GatedRecurrent):
 
         self.children.extend([self.initial_transformer, self.context_transformer])
 
+        # at inference time, the output of the context transformer can be computed (and cached) outside of the
+        # search graph -- if this is set, initial_state_context is that output instead of the context features
+        self.precomputed_context_projection = False
+
     # THINKING: how to best combine the image info with the source info?
     @application
     def initial_states(self, batch_size, *args, **kwargs):
@@ -121,7 +127,10 @@ class GRUInitialStateWithInitialStateSumContext(GatedRecurrent):
         context = kwargs['initial_state_context']
         attended_reverse_final_state = attended[0, :, -self.attended_dim:]
         initial_state_representation = self.initial_transformer.apply(attended_reverse_final_state)
-        initial_context_representation = self.context_transformer.apply(context)
+        if self.precomputed_context_projection:
+            initial_context_representation = context
+        else:
+            initial_context_representation = self.context_transformer.apply(context)
         initial_state = initial_state_representation + initial_context_representation
         return initial_state
 
@@ -482,14 +491,145 @@ class InitialContextDecoder(Initializable):
                                                      target_samples, target_samples_mask, scores, **kwargs)
 
 
+    # Note: pass source_sentence_mask to search or sample several padded sentences at once
     @application
-    def generate(self, source_sentence, representation, initial_state_context, **kwargs):
+    def generate(self, source_sentence, representation, initial_state_context, source_sentence_mask=None,
+                 **kwargs):
+        if source_sentence_mask is None:
+            source_sentence_mask = tensor.ones(source_sentence.shape)
         return self.sequence_generator.generate(
             n_steps=2 * source_sentence.shape[1],
             batch_size=source_sentence.shape[0],
             attended=representation,
-            attended_mask=tensor.ones(source_sentence.shape).T,
+            attended_mask=source_sentence_mask.T,
             initial_state_context=initial_state_context,
             **kwargs)
 
 
+
+class StepwiseDecoder(object):
+    """Compiled functions which run an `InitialContextDecoder` one step at a time, with explicit states
+
+    This exposes the pieces of `generate` to search procedures which drive the decoding themselves (e.g. greedy,
+    beam or dynamically batched search). The encoder and the preprocessing of the attended sequence are computed
+    once by `initial_states`. Each decoding step then only runs the attention, the readout and the recurrent
+    transition. Every state is a plain numpy array, so searchers can reorder, repeat or concatenate the rows of
+    different sentences.
+
+    All the arrays have the batch on their first axis, except for the contexts `attended`, `preprocessed_attended` and
+    `attended_mask`, whose axes are (time, batch, ...). Rows of the same sentence share the same contexts.
+
+    Parameters
+    ----------
+    encoder: the encoder brick, e.g. `machine_translation.model.BidirectionalEncoder`
+    decoder: InitialContextDecoder : with its parameters allocated and loaded. If its transition has
+      `precomputed_context_projection` set, the context input of `initial_states` is the projected context.
+
+    """
+
+    context_names = ('attended', 'preprocessed_attended', 'attended_mask')
+
+    def __init__(self, encoder, decoder):
+        self.generator = decoder.sequence_generator
+        self.transition = self.generator.transition
+        self.readout = self.generator.readout
+        self.state_names = list(self.generator.generate.states)
+        self.glimpse_names = list(self.transition.take_glimpses.outputs)
+        self._compile_initial_states(encoder)
+        self._compile_step()
+
+    def _compile_initial_states(self, encoder):
+        source = tensor.lmatrix('source')
+        source_mask = tensor.matrix('source_mask')
+        initial_state_context = tensor.matrix('context_input')
+
+        attended = encoder.apply(source, source_mask)
+        attended_mask = source_mask.T
+        initial_states = self.generator.initial_states(
+            source.shape[0], attended=attended, attended_mask=attended_mask,
+            initial_state_context=initial_state_context)
+        preprocessed_attended = self.transition.attention.preprocess(attended)
+
+        # symbolic inputs of the step functions, with the types of the values they are fed
+        self.context_vars = OrderedDict([('attended', attended.type('attended')),
+                                         ('preprocessed_attended', preprocessed_attended.type('preprocessed_attended')),
+                                         ('attended_mask', attended_mask.type('attended_mask'))])
+        self.state_vars = OrderedDict((name, state.type(name))
+                                      for name, state in equizip(self.state_names, initial_states))
+
+        self.initial_states_computer = theano.function(
+            [source, source_mask, initial_state_context],
+            [attended, preprocessed_attended, attended_mask] + list(initial_states),
+            name='initial_states', on_unused_input='ignore')
+
+    def _compile_step(self):
+        contexts = self.context_vars
+        states = dict_subset(self.state_vars, self.generator._state_names)
+        glimpses = dict_subset(self.state_vars, self.glimpse_names)
+        outputs = self.state_vars['outputs']
+        # the contexts of the recurrent transition itself, without the preprocessed sequence
+        transition_contexts = dict_subset(contexts, ['attended', 'attended_mask'])
+
+        # the same computations as one iteration of BaseSequenceGenerator.generate, except that the preprocessed
+        # attended sequence is an input instead of being recomputed
+        next_glimpses = self.transition.take_glimpses(
+            as_dict=True, **dict_union(states, glimpses, contexts))
+        readouts = self.readout.readout(
+            feedback=self.readout.feedback(outputs),
+            **dict_union(states, next_glimpses, transition_contexts))
+        logprobs = -tensor.log(self.readout.emitter.probs(readouts))
+        self.logprobs_computer = theano.function(
+            list(contexts.values()) + list(self.state_vars.values()),
+            [logprobs] + [next_glimpses[name] for name in self.glimpse_names],
+            name='logprobs', on_unused_input='ignore')
+
+        glimpse_vars = OrderedDict((name, var.type(name)) for name, var in glimpses.items())
+        next_outputs = tensor.lvector('next_outputs')
+        next_inputs = self.generator.fork.apply(self.readout.feedback(next_outputs), as_dict=True)
+        next_states = self.transition.compute_states(
+            as_dict=True, **dict_union(next_inputs, states, glimpse_vars, transition_contexts))
+        self.next_states_computer = theano.function(
+            list(contexts.values()) + list(states.values()) + list(glimpse_vars.values()) + [next_outputs],
+            [next_states[name] for name in self.generator._state_names],
+            name='next_states', on_unused_input='ignore')
+
+    def initial_states(self, source, source_mask, initial_state_context):
+        """Encode a batch of padded sources
+
+        Parameters
+        ----------
+        source: int64 array (batch, time) : the source indices
+        source_mask: floatX array (batch, time) : 1. for tokens, 0. for padding
+        initial_state_context: floatX array (batch, context_dim) : the context features (or their projections)
+
+        Returns
+        -------
+        contexts: OrderedDict : `attended`, `preprocessed_attended` and `attended_mask`
+        states: OrderedDict : the decoder states before the first step: the GRU `states`, the previous `outputs` and
+          the glimpses (`weighted_averages` and `weights`)
+
+        """
+        values = self.initial_states_computer(source, source_mask, initial_state_context)
+        contexts = OrderedDict(equizip(self.context_names, values[:len(self.context_names)]))
+        states = OrderedDict(equizip(self.state_names, values[len(self.context_names):]))
+        return contexts, states
+
+    def logprobs(self, contexts, states):
+        """Get the negative log-probabilities of the next output, and the glimpses of this step
+
+        The glimpses must be passed to `next_states` together with the chosen outputs.
+
+        """
+        values = self.logprobs_computer(*([contexts[name] for name in self.context_names] +
+                                          [states[name] for name in self.state_names]))
+        return values[0], OrderedDict(equizip(self.glimpse_names, values[1:]))
+
+    def next_states(self, contexts, states, glimpses, outputs):
+        """Feed the chosen `outputs` (int64 array, one per row) back and get the states of the next step"""
+        values = self.next_states_computer(*([contexts[name] for name in self.context_names] +
+                                             [states[name] for name in self.generator._state_names] +
+                                             [glimpses[name] for name in self.glimpse_names] + [outputs]))
+        next_states = OrderedDict(equizip(self.generator._state_names, values))
+        next_states['outputs'] = outputs
+        next_states.update(glimpses)
+        return OrderedDict((name, next_states[name]) for name in self.state_names)
@@ -6,22 +6,24 @@ Functions and classes for sampling from MMMT models
 from __future__ import print_function
 
 import logging
+import multiprocessing
 import numpy
 import operator
 import os
-import re
-import signal
 import time
 import theano
-import subprocess
 import codecs
-import tempfile
+import traceback
 
 from blocks.extensions import SimpleExtension
+from six.moves import queue
 from blocks.search import BeamSearch
-from machine_translation.checkpoint import SaveLoadUtils
 
-from subprocess import Popen, PIPE
+from mmmt.extensions import AsyncCheckpointWriter
+from mmmt.evaluation import CorpusBleu, MeteorScorer, read_segments
+from mmmt.stream import CachedDevSet
+from mmmt.vocab import Vocabulary
+
 
 logger = logging.getLogger(__name__)
 
@@ -30,41 +32,209 @@ logger = logging.getLogger(__name__)
 theano.config.on_unused_input = 'warn'
 
 
+class SampleFunc:
+    """Draws samples from the sampling graph of a model, for min-risk training
 
-import numpy
+    Parameters
+    ----------
+    sample_func: the compiled sampling graph, e.g. from `Model.get_theano_function`
+    vocab: the target vocabulary, samples are cut after its </S>
+    input_names: list[str] : the names of the graph inputs in the order the function takes them (the names of
+      `model.inputs`). Inputs are matched by name: `source`, `source_mask` and `context`. If the graph has no mask
+      input, sources of different lengths are sampled one at a time.
 
-class SampleFunc:
+    """
 
-    def __init__(self, sample_func, vocab):
+    def __init__(self, sample_func, vocab, input_names=('source', 'context')):
         self.sample_func = sample_func
         self.vocab = vocab
+        self.input_names = list(input_names)
 
-    # TODO: we may be able to make this function faster by passing multiple sources for sampling at the same damn time
-    # TODO: or by avoiding the for loop somehow
     def __call__(self, source_seq, initial_context, num_samples=1):
+        return self.sample_batch([source_seq], numpy.asarray(initial_context)[None, :], num_samples=num_samples)[0]
+
+    def sample_batch(self, source_seqs, initial_contexts, num_samples=1):
+        """Draw `num_samples` samples for each of a block of sources with a single call of the sampling function
 
-        source_inputs = numpy.tile(source_seq[None, :], (num_samples, 1))
-        context_inputs = numpy.tile(initial_context[None, :], (num_samples, 1))
+        Returns a list with the samples of each source, the samples of a source are lists of target indices which
+        end with </S> (unless it was never generated).
+
+        """
+        lengths = [len(seq) for seq in source_seqs]
+        if 'source_mask' not in self.input_names and len(set(lengths)) > 1:
+            return [self(seq, context, num_samples) for seq, context in zip(source_seqs, initial_contexts)]
+
+        # padding positions are masked out, so their value doesn't matter
+        source_inputs = numpy.zeros((len(source_seqs), max(lengths)), dtype='int64')
+        source_mask = numpy.zeros(source_inputs.shape, dtype=theano.config.floatX)
+        for i, seq in enumerate(source_seqs):
+            source_inputs[i, :lengths[i]] = seq
+            source_mask[i, :lengths[i]] = 1.
+
+        # the samples of each source are contiguous in the batch
+        sampling_inputs = {'source': numpy.repeat(source_inputs, num_samples, axis=0),
+                           'source_mask': numpy.repeat(source_mask, num_samples, axis=0),
+                           'context': numpy.repeat(numpy.asarray(initial_contexts, dtype=theano.config.floatX),
+                                                   num_samples, axis=0)}
 
         # the output is [seq_len, batch]
-        # TODO: make sure the order of arguments is correct, because we used model.get_theano_function
-        _1, outputs, _2, _3, costs = self.sample_func(source_inputs, context_inputs)
+        _1, outputs, _2, _3, costs = self.sample_func(*[sampling_inputs[name] for name in self.input_names])
         outputs = outputs.T
 
-        # TODO: this step could be avoided by computing the samples mask in a different way
         lens = self._get_true_length(outputs)
-        samples = [s[:l] for s,l in zip(outputs.tolist(), lens)]
-
-        return samples
+        samples = [s[:l] for s, l in zip(outputs.tolist(), lens)]
+        return [samples[i:i + num_samples] for i in range(0, len(samples), num_samples)]
 
     def _get_true_length(self, seqs):
-        try:
-            lens = []
-            for r in seqs.tolist():
-                lens.append(r.index(self.vocab['</S>']) + 1)
-            return lens
-        except ValueError:
-            return [seqs.shape[1] for _ in range(seqs.shape[0])]
+        # the length up to and including the first </S> of each row, or the full length if there is none
+        is_eos = seqs == self.vocab['</S>']
+        return numpy.where(is_eos.any(axis=1), is_eos.argmax(axis=1) + 1, seqs.shape[1])
+
+
+class BatchedBeamSearch(BeamSearch):
+    """Beam search over several source sentences at once
+
+    Each sentence gets `beam_size` consecutive rows of the search batch, and its hypotheses are only pruned against
+    each other. Sentences are padded to the longest one in the batch, so the sampling graph must take a source mask
+    which hides the padding from the encoder and the attention (see `InitialContextDecoder.generate`). A sentence
+    stops growing once all of its hypotheses have produced the EOS symbol or it has reached its own max length.
+
+    Parameters
+    ----------
+    samples: theano variable : the `outputs` of the sampling graph, as for blocks' BeamSearch
+    source_sentence: theano variable : the source input of the sampling graph
+    initial_context: theano variable : the context features input of the sampling graph
+    source_sentence_mask: theano variable : the source mask input of the sampling graph -- if the graph has no mask,
+      pass None and search one sentence at a time
+    beam_size: int : the number of hypotheses kept for each sentence
+
+    """
+
+    # the contexts with axes (time, batch, ...), all other contexts and states have the batch on the first axis
+    time_major_contexts = ('attended', 'attended_mask')
+
+    def __init__(self, samples, source_sentence, initial_context, source_sentence_mask=None, beam_size=10):
+        super(BatchedBeamSearch, self).__init__(samples=samples)
+        self.source_sentence = source_sentence
+        self.initial_context = initial_context
+        self.source_sentence_mask = source_sentence_mask
+        self.beam_size = beam_size
+
+    def search_batch(self, sources, context_features, eol_symbol, max_lengths=None, ignore_first_eol=False):
+        """Find the `beam_size` best hypotheses for each source sentence
+
+        Parameters
+        ----------
+        sources: list of int arrays : the source sentences, already mapped to indices
+        context_features: 2d array : the context features of each sentence
+        eol_symbol: int : the index of the EOS token
+        max_lengths: list of int : the maximum hypothesis length for each sentence (default: 3 * source length)
+        ignore_first_eol: bool : don't let hypotheses end at the first step
+
+        Returns
+        -------
+        a (hypotheses, costs) tuple for each sentence in `sources`, in the same order, where `hypotheses` is a list of
+        `beam_size` lists of indices and `costs` holds their costs, like the output of BeamSearch.search
+
+        """
+        if not self.compiled:
+            self.compile()
+
+        num_sentences = len(sources)
+        beam_size = self.beam_size
+        assert num_sentences == 1 or self.source_sentence_mask is not None, \
+            'Searching more than one sentence at once needs a sampling graph with a source mask'
+
+        source_lengths = numpy.array([len(seq) for seq in sources])
+        if max_lengths is None:
+            max_lengths = 3 * source_lengths
+        max_lengths = numpy.asarray(max_lengths)
+        row_max_lengths = numpy.repeat(max_lengths, beam_size)
+
+        source_input = numpy.zeros((num_sentences, source_lengths.max()), dtype='int64')
+        source_mask = numpy.zeros(source_input.shape, dtype=theano.config.floatX)
+        for i, seq in enumerate(sources):
+            source_input[i, :len(seq)] = seq
+            source_mask[i, :len(seq)] = 1.
+        input_values = {
+            self.source_sentence: source_input,
+            self.initial_context: numpy.asarray(context_features, dtype=theano.config.floatX)}
+        if self.source_sentence_mask is not None:
+            input_values[self.source_sentence_mask] = source_mask
+
+        # the encoder and the initial states are computed once per sentence, then each sentence gets beam_size rows
+        contexts, states, _ = self.compute_initial_states_and_contexts(input_values)
+        for name in contexts:
+            contexts[name] = numpy.repeat(contexts[name], beam_size,
+                                          axis=1 if name in self.time_major_contexts else 0)
+        for name in states:
+            states[name] = numpy.repeat(states[name], beam_size, axis=0)
+
+        # These arrays store all generated outputs, including those of finished hypotheses, as in BeamSearch.search
+        all_outputs = states['outputs'][None, :]
+        all_masks = numpy.ones_like(all_outputs, dtype=theano.config.floatX)
+        all_costs = numpy.zeros_like(all_outputs, dtype=theano.config.floatX)
+
+        # the first row of each sentence in the search batch
+        sentence_offsets = numpy.arange(num_sentences)[:, None] * beam_size
+        sentence_range = numpy.arange(num_sentences)[:, None]
+
+        for i in range(max_lengths.max()):
+            active = (all_masks[-1].reshape(num_sentences, beam_size).sum(axis=1) > 0) & (i < max_lengths)
+            if not active.any():
+                break
+            done_rows = numpy.repeat(~active, beam_size)
+
+            # finished hypotheses can only be continued with the EOS symbol, at no cost
+            logprobs = self.compute_logprobs(contexts, states)
+            next_costs = (all_costs[-1, :, None] + logprobs * all_masks[-1, :, None])
+            (finished,) = numpy.where(all_masks[-1] == 0)
+            next_costs[finished, :eol_symbol] = numpy.inf
+            next_costs[finished, eol_symbol + 1:] = numpy.inf
+
+            # choose the beam_size best continuations within each sentence
+            vocab_size = next_costs.shape[1]
+            next_costs = next_costs.reshape(num_sentences, beam_size * vocab_size)
+            if i == 0:
+                # at the first step all hypotheses of a sentence are the same
+                next_costs = next_costs[:, :vocab_size]
+            best = numpy.argpartition(next_costs, beam_size - 1, axis=1)[:, :beam_size]
+            chosen_costs = next_costs[sentence_range, best].flatten()
+            indexes = (sentence_offsets + best // vocab_size).flatten()
+            outputs = (best % vocab_size).flatten()
+
+            # sentences which are done keep their hypotheses as they are
+            indexes[done_rows] = numpy.flatnonzero(done_rows)
+            outputs[done_rows] = eol_symbol
+            chosen_costs[done_rows] = all_costs[-1, done_rows]
+
+            # Rearrange everything
+            for name in states:
+                states[name] = states[name][indexes]
+            all_outputs = all_outputs[:, indexes]
+            all_masks = all_masks[:, indexes]
+            all_costs = all_costs[:, indexes]
+
+            # Record chosen output and compute new states
+            states.update(self.compute_next_states(contexts, states, outputs))
+            all_outputs = numpy.vstack([all_outputs, outputs[None, :]])
+            all_costs = numpy.vstack([all_costs, chosen_costs[None, :]])
+            mask = outputs != eol_symbol
+            if ignore_first_eol and i == 0:
+                mask[:] = 1
+            mask[done_rows] = 0
+            all_masks = numpy.vstack([all_masks, mask[None, :]])
+
+        all_outputs = all_outputs[1:].T
+        all_costs = (all_costs[1:] - all_costs[:-1]).sum(axis=0)
+        # hypotheses of sentences which hit their max length are cut there, like in BeamSearch.search
+        lengths = numpy.minimum(all_masks[:-1].sum(axis=0).astype('int64'), row_max_lengths)
+
+        results = []
+        for sentence_rows in numpy.arange(num_sentences * beam_size).reshape(num_sentences, beam_size):
+            results.append(([list(all_outputs[row, :lengths[row]]) for row in sentence_rows],
+                            all_costs[sentence_rows]))
+        return results
 
 
 class SamplingBase(object):
@@ -82,9 +252,6 @@ class SamplingBase(object):
     def _oov_to_unk(self, seq, vocab_size, unk_idx):
         return [x if x < vocab_size else unk_idx for x in seq]
 
-    def _idx_to_word(self, seq, ivocab):
-        return " ".join([ivocab.get(idx, "<UNK>") for idx in seq])
-
     def _initialize_dataset_info(self):
         # Get dictionaries, this may not be the practical way
         sources = self._get_attr_rec(self.main_loop, 'data_stream')
@@ -96,36 +263,92 @@ class SamplingBase(object):
         #             self.source_dataset = sources.data_streams[0].dataset
         #         if not hasattr(self, 'target_dataset'):
         #             self.target_dataset = sources.data_streams[1].dataset
-        if not hasattr(self, 'src_vocab'):
+        if not getattr(self, 'src_vocab', None):
             self.src_vocab = self.source_dataset.dictionary
-        if not hasattr(self, 'trg_vocab'):
+        if not getattr(self, 'trg_vocab', None):
             self.trg_vocab = self.target_dataset.dictionary
-        if not hasattr(self, 'src_ivocab'):
-            self.src_ivocab = {v: k for k, v in self.src_vocab.items()}
-        if not hasattr(self, 'trg_ivocab'):
-            self.trg_ivocab = {v: k for k, v in self.trg_vocab.items()}
+        # the vocabularies hold their own inverse indices
+        self.src_vocab = Vocabulary.load(self.src_vocab, self.config['src_vocab_size'],
+                                         unk_idx=self.config['unk_id'])
+        self.trg_vocab = Vocabulary.load(self.trg_vocab, self.config['trg_vocab_size'],
+                                         unk_idx=self.config['unk_id'])
         if not hasattr(self, 'src_vocab_size'):
             self.src_vocab_size = len(self.src_vocab)
 
+    def _get_dev_set(self):
+        # the dev set is read from self.data_stream on the first validation only
+        if getattr(self, 'dev_set', None) is None:
+            logger.info("Caching the validation set")
+            self.dev_set = CachedDevSet(self.data_stream, src_vocab_size=self.config['src_vocab_size'],
+                                        unk_idx=self.unk_idx)
+        return self.dev_set
+
+    def _translate_dev_set(self):
+        """Beam search over the dev set
+
+        Returns the best translation of each dev segment in the original order (as strings and as index lists), and
+        the total cost of the n-best hypotheses. Segments are decoded from shortest to longest, `search_batch_size`
+        sentences at a time.
+
+        """
+        dev_set = self._get_dev_set()
+        batch_size = self.config.get('search_batch_size', 1) if self.beam_search.source_sentence_mask is not None \
+            else 1
+
+        translations = ['<UNK>'] * len(dev_set)
+        hypotheses = [[self.unk_idx]] * len(dev_set)
+        total_cost = 0.0
+        for start in range(0, len(dev_set), batch_size):
+            batch_idxs = dev_set.order[start:start + batch_size]
+            results = self.beam_search.search_batch(
+                [dev_set.sources[i] for i in batch_idxs], dev_set.contexts[batch_idxs],
+                eol_symbol=self.eos_idx, ignore_first_eol=True)
+
+            for i, (trans, costs) in zip(batch_idxs, results):
+                # normalize costs according to the sequence lengths
+                if self.normalize:
+                    lengths = numpy.array([len(s) for s in trans])
+                    costs = costs / lengths
+
+                nbest_idx = numpy.argsort(costs)[:self.n_best]
+                total_cost += costs[nbest_idx].sum()
+                # convert idx to words
+                hypotheses[i] = trans[nbest_idx[0]]
+                translations[i] = self.trg_vocab.decode(hypotheses[i])
+
+            if start // 100 != (start + len(batch_idxs)) // 100:
+                logger.info(
+                    "Translated {} lines of validation set...".format(start + len(batch_idxs)))
+
+        return translations, hypotheses, total_cost
+
 
 class Sampler(SimpleExtension, SamplingBase):
     """Random Sampling from model."""
 
     def __init__(self, model, data_stream, hook_samples=1,
-                 src_vocab=None, trg_vocab=None, src_ivocab=None,
-                 trg_ivocab=None, src_vocab_size=None, **kwargs):
+                 src_vocab=None, trg_vocab=None, src_vocab_size=None, trg_vocab_size=None, unk_idx=1, **kwargs):
         super(Sampler, self).__init__(**kwargs)
         self.model = model
         self.hook_samples = hook_samples
         self.data_stream = data_stream
         self.src_vocab = src_vocab
         self.trg_vocab = trg_vocab
-        self.src_ivocab = src_ivocab
-        self.trg_ivocab = trg_ivocab
         self.src_vocab_size = src_vocab_size
+        self.trg_vocab_size = trg_vocab_size
+        self.unk_idx = unk_idx
         self.is_synced = False
 
         self.sampling_fn = model.get_theano_function()
+        # the sampling function takes the graph inputs in the order of model.inputs
+        self.sampling_input_names = [var.name for var in model.inputs]
+
+    def _load_vocab(self, vocab, vocab_size):
+        if vocab_size is None and isinstance(vocab, dict):
+            # without the configured size, the special tokens can't be placed again, the dictionaries of the data
+            # stream already have them in place
+            return Vocabulary(vocab, max(vocab.values()) + 1, unk_idx=self.unk_idx)
+        return Vocabulary.load(vocab, vocab_size, unk_idx=self.unk_idx)
 
     def do(self, which_callback, *args):
         # Get dictionaries, this may not be the practical way
@@ -134,14 +357,12 @@ class Sampler(SimpleExtension, SamplingBase):
         # Load vocabularies and invert if necessary
         # WARNING: Source and target indices from data stream
         #  can be different
-        if not self.src_vocab:
-            self.src_vocab = sources.data_streams[0].dataset.dictionary
-        if not self.trg_vocab:
-            self.trg_vocab = sources.data_streams[1].dataset.dictionary
-        if not self.src_ivocab:
-            self.src_ivocab = {v: k for k, v in self.src_vocab.items()}
-        if not self.trg_ivocab:
-            self.trg_ivocab = {v: k for k, v in self.trg_vocab.items()}
+        if not isinstance(self.src_vocab, Vocabulary):
+            self.src_vocab = self._load_vocab(self.src_vocab or sources.data_streams[0].dataset.dictionary,
+                                              self.src_vocab_size)
+        if not isinstance(self.trg_vocab, Vocabulary):
+            self.trg_vocab = self._load_vocab(self.trg_vocab or sources.data_streams[1].dataset.dictionary,
+                                              self.trg_vocab_size)
         if not self.src_vocab_size:
             self.src_vocab_size = len(self.src_vocab)
 
@@ -174,217 +395,175 @@ class Sampler(SimpleExtension, SamplingBase):
             context = context_[i]
 
             # outputs of self.sampling_fn:
-            _1, outputs, _2, _3, costs = (self.sampling_fn(inp[None, :], context[None, :]))
+            sampling_inputs = {'input': inp[None, :],
+                               'input_mask': numpy.ones((1, len(inp)), dtype=theano.config.floatX),
+                               'context_input': context[None, :]}
+            _1, outputs, _2, _3, costs = (self.sampling_fn(
+                *[sampling_inputs[name] for name in self.sampling_input_names]))
             outputs = outputs.flatten()
             costs = costs.T
 
             sample_length = self._get_true_length(outputs, self.trg_vocab)
 
-            print("Input : ", self._idx_to_word(input_[i][:input_length],
-                                                self.src_ivocab))
-            print("Target: ", self._idx_to_word(target_[i][:target_length],
-                                                self.trg_ivocab))
-            print("Sample: ", self._idx_to_word(outputs[:sample_length],
-                                                self.trg_ivocab))
+            print("Input : ", self.src_vocab.decode(input_[i][:input_length]))
+            print("Target: ", self.trg_vocab.decode(target_[i][:target_length]))
+            print("Sample: ", self.trg_vocab.decode(outputs[:sample_length]))
             print("Sample cost: ", costs[:sample_length].sum())
             print()
 
 
-class BleuValidator(SimpleExtension, SamplingBase):
-    """Implements early stopping based on BLEU score."""
+class ValidationMetric(object):
+    """A score on the dev set translations, which keeps track of the best models according to that score
 
-    def __init__(self, source_sentence, initial_state_context, samples, model, data_stream,
-                 config, src_vocab=None, trg_vocab=None, n_best=1, track_n_models=1,
-                 normalize=True, **kwargs):
-        super(BleuValidator, self).__init__(**kwargs)
-        self.source_sentence = source_sentence
-        self.initial_context = initial_state_context
+    Subclasses set `key` and implement `score`. The scores of all validations are stored in
+    `<saveto>/val_<key>_scores.npz`, and the `track_n_models` best models are kept in `saveto`.
 
-        self.src_vocab = src_vocab
-        self.trg_vocab = trg_vocab
+    Parameters
+    ----------
+    config: dict : the experiment config
+    track_n_models: int : how many of the best models to keep
+    checkpoint_writer: mmmt.extensions.AsyncCheckpointWriter : writes the models, a new one is started by default
 
-        self.samples = samples
-        self.model = model
-        self.data_stream = data_stream
+    """
+
+    key = 'SCORE'
+
+    def __init__(self, config, track_n_models=1, checkpoint_writer=None):
         self.config = config
-        self.n_best = n_best
         self.track_n_models = track_n_models
-        self.normalize = normalize
-        self.verbose = config.get('val_set_out', None)
+        self.checkpoint_writer = checkpoint_writer or AsyncCheckpointWriter()
+        self.name = self.key.lower()
 
-        # Helpers
         self.best_models = []
-        self.val_bleu_curve = []
-        self.beam_search = BeamSearch(samples=samples)
-        self.multibleu_cmd = ['perl', self.config['bleu_script'],
-                              self.config['val_set_grndtruth'], '<']
-
-        # Create save directory if it does not exist
-        if not os.path.exists(self.config['saveto']):
-            os.makedirs(self.config['saveto'])
+        self.val_curve = []
+        self.scores_file = os.path.join(self.config['saveto'], 'val_{}_scores.npz'.format(self.name))
 
         if self.config['reload']:
             try:
-                bleu_score = numpy.load(os.path.join(self.config['saveto'],
-                                                     'val_bleu_scores.npz'))
-                self.val_bleu_curve = bleu_score['bleu_scores'].tolist()
+                scores = numpy.load(self.scores_file)
+                self.val_curve = scores['{}_scores'.format(self.name)].tolist()
 
-                # Track n best previous bleu scores
-                for i, bleu in enumerate(
-                        sorted(self.val_bleu_curve, reverse=True)):
+                # Track n best previous scores
+                for i, score in enumerate(
+                        sorted(self.val_curve, reverse=True)):
                     if i < self.track_n_models:
-                        self.best_models.append(ModelInfo(bleu, key='BLEU'))
-                logger.info("BleuScores Reloaded")
+                        self.best_models.append(ModelInfo(score, key=self.key))
+                logger.info("{} scores Reloaded".format(self.key))
             except:
-                logger.info("BleuScores not Found")
+                logger.info("{} scores not Found".format(self.key))
 
-    def do(self, which_callback, *args):
+    def score(self, translations, hypotheses):
+        """Score the dev set translations against the dev references
 
-        # Track validation burn in
-        if self.main_loop.status['iterations_done'] <= self.config['val_burn_in']:
-            return
+        Parameters
+        ----------
+        translations: list[str] : the translation of each dev segment
+        hypotheses: list[list[int]] : the same translations as target indices
 
-        # Evaluate the model
-        bleu_score = self._evaluate_model()
-        # add an entry to the log
-        self.main_loop.log.current_row['validation_set_bleu_score'] = bleu_score
-        # save if necessary
-        self._save_model(bleu_score)
+        """
+        raise NotImplementedError()
 
-    def _evaluate_model(self):
-        # Set in the superclass -- SamplingBase
-        if not hasattr(self, 'target_dataset'):
-            self._initialize_dataset_info()
+    def _is_valid_to_save(self, score):
+        if not self.best_models or min(self.best_models,
+                                       key=operator.attrgetter('score')).score < score:
+            return True
+        return False
 
-        #         self.unk_sym = self.target_dataset.unk_token
-        #         self.eos_sym = self.target_dataset.eos_token
+    def update(self, score, model):
+        """Record a validation score, and save the parameters of `model` if it is among the best so far
 
-        self.unk_sym = '<UNK>'
-        self.eos_sym = '</S>'
-        self.unk_idx = self.trg_vocab[self.unk_sym]
-        self.eos_idx = self.trg_vocab[self.eos_sym]
+        The files are written in the background, an old best model is only deleted once the new one is on disk.
 
-        logger.info("Started Validation: ")
-        val_start_time = time.time()
-        mb_subprocess = Popen(self.multibleu_cmd, stdin=PIPE, stdout=PIPE)
-        total_cost = 0.0
+        """
+        self.val_curve.append(score)
+        if self._is_valid_to_save(score):
+            model_info = ModelInfo(score, self.config['saveto'], key=self.key)
+            logger.info("Saving new model {}".format(model_info.path))
+            self.checkpoint_writer.save_parameter_values(model.get_parameter_values(), model_info.path)
 
-        if self.verbose:
-            ftrans = open(self.config['val_set_out'], 'w')
-
-        for i, line in enumerate(self.data_stream.get_epoch_iterator()):
-            """
-            Load the sentence, retrieve the sample, write to file
-            """
-
-            seq = self._oov_to_unk(
-                line[0], self.config['src_vocab_size'], self.unk_idx)
-            initial_state_context = line[-1]
-
-            input_ = numpy.tile(seq, (self.config['beam_size'], 1))
-            context_input_ = numpy.tile(initial_state_context, (self.config['beam_size'], 1))
-
-            # draw sample, checking to ensure we don't get an empty string back
-            # beam search param names come from WHERE??
-            trans, costs = self.beam_search.search(
-                input_values={self.source_sentence: input_,
-                              self.initial_context: context_input_},
-                max_length=3*len(seq), eol_symbol=self.eos_idx,
-                ignore_first_eol=True)
-
-            # normalize costs according to the sequence lengths
-            if self.normalize:
-                lengths = numpy.array([len(s) for s in trans])
-                costs = costs / lengths
-
-            nbest_idx = numpy.argsort(costs)[:self.n_best]
-            for j, best in enumerate(nbest_idx):
-                try:
-                    total_cost += costs[best]
-                    trans_out = trans[best]
-
-                    # convert idx to words
-                    trans_out = self._idx_to_word(trans_out, self.trg_ivocab)
-
-                except ValueError:
-                    logger.info(
-                        "Can NOT find a translation for line: {}".format(i+1))
-                    trans_out = '<UNK>'
-
-                if j == 0:
-                    # Write to subprocess and file if it exists
-                    print(trans_out, file=mb_subprocess.stdin)
-                    if self.verbose:
-                        print(trans_out, file=ftrans)
-
-                if i != 0 and i % 100 == 0:
-                    logger.info(
-                        "Translated {} lines of validation set...".format(i))
-
-                mb_subprocess.stdin.flush()
+            # Manage n-best model list
+            if len(self.best_models) >= self.track_n_models:
+                old_model = self.best_models[0]
+                if old_model.path and old_model.path != model_info.path:
+                    self.checkpoint_writer.remove(old_model.path)
+                self.best_models.remove(old_model)
 
-        logger.info("Total cost of the validation: {}".format(total_cost))
-        self.data_stream.reset()
-        if self.verbose:
-            ftrans.close()
-
-        # send end of file, read output.
-        mb_subprocess.stdin.close()
-        stdout = mb_subprocess.stdout.readline()
-        logger.info(stdout)
-        out_parse = re.match(r'BLEU = [-.0-9]+', stdout)
-        logger.info("Validation Took: {} minutes".format(
-            float(time.time() - val_start_time) / 60.))
-        assert out_parse is not None
+            self.best_models.append(model_info)
+            self.best_models.sort(key=operator.attrgetter('score'))
+
+            self.checkpoint_writer.save_arrays({'{}_scores'.format(self.name): numpy.array(self.val_curve)},
+                                               self.scores_file)
+
+
+class BleuMetric(ValidationMetric):
+    """BLEU against `val_set_grndtruth`, computed in-process with the same result as moses multi-bleu.perl
+
+    The reference n-grams are counted on the first validation only. If `trg_vocab` is given, the hypotheses are
+    scored as target indices, otherwise their text is scored.
 
-        # extract the score
-        bleu_score = float(out_parse.group()[6:])
-        self.val_bleu_curve.append(bleu_score)
+    """
+
+    key = 'BLEU'
+
+    def __init__(self, config, track_n_models=1, trg_vocab=None):
+        super(BleuMetric, self).__init__(config, track_n_models=track_n_models)
+        self.trg_vocab = trg_vocab
+        self.corpus_bleu = None
+
+    def score(self, translations, hypotheses):
+        if self.corpus_bleu is None:
+            self.corpus_bleu = CorpusBleu.from_files([self.config['val_set_grndtruth']], vocab=self.trg_vocab)
+
+        if self.trg_vocab is None:
+            hypotheses = [trans_out.decode('utf8') for trans_out in translations]
+        logger.info(self.corpus_bleu.report(hypotheses))
+
+        bleu_score = self.corpus_bleu.score(hypotheses)
         logger.info(bleu_score)
-        mb_subprocess.terminate()
 
         return bleu_score
 
-    def _is_valid_to_save(self, bleu_score):
-        if not self.best_models or min(self.best_models,
-                                       key=operator.attrgetter('score')).score < bleu_score:
-            return True
-        return False
 
-    def _save_model(self, bleu_score):
-        if self._is_valid_to_save(bleu_score):
-            model = ModelInfo(bleu_score, self.config['saveto'], key='BLEU')
+class MeteorMetric(ValidationMetric):
+    """METEOR against `val_set_grndtruth`, computed by a persistent METEOR process
 
-            # Manage n-best model list first
-            if len(self.best_models) >= self.track_n_models:
-                old_model = self.best_models[0]
-                if old_model.path and os.path.isfile(old_model.path):
-                    logger.info("Deleting old model %s" % old_model.path)
-                    os.remove(old_model.path)
-                self.best_models.remove(old_model)
+    The process is started on the first validation and reused afterwards. It runs the meteor-1.5 jar in
+    `meteor_directory`, unless `meteor_command` is set in the config (e.g. to `python -m mmmt.evaluation.fake_meteor`).
 
-            self.best_models.append(model)
-            self.best_models.sort(key=operator.attrgetter('score'))
+    """
 
-            # Save the model here
-            s = signal.signal(signal.SIGINT, signal.SIG_IGN)
-            logger.info("Saving new model {}".format(model.path))
+    key = 'METEOR'
 
-            SaveLoadUtils.save_parameter_values(self.main_loop.model.get_parameter_values(), model.path)
-            numpy.savez(
-                os.path.join(self.config['saveto'], 'val_bleu_scores.npz'),
-                bleu_scores=self.val_bleu_curve)
-            signal.signal(signal.SIGINT, s)
+    def __init__(self, config, track_n_models=1):
+        super(MeteorMetric, self).__init__(config, track_n_models=track_n_models)
+        self.meteor_scorer = MeteorScorer.from_config(self.config)
+        self.references = None
 
+    def score(self, translations, hypotheses):
+        if self.references is None:
+            self.references = read_segments(self.config['val_set_grndtruth'])
 
-class MeteorValidator(SimpleExtension, SamplingBase):
-    """Implements early stopping based on METEOR score."""
+        meteor_score = self.meteor_scorer.corpus_score([trans_out.decode('utf8') for trans_out in translations],
+                                                       self.references[:len(translations)])
+        logger.info('METEOR SCORE: {}'.format(meteor_score))
+
+        return meteor_score
+
+
+class MultiMetricValidator(SimpleExtension, SamplingBase):
+    """Implements early stopping based on any number of scores, decoding the dev set only once per validation
+
+    The translations of each validation are passed to every metric in `metrics`, each score is added to the log as
+    `validation_set_<key>_score`, and each metric keeps its own best models.
+
+    """
 
     def __init__(self, source_sentence, initial_state_context, samples, model, data_stream,
-                 config, src_vocab=None, trg_vocab=None, n_best=1, track_n_models=1,
-                 normalize=True, **kwargs):
-        super(MeteorValidator, self).__init__(**kwargs)
+                 config, metrics, src_vocab=None, trg_vocab=None, n_best=1, normalize=True,
+                 source_sentence_mask=None, **kwargs):
+        super(MultiMetricValidator, self).__init__(**kwargs)
         self.source_sentence = source_sentence
+        self.source_sentence_mask = source_sentence_mask
         self.initial_context = initial_state_context
 
         self.src_vocab = src_vocab
@@ -394,39 +573,20 @@ class MeteorValidator(SimpleExtension, SamplingBase):
         self.model = model
         self.data_stream = data_stream
         self.config = config
+        self.metrics = metrics
         self.n_best = n_best
-        self.track_n_models = track_n_models
         self.normalize = normalize
         self.verbose = config.get('val_set_out', None)
 
         # Helpers
-        self.best_models = []
-        self.val_meteor_curve = []
-        self.beam_search = BeamSearch(samples=samples)
-
-        # Info for Meteor
-        self.target_language = self.config['target_lang']
-        self.meteor_directory = self.config['meteor_directory']
+        self.beam_search = BatchedBeamSearch(samples, source_sentence, initial_state_context,
+                                             source_sentence_mask=source_sentence_mask,
+                                             beam_size=config['beam_size'])
 
         # Create save directory if it does not exist
         if not os.path.exists(self.config['saveto']):
             os.makedirs(self.config['saveto'])
 
-        if self.config['reload']:
-            try:
-                meteor_score = numpy.load(os.path.join(self.config['saveto'],
-                                                       'val_meteor_scores.npz'))
-                self.val_meteor_curve = meteor_score['meteor_scores'].tolist()
-
-                # Track n best previous meteor scores
-                for i, meteor in enumerate(
-                        sorted(self.val_meteor_curve, reverse=True)):
-                    if i < self.track_n_models:
-                        self.best_models.append(ModelInfo(meteor, key='METEOR'))
-                logger.info("MeteorScores Reloaded")
-            except:
-                logger.info("MeteorScores not Found")
-
     def do(self, which_callback, *args):
 
         # Track validation burn in
@@ -434,13 +594,13 @@ class MeteorValidator(SimpleExtension, SamplingBase):
             return
 
         # Evaluate the model
-        meteor_score = self._evaluate_model()
-        # add an entry to the log
-        self.main_loop.log.current_row['validation_set_meteor_score'] = meteor_score
-        # save if necessary
-        self._save_model(meteor_score)
+        scores = self._evaluate_model()
+        for metric in self.metrics:
+            # add an entry to the log
+            self.main_loop.log.current_row['validation_set_{}_score'.format(metric.name)] = scores[metric.key]
+            # save if necessary
+            metric.update(scores[metric.key], self.main_loop.model)
 
-    # TODO: if we are evaluating both BLEU and METEOR, we shouldn't need to translate twice!!
     def _evaluate_model(self):
         # Set in the superclass -- SamplingBase
         if not hasattr(self, 'target_dataset'):
@@ -454,113 +614,179 @@ class MeteorValidator(SimpleExtension, SamplingBase):
         logger.info("Started Validation: ")
         val_start_time = time.time()
 
-        ref_file = self.config['val_set_grndtruth']
-        # TODO: write all hyps to temp file for meteor
-        trg_hyp_file = tempfile.NamedTemporaryFile(delete=False)
+        translations, hypotheses, total_cost = self._translate_dev_set()
+        logger.info("Total cost of the validation: {}".format(total_cost))
 
+        # Write to file if it exists
         if self.verbose:
-            ftrans = codecs.open(self.config['val_set_out'], 'w', encoding='utf8')
+            with codecs.open(self.config['val_set_out'], 'w', encoding='utf8') as ftrans:
+                for trans_out in translations:
+                    print(trans_out.decode('utf8'), file=ftrans)
 
-        total_cost = 0.0
-        with codecs.open(trg_hyp_file.name, 'w', encoding='utf8') as hyps_out:
-            for i, line in enumerate(self.data_stream.get_epoch_iterator()):
-                """
-                Load the sentence, retrieve the sample, write to file
-                """
+        logger.info("Decoding the validation set took: {} minutes".format(
+            float(time.time() - val_start_time) / 60.))
 
-                # TODO: the section with beam search and translation is shared by all validators
-                seq = self._oov_to_unk(
-                    line[0], self.config['src_vocab_size'], self.unk_idx)
+        scores = {}
+        for metric in self.metrics:
+            metric_start_time = time.time()
+            scores[metric.key] = metric.score(translations, hypotheses)
+            logger.info("{} Validation Took: {} minutes".format(
+                metric.key, float(time.time() - metric_start_time) / 60.))
 
-                # TODO: the index is different when we are doing min-risk
-                initial_state_context = line[-1]
+        return scores
 
-                input_ = numpy.tile(seq, (self.config['beam_size'], 1))
-                context_input_ = numpy.tile(initial_state_context, (self.config['beam_size'], 1))
 
-                # draw sample, checking to ensure we don't get an empty string back
-                trans, costs = self.beam_search.search(
-                    input_values={self.source_sentence: input_,
-                                  self.initial_context: context_input_},
-                        max_length=3*len(seq), eol_symbol=self.eos_idx,
-                        ignore_first_eol=True)
+class ParameterSnapshot(object):
+    """Parameter values taken from a model, which can be saved like the model itself"""
 
-                # normalize costs according to the sequence lengths
-                if self.normalize:
-                    lengths = numpy.array([len(s) for s in trans])
-                    costs = costs / lengths
+    def __init__(self, parameter_values):
+        self.parameter_values = parameter_values
 
-                nbest_idx = numpy.argsort(costs)[:self.n_best]
-                for j, best in enumerate(nbest_idx):
-                    try:
-                        total_cost += costs[best]
-                        trans_out = trans[best]
+    def get_parameter_values(self):
+        return self.parameter_values
 
-                        # convert idx to words
-                        trans_out = self._idx_to_word(trans_out, self.trg_ivocab)
 
-                    except ValueError:
-                        logger.info(
-                            "Can NOT find a translation for line: {}".format(i+1))
-                        trans_out = '<UNK>'
-
-                    if j == 0:
-                        # Write to subprocess and file if it exists
-                        hyps_out.write(trans_out.decode('utf8') + '\n')
-                        if self.verbose:
-                            print(trans_out.decode('utf8'), file=ftrans)
-
-                if i != 0 and i % 100 == 0:
-                    logger.info(
-                        "Translated {} lines of validation set...".format(i))
+def _async_validation_worker(validator, requests, results):
+    # the search model is the forked copy, so setting its parameters doesn't touch the training process
+    parameter_names = set(validator.model.get_parameter_dict().keys())
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        iteration, parameter_values = request
+        try:
+            validator.model.set_parameter_values(
+                dict((name, value) for name, value in parameter_values.items() if name in parameter_names))
+            results.put((iteration, validator._evaluate_model(), None))
+        except Exception:
+            results.put((iteration, None, traceback.format_exc()))
+
+
+class AsyncMultiMetricValidator(MultiMetricValidator):
+    """Validates snapshots of the parameters in a separate process, while the training continues
+
+    Every `every_n_batches` batches, the parameter values are copied and sent to a validation process, which is forked
+    before training starts with its own copy of the compiled search graph and of the cached dev set. Forking that early
+    means no other extension has started a thread yet (e.g. the `AsyncCheckpointWriter`s start theirs when they write
+    their first file), so the child doesn't inherit locks held by threads which don't exist in it. Training goes on
+    while the snapshot is decoded and scored. The results are collected after each batch: the scores are written into
+    the log row of the iteration the snapshot was taken at, and each metric saves the snapshot that was evaluated if it
+    is among the best. If a validation is still running when the next one is due, the new one is skipped.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.validation_freq = kwargs.pop('every_n_batches')
+        kwargs.setdefault('before_training', True)
+        kwargs.setdefault('after_batch', True)
+        kwargs.setdefault('after_training', True)
+        super(AsyncMultiMetricValidator, self).__init__(*args, **kwargs)
+
+        self.worker = None
+        self.requests = None
+        self.results = None
+        self.pending = None
+
+    def _start_worker(self):
+        # build everything that only has to be done once before forking, so the worker inherits it
+        if not hasattr(self, 'target_dataset'):
+            self._initialize_dataset_info()
+        self.unk_idx = self.trg_vocab['<UNK>']
+        self.eos_idx = self.trg_vocab['</S>']
+        if not self.beam_search.compiled:
+            self.beam_search.compile()
+        self._get_dev_set()
+
+        context = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') \
+            else multiprocessing
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.worker = context.Process(target=_async_validation_worker, args=(self, self.requests, self.results))
+        self.worker.daemon = True
+        self.worker.start()
+        logger.info("Started the validation process")
+
+    def _stop_worker(self):
+        if self.worker is not None:
+            self.requests.put(None)
+            self.worker.join()
+            self.worker = None
+
+    def _collect(self, block=False):
+        if self.pending is None:
+            return
+        iteration, parameter_values = self.pending
+        while True:
+            try:
+                result_iteration, scores, error = self.results.get(timeout=1 if block else 0.)
+                break
+            except queue.Empty:
+                if not self.worker.is_alive():
+                    logger.error("The validation process died while validating iteration {}".format(iteration))
+                    self.worker = None
+                    self.pending = None
+                    return
+                if not block:
+                    return
+        self.pending = None
+
+        if error is not None:
+            logger.error("Validation of iteration {} failed:\n{}".format(result_iteration, error))
+            return
 
-            logger.info("Total cost of the validation: {}".format(total_cost))
+        logger.info("Validation of iteration {} finished".format(result_iteration))
+        for metric in self.metrics:
+            self.main_loop.log[result_iteration]['validation_set_{}_score'.format(metric.name)] = scores[metric.key]
+            logger.info("{} of iteration {}: {}".format(metric.key, result_iteration, scores[metric.key]))
+            # save the parameters which were evaluated, not the current ones
+            metric.update(scores[metric.key], ParameterSnapshot(parameter_values))
 
-            self.data_stream.reset()
-            if self.verbose:
-                ftrans.close()
+    def do(self, which_callback, *args):
+        if which_callback == 'before_training':
+            self._start_worker()
+            return
+        if which_callback == 'after_training':
+            self._collect(block=True)
+            self._stop_worker()
+            return
 
-        meteor_cmd = ['java', '-Xmx4G', '-jar', os.path.join(self.meteor_directory, 'meteor-1.5.jar'),
-                      trg_hyp_file.name, ref_file, '-l', self.target_language, '-norm']
+        self._collect()
 
-        meteor_output = subprocess.check_output(meteor_cmd)
-        meteor_score = float(meteor_output.strip().split('\n')[-1].split()[-1])
-        logger.info('METEOR SCORE: {}'.format(meteor_score))
+        iterations_done = self.main_loop.status['iterations_done']
+        # Track validation burn in
+        if iterations_done % self.validation_freq or iterations_done <= self.config['val_burn_in']:
+            return
+        if self.pending is not None:
+            logger.info("Skipping the validation of iteration {}, iteration {} is still being validated".format(
+                iterations_done, self.pending[0]))
+            return
 
-        logger.info("Meteor Validation Took: {} minutes".format(float(time.time() - val_start_time) / 60.))
+        if self.worker is None:
+            self._start_worker()
+        parameter_values = self.main_loop.model.get_parameter_values()
+        self.pending = (iterations_done, parameter_values)
+        self.requests.put(self.pending)
 
-        return meteor_score
 
-    def _is_valid_to_save(self, meteor_score):
-        if not self.best_models or min(self.best_models,
-                                       key=operator.attrgetter('score')).score < meteor_score:
-            return True
-        return False
+class BleuValidator(MultiMetricValidator):
+    """Implements early stopping based on BLEU score."""
 
-    def _save_model(self, meteor_score):
-        if self._is_valid_to_save(meteor_score):
-            model = ModelInfo(meteor_score, self.config['saveto'], key='METEOR')
+    def __init__(self, source_sentence, initial_state_context, samples, model, data_stream,
+                 config, track_n_models=1, **kwargs):
+        super(BleuValidator, self).__init__(source_sentence, initial_state_context, samples, model, data_stream,
+                                            config, [BleuMetric(config, track_n_models=track_n_models)],
+                                            **kwargs)
 
-            # Manage n-best model list first
-            if len(self.best_models) >= self.track_n_models:
-                old_model = self.best_models[0]
-                if old_model.path and os.path.isfile(old_model.path):
-                    logger.info("Deleting old model %s" % old_model.path)
-                    os.remove(old_model.path)
-                self.best_models.remove(old_model)
 
-            self.best_models.append(model)
-            self.best_models.sort(key=operator.attrgetter('score'))
+class MeteorValidator(MultiMetricValidator):
+    """Implements early stopping based on METEOR score."""
 
-            # Save the model here
-            s = signal.signal(signal.SIGINT, signal.SIG_IGN)
-            logger.info("Saving new model {}".format(model.path))
+    def __init__(self, source_sentence, initial_state_context, samples, model, data_stream,
+                 config, track_n_models=1, **kwargs):
+        super(MeteorValidator, self).__init__(source_sentence, initial_state_context, samples, model, data_stream,
+                                              config, [MeteorMetric(config, track_n_models=track_n_models)],
+                                              **kwargs)
 
-            SaveLoadUtils.save_parameter_values(self.main_loop.model.get_parameter_values(), model.path)
-            numpy.savez(
-                os.path.join(self.config['saveto'], 'val_meteor_scores.npz'),
-                meteor_scores=self.val_meteor_curve)
-            signal.signal(signal.SIGINT, s)
 
 class ModelInfo:
     """Utility class to keep track of evaluated models."""
@@ -0,0 +1,312 @@
+"""
+An HTTP translation server around `NMTPredictor`, which batches concurrent requests
+
+Requests are JSON objects POSTed to /translate:
+
+    {"segment": "a man rides a bike", "context": [0.1, ...], "n_best": 1, "tokenize": true, "detokenize": true}
+
+`context` holds the context features of the segment (e.g. the image features the model was trained with), the
+other fields are optional. The response is `{"translations": [...], "costs": [...]}` with the n best translations.
+GET /stats returns the batching and cache counters.
+
+"""
+
+import asyncio
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+
+class TranslationRequest(object):
+    """One segment to translate, and the options of `NMTPredictor.predict_segment`"""
+
+    def __init__(self, segment, context, n_best=1, tokenize=False, detokenize=False):
+        self.segment = segment
+        self.context = numpy.asarray(context, dtype='float32')
+        self.n_best = n_best
+        self.tokenize = tokenize
+        self.detokenize = detokenize
+
+
+class MicroBatcher(object):
+    """Collects the requests which arrive within `max_wait` seconds of each other, and translates them together
+
+    Once a request arrives, the batcher waits up to `max_wait` seconds for more, or until it has `max_batch_size` of
+    them, and translates them with a single `NMTPredictor.predict_batch` call, which takes the n_best and detokenize
+    options of each request. The searches run one at a time in a worker thread, so the event loop keeps accepting
+    requests meanwhile, and they make up the next batch. If a batch fails, its requests are translated one by one, so
+    that a bad request only fails itself.
+
+    Parameters
+    ----------
+    predictor: NMTPredictor
+    max_batch_size: int : the largest number of requests translated at once
+    max_wait: float : how many seconds the first request of a batch may wait for others
+
+    """
+
+    def __init__(self, predictor, max_batch_size=16, max_wait=0.01):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        # the compiled theano functions are not thread safe, a single thread runs all the searches
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.task = None
+
+        self.num_requests = 0
+        self.num_batches = 0
+        self.search_time = 0.
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.executor.shutdown(wait=False)
+
+    async def translate(self, request):
+        """Get the (translations, costs) of a `TranslationRequest`, once the batch it is part of is translated"""
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((request, future))
+        return await future
+
+    async def _next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = asyncio.get_event_loop().time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - asyncio.get_event_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            # the futures of clients which disconnected while they waited are cancelled by `NMTServer`
+            batch = [(request, future) for request, future in await self._next_batch() if not future.done()]
+            if not batch:
+                continue
+            start_time = time.time()
+            try:
+                results = await loop.run_in_executor(self.executor, self._translate_batch,
+                                                     [request for request, _ in batch])
+            except Exception as e:
+                # e.g. the executor was shut down, the batch fails but the batcher keeps serving
+                logger.exception('Translating a batch of {} requests failed'.format(len(batch)))
+                results = [(None, e)] * len(batch)
+            self.search_time += time.time() - start_time
+            self.num_requests += len(batch)
+            self.num_batches += 1
+
+            for (_, future), (result, error) in zip(batch, results):
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+    def _translate_batch(self, requests):
+        # returns a (result, error) tuple for each request
+        try:
+            return [(result, None) for result in self._predict(requests)]
+        except Exception as e:
+            if len(requests) == 1:
+                return [(None, e)]
+            logger.warning('Translating a batch of {} requests failed ({}), translating them one by one'.format(
+                len(requests), e))
+            return [self._translate_batch([request])[0] for request in requests]
+
+    def _predict(self, requests):
+        segments = [request.segment for request in requests]
+        to_tokenize = [i for i, request in enumerate(requests) if request.tokenize]
+        if to_tokenize:
+            for i, tokens in zip(to_tokenize, self.predictor.tokenize([segments[i] for i in to_tokenize])):
+                segments[i] = tokens
+        source_seqs = [self.predictor.src_vocab.encode(segment) for segment in segments]
+
+        return self.predictor.predict_batch(source_seqs, numpy.array([request.context for request in requests]),
+                                            n_best=[request.n_best for request in requests],
+                                            detokenize=[request.detokenize for request in requests])
+
+    def stats(self):
+        return {'requests': self.num_requests, 'batches': self.num_batches,
+                'mean_batch_size': float(self.num_requests) / self.num_batches if self.num_batches else 0.,
+                'search_seconds': self.search_time}
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message):
+        super(HTTPError, self).__init__(message)
+        self.status = status
+
+
+class NMTServer(object):
+    """A minimal HTTP/1.1 server (one request per connection) which answers /translate and /stats
+
+    Parameters
+    ----------
+    predictor: NMTPredictor
+    host: str
+    port: int : 0 picks a free port, which is logged when the server starts
+    max_batch_size: int : see `MicroBatcher`
+    max_wait: float : see `MicroBatcher`
+    max_body_size: int : the largest request body in bytes, larger requests are refused before they are read
+
+    """
+
+    reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large',
+               500: 'Internal Server Error'}
+
+    def __init__(self, predictor, host='0.0.0.0', port=5000, max_batch_size=16, max_wait=0.01,
+                 max_body_size=16 * 1024 * 1024):
+        self.predictor = predictor
+        self.host = host
+        self.port = port
+        self.max_body_size = max_body_size
+        self.batcher = MicroBatcher(predictor, max_batch_size=max_batch_size, max_wait=max_wait)
+        self.server = None
+
+    async def start(self):
+        self.batcher.start()
+        self.server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info('NMT server listening on {}:{}'.format(self.host, self.port))
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            self.batcher.stop()
+
+    def stats(self):
+        stats = {'batching': self.batcher.stats()}
+        if self.predictor.translation_cache is not None:
+            stats['translation_cache'] = self.predictor.translation_cache.stats()
+        return stats
+
+    def _parse_request(self, body):
+        try:
+            data = json.loads(body.decode('utf8'))
+            request = TranslationRequest(data['segment'], data['context'], n_best=int(data.get('n_best', 1)),
+                                         tokenize=bool(data.get('tokenize', False)),
+                                         detokenize=bool(data.get('detokenize', False)))
+        except (ValueError, TypeError, KeyError) as e:
+            raise HTTPError(400, 'Invalid request: {!r}'.format(e))
+        if request.context.ndim != 1:
+            raise HTTPError(400, 'context must be a list of numbers')
+        if not 1 <= request.n_best <= self.predictor.beam_size:
+            raise HTTPError(400, 'n_best must be between 1 and the beam size {}'.format(self.predictor.beam_size))
+        if request.tokenize and self.predictor.tokenizer is None:
+            raise HTTPError(400, 'This server has no tokenizer')
+        if request.detokenize and self.predictor.detokenizer is None:
+            raise HTTPError(400, 'This server has no detokenizer')
+        return request
+
+    async def _translate(self, request, reader, writer):
+        # the reader is polled while the request waits, so that the translation of a client which disconnected is
+        # cancelled (which cancels its future in the batcher). The end of the stream alone only means that the client
+        # is done sending (e.g. a half-close with shutdown(SHUT_WR)), it still gets its response
+        translation = asyncio.ensure_future(self.batcher.translate(request))
+        reading = True
+        while not translation.done():
+            if not reading:
+                await asyncio.wait([translation])
+                break
+            disconnect = asyncio.ensure_future(reader.read(1024))
+            await asyncio.wait([translation, disconnect], return_when=asyncio.FIRST_COMPLETED)
+            if not disconnect.done():
+                disconnect.cancel()
+            elif disconnect.cancelled() or disconnect.exception() is not None or writer.transport.is_closing():
+                translation.cancel()
+                raise ConnectionResetError('The client disconnected before {!r} was translated'.format(
+                    request.segment))
+            elif not disconnect.result():
+                reading = False
+            # otherwise more data (e.g. a pipelined request), which this server ignores
+        return translation.result()
+
+    async def _respond(self, method, path, body, reader, writer):
+        if path == '/stats' and method == 'GET':
+            return self.stats()
+        if path == '/translate' and method == 'POST':
+            request = self._parse_request(body)
+            try:
+                translations, costs = await self._translate(request, reader, writer)
+            except ConnectionError:
+                raise
+            except Exception as e:
+                logger.exception('Translating {!r} failed'.format(request.segment))
+                raise HTTPError(500, 'Translation failed: {!r}'.format(e))
+            return {'translations': translations, 'costs': [float(cost) for cost in costs]}
+        raise HTTPError(404, 'No route for {} {}'.format(method, path))
+
+    async def _read_request(self, reader):
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) != 3:
+            raise HTTPError(400, 'Invalid request line')
+        method, path = request_line[0].upper(), request_line[1].split('?')[0]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        try:
+            content_length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise HTTPError(400, 'Invalid Content-Length')
+        if content_length < 0:
+            raise HTTPError(400, 'Invalid Content-Length')
+        if content_length > self.max_body_size:
+            raise HTTPError(413, 'The request body is larger than {} bytes'.format(self.max_body_size))
+        try:
+            body = await reader.readexactly(content_length)
+        except asyncio.IncompleteReadError:
+            raise HTTPError(400, 'Invalid or missing request body')
+        return method, path, body
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            try:
+                method, path, body = await self._read_request(reader)
+                status, response = 200, await self._respond(method, path, body, reader, writer)
+            except HTTPError as e:
+                status, response = e.status, {'error': str(e)}
+            body = json.dumps(response).encode('utf8')
+            writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                         'Connection: close\r\n\r\n'.format(status, self.reasons[status], len(body)).encode('latin-1'))
+            writer.write(body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logger.debug('Dropped a connection: {}'.format(e))
+        finally:
+            writer.close()
+
+
+def run_nmt_server(predictor, host='0.0.0.0', port=5000, max_batch_size=16, max_wait=0.01,
+                   max_body_size=16 * 1024 * 1024):
+    """Serve translations with `predictor` until the process is interrupted"""
+    server = NMTServer(predictor, host=host, port=port, max_batch_size=max_batch_size, max_wait=max_wait,
+                       max_body_size=max_body_size)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        logger.info('NMT server stopped')
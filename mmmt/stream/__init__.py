@@ -1,91 +1,915 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+import zipfile
+from contextlib import closing
+from itertools import islice
+
 import numpy
 
-from six.moves import cPickle
+import six
+from six.moves import queue
 
-from fuel.datasets import IterableDataset
-from fuel.transformers import Merge
-from fuel.streams import DataStream
-from fuel.datasets import TextFile
-from fuel.schemes import ConstantScheme
-from fuel.streams import DataStream
-from fuel.transformers import (
-    Merge, Batch, Filter, Padding, SortMapping, Unpack, Mapping)
-import numpy
-from fuel.datasets import TextFile
-from fuel.schemes import ConstantScheme
+from fuel import config as fuel_config
+from fuel.datasets import Dataset, IterableDataset, TextFile
+from fuel.schemes import ConstantScheme, SequentialExampleScheme
 from fuel.streams import DataStream
 from fuel.transformers import (
     Merge, Batch, Filter, Padding, SortMapping, Unpack, Mapping, Transformer)
 
-from six.moves import cPickle
+from machine_translation.stream import _length, _oov_to_unk, _too_long
+
+from mmmt.vocab import Vocabulary
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+    SHARED_MEMORY_AVAILABLE = True
+except ImportError:
+    SHARED_MEMORY_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+
+def _quantization_path(filename):
+    return os.path.splitext(filename)[0] + '.quant.npz'
+
+
+class ContextFeatureStore(object):
+    """A matrix of context features with one row per segment
+
+    The rows may be stored as float32, float16, or as int8 with a per-dimension `scale` and `offset`. Indexing
+    or iterating the store returns float32 rows. `stored_rows` gives the rows as they are stored, which can be
+    turned into float32 with `dequantize` once a batch of them has been assembled.
+
+    If `ids` is given, `data` is a table of distinct feature vectors (e.g. one per image) and segment `i` uses
+    row `ids[i]` of the table.
+
+    """
+    def __init__(self, data, scale=None, offset=None, ids=None):
+        self.data = data
+        self.scale = scale
+        self.offset = offset
+        self.ids = ids
+
+    @property
+    def shape(self):
+        return (len(self),) + self.data.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def __len__(self):
+        if self.ids is not None:
+            return len(self.ids)
+        return len(self.data)
+
+    def stored(self, idx):
+        """The rows of segments `idx`, as they are stored"""
+        if self.ids is not None:
+            return self.data[self.ids[idx]]
+        return self.data[idx]
+
+    @property
+    def stored_rows(self):
+        """An iterable over the rows of all segments, as they are stored"""
+        return StoredContextFeatures(self)
+
+    def dequantize(self, rows):
+        rows = numpy.asarray(rows)
+        if self.scale is not None:
+            return rows.astype('float32') * self.scale + self.offset
+        return rows.astype('float32', copy=False)
+
+    def __getitem__(self, idx):
+        return self.dequantize(self.stored(idx))
+
+    def segment_range(self, start, end):
+        """The store of segments [start, end), which reads its rows from this one's (memory-mapped) data when they
+        are indexed, instead of copying them"""
+        if self.ids is not None:
+            return ContextFeatureStore(self.data, scale=self.scale, offset=self.offset, ids=self.ids[start:end])
+        return ContextFeatureStore(self.data[start:end], scale=self.scale, offset=self.offset)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class StoredContextFeatures(object):
+    """Iterates over the stored rows of a `ContextFeatureStore`, e.g. to wrap it in an `IterableDataset`"""
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __iter__(self):
+        for i in range(len(self.store)):
+            yield self.store.stored(i)
+
+
+def load_context_feature_ids(filename):
+    """Load the feature table row of each segment, from an `.npy` array or a text file with one id per line"""
+    if filename.endswith('.npy'):
+        return numpy.load(filename)
+    with open(filename) as inp:
+        return numpy.array([int(line) for line in inp if line.strip()], dtype='int64')
+
+
+def load_context_features(filename, ids_file=None):
+    """Open a matrix of context features with one row per segment.
+
+    `.npy` feature stores are opened with `numpy.memmap`, so rows are only read from disk when they are
+    indexed. Legacy `.npz` archives have to be decompressed into memory -- convert them once with
+    `convert_npz_to_feature_store`.
+
+    If `ids_file` is given, `filename` is a table of distinct features, and each segment is mapped to its row of
+    the table through the ids in `ids_file` (see `deduplicate_context_features`).
+
+    Returns
+    -------
+    features: ContextFeatureStore
+
+    """
+    ids = load_context_feature_ids(ids_file) if ids_file is not None else None
+
+    if filename.endswith('.npz'):
+        logger.warning('Loading all of {} into memory, convert it to a .npy feature store '
+                       'to memory-map it instead'.format(filename))
+        return ContextFeatureStore(numpy.load(filename)['arr_0'], ids=ids)
+
+    scale = offset = None
+    if os.path.isfile(_quantization_path(filename)):
+        with closing(numpy.load(_quantization_path(filename))) as quantization:
+            scale = quantization['scale']
+            offset = quantization['offset']
+    store = ContextFeatureStore(numpy.load(filename, mmap_mode='r'), scale=scale, offset=offset, ids=ids)
+
+    if ids is not None and len(ids) > 0:
+        assert ids.min() >= 0 and ids.max() < len(store.data), \
+            'ids in {} are out of range for the {} rows of {}'.format(ids_file, len(store.data), filename)
+    return store
+
+
+def deduplicate_context_features(features_file, table_file, ids_file, chunk_rows=4096):
+    """Store each distinct feature vector once, with one table id per segment
+
+    Writes the table of distinct rows to `table_file` (in order of first occurrence) and the id of each segment's
+    row to `ids_file` (an `.npy` array).
+
+    Returns
+    -------
+    num_distinct: int : the number of rows in the table
+
+    """
+    features = load_context_features(features_file)
+
+    # rows are keyed on their sha1 digest rather than their bytes, so the dict stays small for wide features, and
+    # the row a digest was first seen with is compared on each hit, so a collision can't merge different rows
+    row_ids = {}
+    first_rows = []
+    ids = numpy.empty(len(features), dtype='int64')
+    for start in range(0, len(features), chunk_rows):
+        for i, row in enumerate(features.stored(slice(start, start + chunk_rows))):
+            row = numpy.ascontiguousarray(row)
+            key = hashlib.sha1(row.tobytes()).digest()
+            if key not in row_ids:
+                row_ids[key] = len(first_rows)
+                first_rows.append(start + i)
+            elif not numpy.array_equal(features.stored(first_rows[row_ids[key]]), row):
+                raise ValueError('Rows {} and {} of {} have the same sha1 digest'.format(
+                    first_rows[row_ids[key]], start + i, features_file))
+            ids[start + i] = row_ids[key]
+
+    table = numpy.lib.format.open_memmap(table_file, mode='w+', dtype=features.dtype,
+                                         shape=(len(first_rows),) + features.shape[1:])
+    for start in range(0, len(first_rows), chunk_rows):
+        table[start:start + chunk_rows] = features.stored(first_rows[start:start + chunk_rows])
+    table.flush()
+    del table
+
+    if features.scale is not None:
+        numpy.savez(_quantization_path(table_file), scale=features.scale, offset=features.offset)
+    numpy.save(ids_file, ids)
+
+    return len(first_rows)
+
+
+def quantize_context_features(features_file, output_file, dtype='int8', chunk_rows=4096):
+    """Write a smaller copy of a feature store, as float16 or as int8 with a per-dimension scale and offset
+
+    For int8, each dimension's [min, max] range is mapped linearly onto [-128, 127], and the scale and offset
+    are written to a `.quant.npz` file next to the `.npy` feature store.
+
+    """
+    features = load_context_features(features_file)
+    n_rows = len(features)
+    store = numpy.lib.format.open_memmap(output_file, mode='w+', dtype=dtype, shape=features.shape)
+
+    if numpy.dtype(dtype) == numpy.float16:
+        for start in range(0, n_rows, chunk_rows):
+            store[start:start + chunk_rows] = features[start:start + chunk_rows]
+    elif numpy.dtype(dtype) == numpy.int8:
+        mins = numpy.full(features.shape[1:], numpy.inf, dtype='float32')
+        maxs = numpy.full(features.shape[1:], -numpy.inf, dtype='float32')
+        for start in range(0, n_rows, chunk_rows):
+            chunk = features[start:start + chunk_rows]
+            mins = numpy.minimum(mins, chunk.min(axis=0))
+            maxs = numpy.maximum(maxs, chunk.max(axis=0))
+
+        scale = (maxs - mins) / 255.
+        scale[scale == 0] = 1.
+        offset = mins + 128. * scale
+        for start in range(0, n_rows, chunk_rows):
+            chunk = numpy.rint((features[start:start + chunk_rows] - offset) / scale)
+            store[start:start + chunk_rows] = numpy.clip(chunk, -128, 127)
+        numpy.savez(_quantization_path(output_file),
+                    scale=scale.astype('float32'), offset=offset.astype('float32'))
+    else:
+        raise ValueError('Context features can be quantized to float16 or int8, not {}'.format(dtype))
+
+    store.flush()
+    del store
+
+
+def feature_reconstruction_error(features_file, quantized_file, chunk_rows=4096):
+    """Compare a quantized feature store with the original features
+
+    Returns
+    -------
+    errors: dict : the root mean squared error, the maximum absolute error, the mean relative L2 error and the
+                   mean cosine similarity of the rows
+
+    """
+    features = load_context_features(features_file)
+    quantized = load_context_features(quantized_file)
+    assert features.shape == quantized.shape, 'shapes {} and {} do not match'.format(features.shape,
+                                                                                     quantized.shape)
+
+    squared_error = 0.
+    max_abs_error = 0.
+    relative_error = 0.
+    cosine = 0.
+    for start in range(0, len(features), chunk_rows):
+        original = features[start:start + chunk_rows].astype('float64')
+        reconstructed = quantized[start:start + chunk_rows].astype('float64')
+        diff = original - reconstructed
+        squared_error += (diff ** 2).sum()
+        max_abs_error = max(max_abs_error, numpy.abs(diff).max())
+
+        original_norms = numpy.sqrt((original ** 2).sum(axis=1))
+        reconstructed_norms = numpy.sqrt((reconstructed ** 2).sum(axis=1))
+        safe_norms = numpy.maximum(original_norms, 1e-12)
+        relative_error += (numpy.sqrt((diff ** 2).sum(axis=1)) / safe_norms).sum()
+        cosine += ((original * reconstructed).sum(axis=1) /
+                   numpy.maximum(original_norms * reconstructed_norms, 1e-12)).sum()
+
+    n_rows = float(len(features))
+    return {
+        'rmse': numpy.sqrt(squared_error / numpy.prod(features.shape)),
+        'max_abs_error': max_abs_error,
+        'mean_relative_l2_error': relative_error / n_rows,
+        'mean_cosine_similarity': cosine / n_rows
+    }
+
+
+def convert_npz_to_feature_store(npz_file, output_file, array_name='arr_0', chunk_rows=4096):
+    """Copy an array out of an `.npz` archive into a `.npy` file which can be memory-mapped
+
+    The array is streamed out of the archive `chunk_rows` rows at a time, so the full matrix never needs to fit
+    into memory.
+
+    Parameters
+    ----------
+    npz_file: str : the archive written by `numpy.savez`
+    output_file: str : path of the `.npy` feature store
+    array_name: str : the name of the array inside the archive
+    chunk_rows: int : how many rows to copy at a time
+
+    Returns
+    -------
+    shape: tuple : the shape of the converted matrix
+
+    """
+    header_readers = {(1, 0): numpy.lib.format.read_array_header_1_0,
+                      (2, 0): numpy.lib.format.read_array_header_2_0}
+
+    with closing(zipfile.ZipFile(npz_file)) as archive:
+        member = archive.open(array_name + '.npy')
+        version = numpy.lib.format.read_magic(member)
+        shape, fortran_order, dtype = header_readers[version](member)
+
+        if fortran_order or dtype.hasobject or len(shape) == 0:
+            # rows are not contiguous on disk, fall back to loading the whole array
+            member.close()
+            features = numpy.load(npz_file)[array_name]
+            numpy.save(output_file, numpy.ascontiguousarray(features))
+            return features.shape
+
+        store = numpy.lib.format.open_memmap(output_file, mode='w+', dtype=dtype, shape=shape)
+        row_shape = shape[1:]
+        row_bytes = int(numpy.prod(row_shape)) * dtype.itemsize
+        for start in range(0, shape[0], chunk_rows):
+            n_rows = min(chunk_rows, shape[0] - start)
+            chunk = member.read(n_rows * row_bytes)
+            store[start:start + n_rows] = numpy.frombuffer(chunk, dtype=dtype).reshape((n_rows,) + row_shape)
+        member.close()
+        store.flush()
+        del store
+
+    return shape
+
+
+def _binarized_paths(prefix, side):
+    return prefix + '.{}.tokens.npy'.format(side), prefix + '.{}.offsets.npy'.format(side)
+
+
+def _binarize_text_file(text_file, vocab, tokens_file, offsets_file, chunk_lines=100000):
+    tokens = []
+    lengths = []
+    with open(text_file) as inp:
+        while True:
+            lines = list(islice(inp, chunk_lines))
+            if not lines:
+                break
+            # this matches the way fuel's TextFile maps words to indices, plus the _oov_to_unk mapping
+            for idxs in vocab.encode_batch(lines):
+                tokens.append(idxs.astype('int32'))
+                lengths.append(len(idxs))
+
+    numpy.save(tokens_file, numpy.concatenate(tokens) if tokens else numpy.array([], dtype='int32'))
+    numpy.save(offsets_file, numpy.concatenate([[0], numpy.cumsum(lengths, dtype='int64')]))
+    return len(lengths)
+
+
+def binarize_parallel_corpus(src_vocab, trg_vocab, src_data, trg_data, binarized_corpus,
+                             src_vocab_size=30000, trg_vocab_size=30000, unk_id=1, **kwargs):
+    """Map a tokenized parallel corpus to flat int32 token arrays with an offsets index
+
+    For each side this writes `<binarized_corpus>.{src,trg}.tokens.npy`, every sentence's token indices (with EOS
+    appended, and OOV indices already mapped to `unk_id`) laid end to end, and `<binarized_corpus>.{src,trg}.offsets.npy`,
+    where sentence `i` is `tokens[offsets[i]:offsets[i+1]]`.
+
+    Like the stream functions, this can be called with a whole config: binarize_parallel_corpus(**config_dict)
+
+    Returns
+    -------
+    num_segments: int : the number of sentence pairs in the corpus
+
+    """
+    src_vocab = Vocabulary.load(src_vocab, src_vocab_size, unk_idx=unk_id)
+    trg_vocab = Vocabulary.load(trg_vocab, trg_vocab_size, unk_idx=unk_id)
+
+    num_src = _binarize_text_file(src_data, src_vocab, *_binarized_paths(binarized_corpus, 'src'))
+    num_trg = _binarize_text_file(trg_data, trg_vocab, *_binarized_paths(binarized_corpus, 'trg'))
+    assert num_src == num_trg, 'lens {} and {} do not match'.format(num_src, num_trg)
+
+    return num_src
+
+
+class BinarizedParallelDataset(Dataset):
+    """Serves (source, target, initial_context) examples from a binarized parallel corpus
+
+    The token arrays written by `binarize_parallel_corpus` and the context feature store are memory-mapped, so
+    each example is read straight from the index without any tokenization or vocabulary lookups.
+
+    Pairs longer than `seq_len` are dropped here, together with their context features, so the three sources
+    always stay aligned. Context features are served as they are stored, use `self.context_features.dequantize`
+    to turn a batch of them into float32.
+
+    Parameters
+    ----------
+    binarized_corpus: str : the prefix that was passed to `binarize_parallel_corpus`
+    context_features: str : the context features for each sentence pair
+    seq_len: int : pairs where either side is longer than this are skipped (None keeps everything)
+    context_feature_ids: str : the table row of each sentence pair, if `context_features` is deduplicated
+
+    """
+    provides_sources = ('source', 'target', 'initial_context')
+
+    def __init__(self, binarized_corpus, context_features, seq_len=None, context_feature_ids=None, **kwargs):
+        self.src_tokens, self.src_offsets = [numpy.load(f, mmap_mode='r')
+                                             for f in _binarized_paths(binarized_corpus, 'src')]
+        self.trg_tokens, self.trg_offsets = [numpy.load(f, mmap_mode='r')
+                                             for f in _binarized_paths(binarized_corpus, 'trg')]
+        self.context_features = load_context_features(context_features, context_feature_ids)
+
+        num_segments = len(self.src_offsets) - 1
+        assert num_segments == len(self.trg_offsets) - 1 == len(self.context_features), \
+            'lens {}, {} and {} do not match'.format(num_segments, len(self.trg_offsets) - 1,
+                                                     len(self.context_features))
+
+        if seq_len is not None:
+            src_lens = numpy.diff(self.src_offsets)
+            trg_lens = numpy.diff(self.trg_offsets)
+            self.indices = numpy.flatnonzero((src_lens <= seq_len) & (trg_lens <= seq_len))
+        else:
+            self.indices = numpy.arange(num_segments)
+
+        self.num_examples = len(self.indices)
+        self.example_iteration_scheme = SequentialExampleScheme(self.num_examples)
+        super(BinarizedParallelDataset, self).__init__(**kwargs)
+
+    @staticmethod
+    def _segment(tokens, offsets, idx):
+        return numpy.asarray(tokens[offsets[idx]:offsets[idx + 1]], dtype='int64')
+
+    def _example(self, idx):
+        return (self._segment(self.src_tokens, self.src_offsets, idx),
+                self._segment(self.trg_tokens, self.trg_offsets, idx),
+                self.context_features.stored(idx))
+
+    def get_data(self, state=None, request=None):
+        if state is not None:
+            raise ValueError('BinarizedParallelDataset does not have a state')
+        if isinstance(request, (int, numpy.integer)):
+            return self._example(self.indices[request])
+
+        examples = [self._example(idx) for idx in self.indices[request]]
+        return tuple(list(source) for source in zip(*examples))
+
+
+class TokenBudgetBatch(Transformer):
+    """Packs a stream of examples into length-bucketed batches with a bounded number of padded tokens
+
+    `read_ahead` examples are read and sorted by the lengths of all `length_sources`. Consecutive examples are
+    then packed into a batch for as long as `batch size * sum of the longest sequence in each length source`
+    stays within `max_tokens`, so every batch costs about the same amount of padded computation. The batches
+    of each read-ahead block are returned in a random order.
+
+    Parameters
+    ----------
+    data_stream : :class:`AbstractDataStream` instance
+        The data stream to wrap, it must produce examples
+    max_tokens: int : the maximum number of padded tokens in a batch (a single example may exceed it)
+    read_ahead: int : how many examples are sorted and bucketed together
+    length_sources: tuple : the sources whose lengths are used for sorting and packing
+    rng: numpy.random.RandomState : used to shuffle the batch order
+
+    """
+    def __init__(self, data_stream, max_tokens, read_ahead, length_sources=('source', 'target'), rng=None,
+                 **kwargs):
+        if not data_stream.produces_examples:
+            raise ValueError('the wrapped data stream must produce examples, '
+                             'not batches of examples')
+        super(TokenBudgetBatch, self).__init__(
+            data_stream, produces_examples=False, **kwargs)
+
+        self.max_tokens = max_tokens
+        self.read_ahead = read_ahead
+        self.length_idxs = [self.data_stream.sources.index(source) for source in length_sources]
+        self.rng = rng if rng is not None else numpy.random.RandomState(fuel_config.default_seed)
+        self._batches = []
+
+    def get_epoch_iterator(self, **kwargs):
+        self._batches = []
+        return super(TokenBudgetBatch, self).get_epoch_iterator(**kwargs)
+
+    def get_data(self, request=None):
+        if request is not None:
+            raise ValueError
+        if not self._batches:
+            self._batches = self._bucket(list(islice(self.child_epoch_iterator, self.read_ahead)))
+        if not self._batches:
+            raise StopIteration
+        return self._batches.pop()
+
+    def _bucket(self, examples):
+        if not examples:
+            return []
+
+        # lengths is (examples, length sources), sort by the first length source, then the next one, ...
+        lengths = numpy.array([[len(example[i]) for i in self.length_idxs] for example in examples])
+        order = numpy.lexsort(lengths.T[::-1])
+
+        batches = []
+        batch_idxs = []
+        longest = numpy.zeros(len(self.length_idxs), dtype='int64')
+        for idx in order:
+            new_longest = numpy.maximum(longest, lengths[idx])
+            if batch_idxs and (len(batch_idxs) + 1) * new_longest.sum() > self.max_tokens:
+                batches.append(batch_idxs)
+                batch_idxs = []
+                new_longest = lengths[idx]
+            batch_idxs.append(idx)
+            longest = new_longest
+        batches.append(batch_idxs)
+
+        self.rng.shuffle(batches)
+        return [tuple([examples[idx][i] for idx in batch_idxs] for i in range(len(self.sources)))
+                for batch_idxs in batches]
+
+
+class PaddingWithEOSContext(Padding):
+    """Pads sequences with EOS and stacks the context features of each batch
+
+    Works like `PaddingWithEOS`, but each padded matrix and its mask are built with a single vectorized
+    assignment, and every source in `context_sources` is returned as one contiguous float32 matrix.
+
+    Parameters
+    ----------
+    data_stream : :class:`AbstractDataStream` instance
+        The data stream to wrap, it must produce batches
+    eos_idx: list : the padding index for each source, indexed by the position of the source in the stream
+    context_sources: tuple : sources which hold one feature vector per example
+    mask_dtype: str : the dtype of the masks
+    dequantize: function : maps a stacked matrix of stored (e.g. int8) context features to float32
+
+    """
+    def __init__(self, data_stream, eos_idx, context_sources=('initial_context',), mask_dtype='float32',
+                 dequantize=None, **kwargs):
+        kwargs['data_stream'] = data_stream
+        self.eos_idx = eos_idx
+        self.context_sources = context_sources
+        self.dequantize = dequantize
+        super(PaddingWithEOSContext, self).__init__(mask_dtype=mask_dtype, **kwargs)
+
+    @property
+    def sources(self):
+        sources = []
+        for source in self.data_stream.sources:
+            sources.append(source)
+            if source in self.mask_sources and source not in self.context_sources:
+                sources.append(source + '_mask')
+        return tuple(sources)
+
+    def transform_batch(self, batch):
+        batch_with_masks = []
+        for i, (source, source_batch) in enumerate(
+                zip(self.data_stream.sources, batch)):
+            if source in self.context_sources:
+                if self.dequantize is not None:
+                    batch_with_masks.append(self.dequantize(numpy.ascontiguousarray(source_batch)))
+                else:
+                    batch_with_masks.append(numpy.ascontiguousarray(source_batch, dtype='float32'))
+                continue
+            if source not in self.mask_sources:
+                batch_with_masks.append(source_batch)
+                continue
+
+            lengths = numpy.array([len(sample) for sample in source_batch], dtype='int64')
+            mask = numpy.arange(lengths.max()) < lengths[:, None]
+            tokens = numpy.concatenate([numpy.asarray(sample) for sample in source_batch])
+
+            padded_batch = numpy.empty(mask.shape, dtype=tokens.dtype)
+            padded_batch.fill(self.eos_idx[i])
+            padded_batch[mask] = tokens
+            batch_with_masks.append(padded_batch)
+            batch_with_masks.append(mask.astype(self.mask_dtype))
+        return tuple(batch_with_masks)
+
+
+def _shard_stream(data_stream, worker_id, num_workers):
+    """Make every root stream of a pipeline yield only every `num_workers`-th item, starting at `worker_id`
+
+    All roots are sliced in the same way, so streams which are merged stay aligned. Items are skipped before
+    they are read where possible: the requests of an iteration scheme are sliced, so the dataset never reads the
+    other examples, and the state of a dataset without a scheme (e.g. the lines of a `TextFile`) is sliced before
+    its `get_data` tokenizes and looks up the words.
+
+    """
+    def sharded(iterator):
+        return islice(iterator, worker_id, None, num_workers)
+
+    streams = [data_stream]
+    while streams:
+        stream = streams.pop()
+        if hasattr(stream, 'data_streams'):
+            streams.extend(stream.data_streams)
+        elif hasattr(stream, 'data_stream'):
+            streams.append(stream.data_stream)
+        elif getattr(stream, 'iteration_scheme', None) is not None:
+            scheme = stream.iteration_scheme
+            if not getattr(scheme, '_sharded', False):
+                scheme.get_request_iterator = lambda get_requests=scheme.get_request_iterator: sharded(get_requests())
+                scheme._sharded = True
+        elif hasattr(stream, 'dataset'):
+            dataset = stream.dataset
+            if not getattr(dataset, '_sharded', False):
+                # Dataset.reset re-opens the dataset through self.open, so the next epochs are sharded too
+                dataset.open = lambda open_dataset=dataset.open: sharded(open_dataset())
+                dataset._sharded = True
+            # the stream opened the dataset when it was created, open it again through the sharded open
+            stream.reset()
+        else:
+            stream.get_epoch_iterator = lambda get_epoch_iterator=stream.get_epoch_iterator, **kwargs: sharded(
+                get_epoch_iterator(**kwargs))
+
+
+def _pack_batch(batch, use_shared_memory, min_shared_bytes=65536):
+    packed = []
+    for data in batch:
+        if use_shared_memory and isinstance(data, numpy.ndarray) and data.nbytes >= min_shared_bytes:
+            data = numpy.ascontiguousarray(data)
+            block = shared_memory.SharedMemory(create=True, size=data.nbytes)
+            numpy.ndarray(data.shape, dtype=data.dtype, buffer=block.buf)[...] = data
+            # the consumer unlinks the block once it has copied the data out, or `_release_batch` does it
+            resource_tracker.unregister(block._name, 'shared_memory')
+            packed.append(('shared', (block.name, data.shape, data.dtype.str)))
+            block.close()
+        else:
+            packed.append(('pickled', data))
+    return tuple(packed)
+
+
+def _unpack_batch(packed):
+    batch = []
+    for kind, data in packed:
+        if kind == 'shared':
+            name, shape, dtype = data
+            block = shared_memory.SharedMemory(name=name)
+            data = numpy.ndarray(shape, dtype=dtype, buffer=block.buf).copy()
+            block.close()
+            block.unlink()
+        batch.append(data)
+    return tuple(batch)
+
+
+def _release_batch(packed):
+    # frees the shared memory of a batch which is thrown away without being unpacked
+    for kind, data in packed:
+        if kind == 'shared':
+            try:
+                block = shared_memory.SharedMemory(name=data[0])
+            except OSError:
+                continue
+            block.close()
+            block.unlink()
+
+
+def _prefetch_worker(data_stream, worker_id, num_workers, commands, batches, stop, use_shared_memory):
+    _shard_stream(data_stream, worker_id, num_workers)
+    while commands.get() is not None:
+        try:
+            for batch in data_stream.get_epoch_iterator():
+                if stop.is_set():
+                    return
+                batches.put(('batch', _pack_batch(batch, use_shared_memory)))
+            batches.put(('epoch_done', None))
+        except Exception:
+            batches.put(('error', traceback.format_exc()))
+            return
+
+
+class _PrefetchEpochIterator(six.Iterator):
+    """Reads the batches of one epoch from the workers of a `PrefetchingDataStream` in round-robin order
+
+    Unlike a generator, this can be pickled with the main loop's iteration state. The workers and their queues
+    are not pickled, so an iterator restored from a checkpoint starts the epoch again from its beginning.
+
+    """
+    def __init__(self, data_stream, as_dict=False):
+        self.data_stream = data_stream
+        self.as_dict = as_dict
+        self.active = list(range(data_stream.num_workers))
+        self.position = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        stream = self.data_stream
+        if stream._processes is None:
+            stream._start_epoch()
+            self.active = list(range(stream.num_workers))
+            self.position = 0
+        while self.active:
+            self.position %= len(self.active)
+            worker_id = self.active[self.position]
+            batch = stream._next_message(worker_id)
+            if batch is None:
+                del self.active[self.position]
+                continue
+            self.position += 1
+            return dict(zip(stream.sources, batch)) if self.as_dict else batch
+        raise StopIteration
+
+
+class PrefetchingDataStream(Transformer):
+    """Runs a data stream in worker processes, so batches are prepared while the model is training
+
+    Each worker process gets its own copy of the wrapped stream and produces every `num_workers`-th example
+    of the underlying datasets, through the whole pipeline (filtering, merging, sorting, padding...). Finished
+    batches are passed back through a bounded queue per worker, large numpy arrays through shared memory when
+    it is available. Batches are read from the workers in round-robin order.
+
+    The stream can be pickled (e.g. in a checkpoint of the main loop's iteration state): the workers are left
+    out, and started again when the unpickled stream is first iterated.
+
+    Parameters
+    ----------
+    data_stream : :class:`AbstractDataStream` instance
+        The data stream to wrap, it is only ever iterated in the worker processes
+    num_workers: int : how many worker processes to start
+    queue_size: int : how many finished batches each worker may hold before it blocks
+    use_shared_memory: bool : pass large arrays through shared memory instead of pickling them
+
+    """
+    def __init__(self, data_stream, num_workers=1, queue_size=8, use_shared_memory=True, **kwargs):
+        super(PrefetchingDataStream, self).__init__(
+            data_stream, produces_examples=data_stream.produces_examples, **kwargs)
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.use_shared_memory = use_shared_memory and SHARED_MEMORY_AVAILABLE
+        self._reset_workers()
+
+    def _reset_workers(self):
+        self._processes = None
+        self._commands = None
+        self._batches = None
+        self._stop = None
+        self._in_epoch = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('_processes', '_commands', '_batches', '_stop', '_in_epoch'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_workers()
+
+    @property
+    def mask_sources(self):
+        # the Sampler reads this from the main loop's data stream
+        return self.data_stream.mask_sources
+
+    def _start_workers(self):
+        # the workers must inherit the stream instead of unpickling it
+        context = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') \
+            else multiprocessing
+        self._commands = [context.Queue() for _ in range(self.num_workers)]
+        self._batches = [context.Queue(maxsize=self.queue_size) for _ in range(self.num_workers)]
+        self._stop = context.Event()
+        self._processes = []
+        for worker_id in range(self.num_workers):
+            process = context.Process(target=_prefetch_worker,
+                                      args=(self.data_stream, worker_id, self.num_workers,
+                                            self._commands[worker_id], self._batches[worker_id], self._stop,
+                                            self.use_shared_memory))
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+        self._in_epoch = [False] * self.num_workers
+        logger.info('Started {} prefetching workers'.format(self.num_workers))
+
+    def _next_message(self, worker_id, unpack=True):
+        message, payload = self._batches[worker_id].get()
+        if message == 'error':
+            raise RuntimeError('Prefetching worker {} failed:\n{}'.format(worker_id, payload))
+        if message == 'epoch_done':
+            self._in_epoch[worker_id] = False
+            return None
+        if not unpack:
+            _release_batch(payload)
+            return payload
+        return _unpack_batch(payload)
+
+    def _drain(self):
+        # skip whatever is left of an epoch that was not iterated to the end
+        for worker_id in range(self.num_workers):
+            while self._in_epoch[worker_id]:
+                self._next_message(worker_id, unpack=False)
+
+    def _start_epoch(self):
+        if self._processes is None:
+            self._start_workers()
+        self._drain()
+        for worker_id in range(self.num_workers):
+            self._commands[worker_id].put('epoch')
+            self._in_epoch[worker_id] = True
+
+    def get_epoch_iterator(self, as_dict=False, **kwargs):
+        self._start_epoch()
+        return _PrefetchEpochIterator(self, as_dict)
+
+    def get_data(self, request=None):
+        raise NotImplementedError('PrefetchingDataStream can only be read through its epoch iterator')
+
+    def _discard_queued_batches(self):
+        for batches in self._batches:
+            while True:
+                try:
+                    message, payload = batches.get_nowait()
+                except queue.Empty:
+                    break
+                if message == 'batch':
+                    _release_batch(payload)
+
+    def close(self):
+        if self._processes is not None:
+            # the workers stop at their next batch, a worker blocked on a full queue is unblocked by the draining
+            self._stop.set()
+            for commands in self._commands:
+                commands.put(None)
+            deadline = time.time() + 10.
+            while any(process.is_alive() for process in self._processes) and time.time() < deadline:
+                self._discard_queued_batches()
+                time.sleep(0.01)
+            for process in self._processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+            self._discard_queued_batches()
+            self._reset_workers()
+        super(PrefetchingDataStream, self).close()
 
-from machine_translation.stream import _ensure_special_tokens, _length, PaddingWithEOS, _oov_to_unk, _too_long
 
 def get_tr_stream_with_context_features(src_vocab, trg_vocab, src_data, trg_data, context_features,
                                         src_vocab_size=30000, trg_vocab_size=30000, unk_id=1,
-                                        seq_len=50, batch_size=80, sort_k_batches=12, **kwargs):
-    """Prepares the training data stream."""
+                                        seq_len=50, batch_size=80, sort_k_batches=12,
+                                        binarized_corpus=None, max_tokens=None, prefetch_workers=0,
+                                        prefetch_queue_size=8, context_feature_ids=None, **kwargs):
+    """Prepares the training data stream.
 
-    def _get_np_array(filename):
-        return numpy.load(filename)['arr_0']
+    If `binarized_corpus` is set, examples are read from the corpus compiled by `binarize_parallel_corpus`
+    instead of re-tokenizing `src_data` and `trg_data` every epoch.
+
+    If `max_tokens` is set, the `batch_size*sort_k_batches` read-ahead examples are packed into batches of at
+    most `max_tokens` padded source and target tokens instead of batches of `batch_size` examples.
+
+    If `context_feature_ids` is set, `context_features` is a deduplicated table, and each line of the corpus
+    uses the table row given by its id.
+
+    If `prefetch_workers` > 0, the whole pipeline runs in that many worker processes, which keep up to
+    `prefetch_queue_size` padded batches each ready for the training loop.
+
+    """
 
     # Load dictionaries and ensure special tokens exist
-    src_vocab = _ensure_special_tokens(
-        src_vocab if isinstance(src_vocab, dict)
-        else cPickle.load(open(src_vocab)),
-        bos_idx=0, eos_idx=src_vocab_size - 1, unk_idx=unk_id)
-    trg_vocab = _ensure_special_tokens(
-        trg_vocab if isinstance(trg_vocab, dict) else
-        cPickle.load(open(trg_vocab)),
-        bos_idx=0, eos_idx=trg_vocab_size - 1, unk_idx=unk_id)
-
-    # Get text files from both source and target
-    src_dataset = TextFile([src_data], src_vocab, None)
-    trg_dataset = TextFile([trg_data], trg_vocab, None)
-
-    # Merge them to get a source, target pair
-    stream = Merge([src_dataset.get_example_stream(),
-                    trg_dataset.get_example_stream()],
-                   ('source', 'target'))
-
-    # Filter sequences that are too long
-    stream = Filter(stream,
-                    predicate=_too_long(seq_len=seq_len))
-
-
-    # Replace out of vocabulary tokens with unk token
-    # TODO: doesn't the TextFile stream do this anyway?
-    stream = Mapping(stream,
-                     _oov_to_unk(src_vocab_size=src_vocab_size,
-                                 trg_vocab_size=trg_vocab_size,
-                                 unk_id=unk_id))
-
-    # now add the source with the image features
-    # create the image datastream (iterate over a file line-by-line)
-    train_features = _get_np_array(context_features)
-    train_feature_dataset = IterableDataset(train_features)
-    train_image_stream = DataStream(train_feature_dataset)
-
-    stream = Merge([stream, train_image_stream], ('source', 'target', 'initial_context'))
-
-    # Build a batched version of stream to read k batches ahead
-    stream = Batch(stream,
-                   iteration_scheme=ConstantScheme(
-                       batch_size*sort_k_batches))
-
-    # Sort all samples in the read-ahead batch
-    stream = Mapping(stream, SortMapping(_length))
-
-    # Convert it into a stream again
-    stream = Unpack(stream)
-
-    # Construct batches from the stream with specified batch size
-    stream = Batch(
-        stream, iteration_scheme=ConstantScheme(batch_size))
-
-    # Pad sequences that are short
-    masked_stream = PaddingWithEOS(
-        stream, [src_vocab_size - 1, trg_vocab_size - 1], mask_sources=('source', 'target'))
+    src_vocab = Vocabulary.load(src_vocab, src_vocab_size, unk_idx=unk_id)
+    trg_vocab = Vocabulary.load(trg_vocab, trg_vocab_size, unk_idx=unk_id)
+
+    if binarized_corpus is not None:
+        # the corpus was tokenized, mapped to indices and OOV-filtered at compile time
+        dataset = BinarizedParallelDataset(binarized_corpus, context_features, seq_len=seq_len,
+                                           context_feature_ids=context_feature_ids)
+        train_features = dataset.context_features
+        stream = dataset.get_example_stream()
+    else:
+        # Get text files from both source and target
+        src_dataset = TextFile([src_data], src_vocab, None)
+        trg_dataset = TextFile([trg_data], trg_vocab, None)
+
+        # Merge them to get a source, target pair
+        stream = Merge([src_dataset.get_example_stream(),
+                        trg_dataset.get_example_stream()],
+                       ('source', 'target'))
+
+        # Filter sequences that are too long
+        stream = Filter(stream,
+                        predicate=_too_long(seq_len=seq_len))
+
+
+        # Replace out of vocabulary tokens with unk token
+        # TODO: doesn't the TextFile stream do this anyway?
+        stream = Mapping(stream,
+                         _oov_to_unk(src_vocab_size=src_vocab_size,
+                                     trg_vocab_size=trg_vocab_size,
+                                     unk_id=unk_id))
+
+        # now add the source with the image features
+        # create the image datastream (iterate over a file line-by-line)
+        # rows are passed through as they are stored, and dequantized once they have been batched
+        train_features = load_context_features(context_features, context_feature_ids)
+        train_feature_dataset = IterableDataset(train_features.stored_rows)
+        train_image_stream = DataStream(train_feature_dataset)
+
+        stream = Merge([stream, train_image_stream], ('source', 'target', 'initial_context'))
+
+    if max_tokens is not None:
+        # Sort k batches worth of samples by source and target length, and pack them into token-bounded batches
+        stream = TokenBudgetBatch(stream, max_tokens, read_ahead=batch_size*sort_k_batches)
+    else:
+        # Build a batched version of stream to read k batches ahead
+        stream = Batch(stream,
+                       iteration_scheme=ConstantScheme(
+                           batch_size*sort_k_batches))
+
+        # Sort all samples in the read-ahead batch
+        stream = Mapping(stream, SortMapping(_length))
+
+        # Convert it into a stream again
+        stream = Unpack(stream)
+
+        # Construct batches from the stream with specified batch size
+        stream = Batch(
+            stream, iteration_scheme=ConstantScheme(batch_size))
+
+    # Pad sequences that are short, and stack the context features
+    masked_stream = PaddingWithEOSContext(
+        stream, [src_vocab_size - 1, trg_vocab_size - 1], mask_sources=('source', 'target'),
+        dequantize=train_features.dequantize)
+
+    # Build the batches in background processes
+    if prefetch_workers > 0:
+        masked_stream = PrefetchingDataStream(masked_stream, num_workers=prefetch_workers,
+                                              queue_size=prefetch_queue_size)
 
     return masked_stream, src_vocab, trg_vocab
 
@@ -93,25 +917,18 @@ def get_tr_stream_with_context_features(src_vocab, trg_vocab, src_data, trg_data
 # Remember that the BleuValidator does hackish stuff to get target set information from the main_loop data_stream
 # using all kwargs here makes it more clear that this function is always called with get_dev_stream(**config_dict)
 def get_dev_stream_with_context_features(val_context_features=None, val_set=None, src_vocab=None,
-                                         src_vocab_size=30000, unk_id=1, **kwargs):
+                                         src_vocab_size=30000, unk_id=1, val_context_feature_ids=None, **kwargs):
     """Setup development set stream if necessary."""
 
-    def _get_np_array(filename):
-        return numpy.load(filename)['arr_0']
-
-
     dev_stream = None
     if val_set is not None and src_vocab is not None:
-        src_vocab = _ensure_special_tokens(
-            src_vocab if isinstance(src_vocab, dict) else
-            cPickle.load(open(src_vocab)),
-            bos_idx=0, eos_idx=src_vocab_size - 1, unk_idx=unk_id)
+        src_vocab = Vocabulary.load(src_vocab, src_vocab_size, unk_idx=unk_id)
 
         dev_dataset = TextFile([val_set], src_vocab, None)
 
         # now add the source with the image features
         # create the image datastream (iterate over a file line-by-line)
-        con_features = _get_np_array(val_context_features)
+        con_features = load_context_features(val_context_features, val_context_feature_ids)
         con_feature_dataset = IterableDataset(con_features)
         valid_image_stream = DataStream(con_feature_dataset)
 
@@ -123,6 +940,46 @@ def get_dev_stream_with_context_features(val_context_features=None, val_set=None
     return dev_stream
 
 
+class CachedDevSet(object):
+    """The dev set read once from its stream and kept in memory for every validation round
+
+    Sources are int64 arrays with out of vocabulary indices already mapped to `unk_idx`, and the context features
+    are stacked into one contiguous float32 matrix. `order` visits the segments from shortest to longest source,
+    callers should use it for decoding and put the outputs back at each segment's original index.
+
+    Parameters
+    ----------
+    data_stream: fuel stream : the dev stream, e.g. from `get_dev_stream_with_context_features`
+    src_vocab_size: int : source indices >= this are mapped to `unk_idx` (None leaves them as they are)
+    unk_idx: int : the index of the <UNK> token
+    source: str : the name of the source sentence in `data_stream`
+    context: str : the name of the context features in `data_stream`
+
+    """
+
+    def __init__(self, data_stream, src_vocab_size=None, unk_idx=1, source='source', context='initial_context'):
+        source_idx = data_stream.sources.index(source) if source in data_stream.sources else 0
+        context_idx = data_stream.sources.index(context) if context in data_stream.sources else -1
+
+        self.sources = []
+        contexts = []
+        for example in data_stream.get_epoch_iterator():
+            seq = numpy.array(example[source_idx], dtype='int64')
+            if src_vocab_size is not None:
+                seq[seq >= src_vocab_size] = unk_idx
+            self.sources.append(seq)
+            contexts.append(example[context_idx])
+        data_stream.reset()
+
+        self.contexts = numpy.ascontiguousarray(numpy.array(contexts, dtype='float32'))
+        self.lengths = numpy.array([len(seq) for seq in self.sources], dtype='int64')
+        # a stable sort keeps segments of the same length in their original order
+        self.order = numpy.argsort(self.lengths, kind='mergesort')
+
+    def __len__(self):
+        return len(self.sources)
+
+
 
 # Module for functionality associated with streaming data
 class MMMTSampleStreamTransformer:
@@ -135,10 +992,12 @@ class MMMTSampleStreamTransformer:
 
     Parameters
     ----------
-    sample_func: function(num_samples=1) which takes source seq and outputs <num_samples> samples
+    sample_func: function(sources, contexts, num_samples=1) which takes a block of source seqs and their contexts
+      and outputs <num_samples> samples for each of them, e.g. `SampleFunc.sample_batch`
     score_func: function
 
-    At call time, we expect a stream providing (sources, references) -- i.e. something like a TextFile object
+    At call time, we expect a stream providing blocks of (sources, references, contexts) -- i.e. something like a
+    Batch over a TextFile object, typically one read-ahead block of `batch_size * sort_k_batches` examples
 
 
     """
@@ -151,20 +1010,19 @@ class MMMTSampleStreamTransformer:
         self.kwargs = kwargs
 
     def __call__(self, data, **kwargs):
-        source = data[0]
-        reference = data[1]
-        initial_context = data[2]
-
-        # each sample may be of different length
-        samples = self.sample_func(numpy.array(source), initial_context, self.num_samples)
+        sources = data[0]
+        references = data[1]
+        initial_contexts = data[2]
 
-        # import ipdb;ipdb.set_trace()
+        # all the sources of the block are sampled at once, each sample may be of different length
+        block_samples = self.sample_func([numpy.asarray(source) for source in sources],
+                                         numpy.asarray(list(initial_contexts)), self.num_samples)
 
         # TODO: we currently have to pass the source because of the interface to mteval_v13
-        scores = numpy.array(self._compute_scores(source, reference, samples, **self.kwargs)).astype('float32')
-        # import ipdb;ipdb.set_trace()
+        block_scores = [numpy.array(self._compute_scores(source, reference, samples, **self.kwargs)).astype('float32')
+                        for source, reference, samples in zip(sources, references, block_samples)]
 
-        return (samples, scores)
+        return (block_samples, block_scores)
 
     # Note that many sentence-level metrics like BLEU can be computed directly over the indexes (not the strings),
     # Note that some sentence-level metrics like METEOR require the string representation
@@ -0,0 +1,129 @@
+"""
+Long-lived tokenizer and detokenizer processes
+
+"""
+
+import logging
+from subprocess import Popen, PIPE
+
+import six
+from six.moves import queue
+
+logger = logging.getLogger(__name__)
+
+
+def moses_tokenizer_command(tokenize_script, language):
+    """Get the command which runs moses' tokenizer.perl line by line (-b disables its output buffering)"""
+    return [tokenize_script, '-l', language, '-q', '-b', '-no-escape', '1']
+
+
+def moses_detokenizer_command(detokenize_script, language):
+    """Get the command which runs moses' detokenizer.perl line by line"""
+    return [detokenize_script, '-l', language, '-q', '-b']
+
+
+class LineProcess(object):
+    """A process which writes one line of output for every line of input, e.g. moses' tokenizer.perl with `-b`
+
+    The process is started on first use and kept running. Lines are written in chunks of `batch_size`, and the same
+    number of lines is read back before the next chunk is written, so the pipes never fill up. If the process dies,
+    it is restarted and the chunk is sent again.
+
+    Parameters
+    ----------
+    cmd: list[str] : the command to run, e.g. `['cat']` or `['python', '-m', 'mmmt.tokenizer.fake_tokenizer']`
+    batch_size: int : how many lines are written before their outputs are read
+
+    """
+
+    def __init__(self, cmd, batch_size=100):
+        self.cmd = cmd
+        self.batch_size = batch_size
+        self.process = None
+
+    def _start(self):
+        self.close()
+        logger.info('Starting: {}'.format(' '.join(self.cmd)))
+        self.process = Popen(self.cmd, stdin=PIPE, stdout=PIPE, universal_newlines=True)
+
+    def close(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+                self.process.wait()
+            except (IOError, OSError):
+                pass
+            self.process = None
+
+    @staticmethod
+    def _clean(line):
+        # the protocol is line based, a newline inside a segment would shift all the following outputs
+        if six.PY2 and isinstance(line, six.text_type):
+            line = line.encode('utf8')
+        return line.replace('\r', ' ').replace('\n', ' ')
+
+    def _communicate(self, lines, retries=1):
+        for attempt in range(retries + 1):
+            if self.process is None or self.process.poll() is not None:
+                self._start()
+            try:
+                self.process.stdin.write(''.join(line + '\n' for line in lines))
+                self.process.stdin.flush()
+                outputs = [self.process.stdout.readline() for _ in lines]
+                if all(outputs):
+                    return [output.rstrip('\n') for output in outputs]
+                error = '{} exited with code {}'.format(self.cmd[0], self.process.poll())
+            except (IOError, OSError) as e:
+                error = e
+            logger.warning('{} failed ({}), restarting it'.format(self.cmd[0], error))
+            self.close()
+        raise RuntimeError('{} failed {} times: {}'.format(self.cmd[0], retries + 1, error))
+
+    def process_lines(self, lines):
+        """Get the output line for each line in `lines`"""
+        outputs = []
+        for start in range(0, len(lines), self.batch_size):
+            outputs.extend(self._communicate([self._clean(line) for line in lines[start:start + self.batch_size]]))
+        return outputs
+
+    def __del__(self):
+        self.close()
+
+
+class LineProcessPool(object):
+    """A few `LineProcess`es running the same command, which can be used from several threads
+
+    Each call borrows an idle process for the whole batch of lines it submits, so concurrent callers never mix up
+    their outputs. The processes are only started when they are first needed.
+
+    Parameters
+    ----------
+    cmd: list[str] or str : the command to run, a string is split on whitespace
+    size: int : how many processes may run at once
+    batch_size: int : see `LineProcess`
+
+    """
+
+    def __init__(self, cmd, size=1, batch_size=100):
+        if isinstance(cmd, six.string_types):
+            cmd = cmd.split()
+        self.cmd = cmd
+        self.processes = [LineProcess(cmd, batch_size=batch_size) for _ in range(size)]
+        self.idle = queue.Queue()
+        for process in self.processes:
+            self.idle.put(process)
+
+    def process_lines(self, lines):
+        """Get the output line for each line in `lines`"""
+        process = self.idle.get()
+        try:
+            return process.process_lines(lines)
+        finally:
+            self.idle.put(process)
+
+    def process_line(self, line):
+        return self.process_lines([line])[0]
+
+    def close(self):
+        for process in self.processes:
+            process.close()
@@ -0,0 +1,33 @@
+"""
+A stand-in for moses' `tokenizer.perl -b` and `detokenizer.perl -b`, which reads and writes one line at a time
+
+Usage:
+    python -m mmmt.tokenizer.fake_tokenizer [--detokenize]
+
+Tokenizing splits punctuation off words, detokenizing attaches it to the previous word again. This is much cruder
+than moses, but it is deterministic and fast, which is what tests of the tokenizer processes need.
+
+"""
+
+import re
+import sys
+
+PUNCTUATION = r'([.,!?;:"()])'
+
+
+def tokenize(line):
+    return ' '.join(re.sub(PUNCTUATION, r' \1 ', line).split())
+
+
+def detokenize(line):
+    return re.sub(r' ' + PUNCTUATION, r'\1', ' '.join(line.split()))
+
+
+def main(stdin, stdout, process_line):
+    for line in iter(stdin.readline, ''):
+        stdout.write(process_line(line.rstrip('\n')) + '\n')
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    main(sys.stdin, sys.stdout, detokenize if '--detokenize' in sys.argv[1:] else tokenize)
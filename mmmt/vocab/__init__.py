@@ -0,0 +1,133 @@
+"""
+Vocabularies shared by the data streams, the validators and the predictor
+
+"""
+
+import logging
+import os
+import tempfile
+import zipfile
+from contextlib import closing
+
+import numpy
+import six
+from six.moves import cPickle
+
+from machine_translation.stream import _ensure_special_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class Vocabulary(dict):
+    """A word -> index dictionary which also stores its index -> word mapping as an array
+
+    The special tokens are put at the indices used in training: <S> at 0, </S> at `vocab_size - 1` and <UNK> at
+    `unk_idx`. Since it is a dict, a Vocabulary can be passed anywhere a vocabulary dict is expected
+    (e.g. to fuel's TextFile).
+
+    Parameters
+    ----------
+    word_to_idx: dict : the vocabulary, with special tokens already in place
+    vocab_size: int : indices >= vocab_size are mapped to `unk_idx` when encoding
+    unk_idx: int : the index of the <UNK> token
+
+    """
+
+    bos_token = '<S>'
+    eos_token = '</S>'
+    unk_token = '<UNK>'
+
+    def __init__(self, word_to_idx, vocab_size, unk_idx=1):
+        super(Vocabulary, self).__init__(word_to_idx)
+        self.vocab_size = vocab_size
+        self.unk_idx = unk_idx
+        self.bos_idx = self[self.bos_token]
+        self.eos_idx = self[self.eos_token]
+
+        self.idx_to_word = numpy.empty(max(max(self.values()) + 1, vocab_size), dtype=object)
+        self.idx_to_word[:] = self.unk_token
+        for word, idx in self.items():
+            self.idx_to_word[idx] = word
+
+    @classmethod
+    def load(cls, vocab, vocab_size, unk_idx=1, use_cache=True):
+        """Get a Vocabulary from a pickled dict, a dict or a Vocabulary
+
+        When a pickle is loaded, the fixed-up vocabulary is cached next to it in `<vocab>.cache.npz`, which is
+        used instead of the pickle as long as it is newer and was built with the same `vocab_size` and `unk_idx`.
+
+        """
+        if isinstance(vocab, cls):
+            return vocab
+        if isinstance(vocab, dict):
+            return cls(_ensure_special_tokens(dict(vocab), bos_idx=0, eos_idx=vocab_size - 1, unk_idx=unk_idx),
+                       vocab_size, unk_idx=unk_idx)
+
+        cache_file = vocab + '.cache.npz'
+        if use_cache and os.path.isfile(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(vocab):
+            try:
+                with closing(numpy.load(cache_file)) as cached:
+                    if int(cached['vocab_size']) == vocab_size and int(cached['unk_idx']) == unk_idx:
+                        return cls(dict(zip(cached['words'].tolist(), cached['idxs'].tolist())),
+                                   vocab_size, unk_idx=unk_idx)
+            except (IOError, OSError, EOFError, ValueError, KeyError, zipfile.BadZipfile) as e:
+                # e.g. a cache truncated by a crash, it is rebuilt from the pickle
+                logger.warning('Could not read the vocabulary cache {}, rebuilding it: {}'.format(cache_file, e))
+
+        with open(vocab, 'rb') as vocab_file:
+            vocabulary = cls.load(cPickle.load(vocab_file), vocab_size, unk_idx=unk_idx)
+
+        if use_cache:
+            try:
+                vocabulary.save_cache(cache_file)
+            except (IOError, OSError) as e:
+                logger.warning('Could not cache vocabulary {}: {}'.format(vocab, e))
+        return vocabulary
+
+    def save_cache(self, cache_file):
+        """Write the vocabulary to `cache_file`, through a temporary file which is renamed, so that processes
+        loading the vocabulary meanwhile never read a partial cache"""
+        words, idxs = zip(*self.items())
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_file)),
+                                        prefix=os.path.basename(cache_file) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as cache_out:
+                numpy.savez(cache_out, words=numpy.array(words), idxs=numpy.array(idxs, dtype='int64'),
+                            vocab_size=self.vocab_size, unk_idx=self.unk_idx)
+            os.rename(tmp_file, cache_file)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+
+    def _lookup(self, sentence, add_eos):
+        if isinstance(sentence, six.string_types):
+            sentence = sentence.split()
+        idxs = [self.get(word, self.unk_idx) for word in sentence]
+        if add_eos:
+            idxs.append(self.eos_idx)
+        return idxs
+
+    def encode(self, sentence, add_eos=True):
+        """Map a sentence (a string or a list of words) to an array of indices, with OOV words mapped to <UNK>"""
+        return self.encode_batch([sentence], add_eos=add_eos)[0]
+
+    def encode_batch(self, sentences, add_eos=True):
+        """Map a list of sentences to a list of index arrays, with OOV words mapped to <UNK>"""
+        sentences = [self._lookup(sentence, add_eos) for sentence in sentences]
+        idxs = numpy.array([idx for sentence in sentences for idx in sentence], dtype='int64')
+        idxs[idxs >= self.vocab_size] = self.unk_idx
+        return numpy.split(idxs, numpy.cumsum([len(sentence) for sentence in sentences])[:-1])
+
+    def decode(self, seq):
+        """Map a sequence of indices to a string"""
+        return self.decode_batch([seq])[0]
+
+    def decode_batch(self, seqs):
+        """Map a list of index sequences to a list of strings"""
+        lengths = [len(seq) for seq in seqs]
+        idxs = numpy.concatenate([numpy.asarray(seq, dtype='int64') for seq in seqs]) if seqs else \
+            numpy.array([], dtype='int64')
+        words = numpy.where((idxs >= 0) & (idxs < len(self.idx_to_word)),
+                            self.idx_to_word.take(idxs, mode='clip'), self.unk_token)
+        return [' '.join(seq_words) for seq_words in numpy.split(words, numpy.cumsum(lengths)[:-1])]
@@ -0,0 +1,40 @@
+"""
+Compile the tokenized training corpus of an experiment into the binarized format read by mmmt.stream
+
+Usage:
+    python scripts/data/binarize_corpus.py <exp_config.yaml> [--output_prefix PREFIX]
+
+The `src_data`, `trg_data`, vocabularies and vocabulary sizes are taken from the experiment config.
+Set `binarized_corpus` in the config to the output prefix to train from the compiled corpus.
+
+"""
+
+import argparse
+import logging
+
+from machine_translation import configurations
+
+from mmmt.stream import binarize_parallel_corpus
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("exp_config",
+                    help="Path to the yaml config file for your experiment")
+parser.add_argument("--output_prefix", default=None,
+                    help="Prefix of the compiled corpus files -- default=`binarized_corpus` from the config")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config_obj = configurations.get_config(args.exp_config)
+    if args.output_prefix is not None:
+        config_obj['binarized_corpus'] = args.output_prefix
+    assert config_obj.get('binarized_corpus', None) is not None, \
+        'Either set `binarized_corpus` in the config or pass --output_prefix'
+
+    logger.info('Binarizing {} and {} to {}'.format(config_obj['src_data'], config_obj['trg_data'],
+                                                    config_obj['binarized_corpus']))
+    num_segments = binarize_parallel_corpus(**config_obj)
+    logger.info('Wrote {} sentence pairs'.format(num_segments))
@@ -0,0 +1,40 @@
+"""
+Convert .npz context feature archives into .npy feature stores which mmmt memory-maps at train and test time
+
+Usage:
+    python scripts/data/convert_context_features.py train.npz dev.npz test.npz
+
+Each archive is written next to the input with the .npy extension, unless --output_dir is given.
+Point `context_features`, `val_context_features` and `test_context_features` in your config at the new files.
+
+"""
+
+import argparse
+import logging
+import os
+
+from mmmt.stream import convert_npz_to_feature_store
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("npz_files", nargs='+',
+                    help="The .npz context feature archives to convert")
+parser.add_argument("--output_dir", default=None,
+                    help="Where to write the .npy feature stores -- default=next to the input files")
+parser.add_argument("--array_name", default='arr_0',
+                    help="The name of the feature matrix inside the archives -- default=arr_0")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    for npz_file in args.npz_files:
+        output_file = os.path.splitext(npz_file)[0] + '.npy'
+        if args.output_dir is not None:
+            output_file = os.path.join(args.output_dir, os.path.basename(output_file))
+
+        logger.info('Converting {} to {}'.format(npz_file, output_file))
+        shape = convert_npz_to_feature_store(npz_file, output_file, array_name=args.array_name)
+        logger.info('Wrote feature store with shape {}'.format(shape))
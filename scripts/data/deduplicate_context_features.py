@@ -0,0 +1,34 @@
+"""
+Store each distinct context feature vector once, and map every segment to its vector through an image id
+
+Usage:
+    python scripts/data/deduplicate_context_features.py train.npy train.table.npy train.ids.npy
+
+In Flickr30k-style data every image has several captions, so the per-caption feature matrix repeats each
+image's features once per caption. Point `context_features` at the table and `context_feature_ids` at the ids
+(likewise `val_context_feature_ids` and `test_context_feature_ids`) to use the deduplicated layout.
+
+"""
+
+import argparse
+import logging
+
+from mmmt.stream import deduplicate_context_features
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("features",
+                    help="The per-segment context features (.npy or .npz)")
+parser.add_argument("table_file",
+                    help="Where to write the .npy table of distinct feature vectors")
+parser.add_argument("ids_file",
+                    help="Where to write the .npy array with the table row of each segment")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    num_distinct = deduplicate_context_features(args.features, args.table_file, args.ids_file)
+    logger.info('Wrote {} distinct feature vectors to {}, and segment ids to {}'.format(
+        num_distinct, args.table_file, args.ids_file))
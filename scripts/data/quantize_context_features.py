@@ -0,0 +1,74 @@
+"""
+Write float16 and/or int8 copies of a context feature store, and report what the quantization costs
+
+Usage:
+    python scripts/data/quantize_context_features.py dev.npy --dtypes float16 int8
+    python scripts/data/quantize_context_features.py dev.npy --dtypes float16 int8 --config exp_config.yaml
+
+For every dtype, `<features>.<dtype>.npy` is written next to the input (int8 stores also get a `.quant.npz` file
+with the per-dimension scale and offset), and the reconstruction error with respect to the original features is
+logged. If an experiment config is given, its validation set (`val_set`) is translated once with the original
+features and once with each quantized copy, and the BLEU scores against `val_set_grndtruth` are reported.
+
+"""
+
+import argparse
+import codecs
+import logging
+import os
+
+from machine_translation import configurations
+
+from mmmt import NMTPredictor
+from mmmt.evaluation import CorpusBleu
+from mmmt.stream import quantize_context_features, feature_reconstruction_error
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("features",
+                    help="The .npy or .npz context features to quantize")
+parser.add_argument("--dtypes", nargs='+', default=['float16', 'int8'],
+                    help="The storage types to try [float16,int8] -- default=both")
+parser.add_argument("--config", default=None,
+                    help="An experiment config -- if given, report dev BLEU with each set of features")
+
+
+def dev_bleu(predictor, config, features_file):
+    output_file = os.path.splitext(features_file)[0] + '.dev.hyps.out'
+    predictor.predict_files(config['val_set'], features_file, output_file=output_file,
+                            context_ids_file=config.get('val_context_feature_ids', None))
+
+    with codecs.open(output_file, encoding='utf8') as hyps:
+        hyp_lines = hyps.read().strip().split('\n')
+    return CorpusBleu.from_files([config['val_set_grndtruth']]).score(hyp_lines)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    quantized_files = []
+    for dtype in args.dtypes:
+        quantized_file = '{}.{}.npy'.format(os.path.splitext(args.features)[0], dtype)
+        logger.info('Writing {} features to {}'.format(dtype, quantized_file))
+        quantize_context_features(args.features, quantized_file, dtype=dtype)
+        quantized_files.append(quantized_file)
+
+        errors = feature_reconstruction_error(args.features, quantized_file)
+        logger.info('{} reconstruction error: {}'.format(
+            dtype, ', '.join('{}={:.6f}'.format(k, v) for k, v in sorted(errors.items()))))
+        logger.info('{} size: {} bytes (original: {} bytes)'.format(
+            dtype, os.path.getsize(quantized_file), os.path.getsize(args.features)))
+
+    if args.config is not None:
+        config_obj = configurations.get_config(args.config)
+        predictor = NMTPredictor(config_obj)
+
+        bleu_scores = [('original', dev_bleu(predictor, config_obj, args.features))]
+        for dtype, quantized_file in zip(args.dtypes, quantized_files):
+            bleu_scores.append((dtype, dev_bleu(predictor, config_obj, quantized_file)))
+
+        for name, bleu_score in bleu_scores:
+            logger.info('Dev BLEU with {} features: {}'.format(name, bleu_score))
@@ -14,7 +14,6 @@ logging.debug("test")
 import numpy
 import codecs
 import tempfile
-import cPickle
 import copy
 from collections import OrderedDict
 import itertools
@@ -40,18 +39,21 @@ from blocks.model import Model
 from blocks.select import Selector
 from blocks.roles import WEIGHT
 
-from machine_translation.checkpoint import CheckpointNMT, LoadNMT
+from machine_translation.checkpoint import LoadNMT
 from machine_translation.model import BidirectionalEncoder, Decoder
 
-from machine_translation.stream import (_ensure_special_tokens,
-                                        get_textfile_stream, _too_long, _length, PaddingWithEOS,
+from machine_translation.stream import (get_textfile_stream, _too_long, _length, PaddingWithEOS,
                                         _oov_to_unk, FlattenSamples)
 
-from machine_translation.evaluation import sentence_level_bleu, sentence_level_meteor
+from machine_translation.evaluation import sentence_level_bleu
 
-from mmmt.sample import SampleFunc, BleuValidator, MeteorValidator
+from mmmt.sample import SampleFunc, BleuMetric, MeteorMetric, MultiMetricValidator, AsyncMultiMetricValidator
+from mmmt.evaluation import MeteorScorer
+from mmmt.extensions import AsyncCheckpointNMT
+from mmmt.vocab import Vocabulary
 from mmmt.model import GRUInitialStateWithInitialStateSumContext, GRUInitialStateWithInitialStateConcatContext, InitialContextDecoder
-from mmmt.stream import MMMTSampleStreamTransformer, CopySourceAndContextNTimes, get_dev_stream_with_context_features
+from mmmt.stream import (MMMTSampleStreamTransformer, CopySourceAndContextNTimes, PaddingWithEOSContext,
+                         get_dev_stream_with_context_features, load_context_features)
 
 
 try:
@@ -149,6 +151,9 @@ exp_config = {
     'val_set_out': '/media/1tb_drive/test_min_risk_model_save/validation_out.txt',
     'val_burn_in': 0,
 
+    # Validate parameter snapshots in a separate process, so that training doesn't wait for the validation
+    'async_validation': False,
+
     'source_lang': 'en',
     'target_lang': 'de',
 
@@ -203,16 +208,19 @@ def get_sampling_model_and_input(exp_config):
     # Create Theano variables
     logger.info('Creating theano variables')
     sampling_source_input = tensor.lmatrix('source')
+    sampling_source_mask = tensor.matrix('source_mask')
     sampling_context_input = tensor.matrix('context')
 
     # Get beam search
     logger.info("Building sampling model")
+    # the mask lets sources of different lengths be sampled in the same call
     sampling_source_representation = encoder.apply(
-        sampling_source_input, tensor.ones(sampling_source_input.shape))
+        sampling_source_input, sampling_source_mask)
 
     generated = decoder.generate(sampling_source_input,
                                  sampling_source_representation,
-                                 sampling_context_input)
+                                 sampling_context_input,
+                                 source_sentence_mask=sampling_source_mask)
 
     # build the model that will let us get a theano function from the sampling graph
     logger.info("Creating Sampling Model...")
@@ -224,18 +232,16 @@ def get_sampling_model_and_input(exp_config):
 sample_model, theano_sampling_source_input, theano_sampling_context_input, train_encoder, train_decoder = \
     get_sampling_model_and_input(exp_config)
 
-trg_vocab = cPickle.load(open(exp_config['trg_vocab']))
 trg_vocab_size = exp_config['trg_vocab_size'] - 1
-src_vocab = cPickle.load(open(exp_config['src_vocab']))
 src_vocab_size = exp_config['src_vocab_size'] - 1
 
-src_vocab = _ensure_special_tokens(src_vocab, bos_idx=0,
-                                   eos_idx=src_vocab_size, unk_idx=exp_config['unk_id'])
-trg_vocab = _ensure_special_tokens(trg_vocab, bos_idx=0,
-                                   eos_idx=trg_vocab_size, unk_idx=exp_config['unk_id'])
+src_vocab = Vocabulary.load(exp_config['src_vocab'], exp_config['src_vocab_size'], unk_idx=exp_config['unk_id'])
+trg_vocab = Vocabulary.load(exp_config['trg_vocab'], exp_config['trg_vocab_size'], unk_idx=exp_config['unk_id'])
 
 theano_sample_func = sample_model.get_theano_function()
-sampling_func = SampleFunc(theano_sample_func, trg_vocab)
+# the sampling function takes the graph inputs in the order of model.inputs
+sampling_func = SampleFunc(theano_sample_func, trg_vocab,
+                           input_names=[var.name for var in sample_model.inputs])
 
 src_stream = get_textfile_stream(source_file=exp_config['src_data'], src_vocab=exp_config['src_vocab'],
                                          src_vocab_size=exp_config['src_vocab_size'])
@@ -250,7 +256,8 @@ training_stream = Merge([src_stream,
                          ('source', 'target'))
 
 # add in the context features
-train_features = numpy.load(exp_config['context_features'])['arr_0']
+train_features = load_context_features(exp_config['context_features'],
+                                       exp_config.get('context_feature_ids', None))
 train_feature_dataset = IterableDataset(train_features)
 train_image_stream = DataStream(train_feature_dataset)
 
@@ -267,34 +274,31 @@ training_stream = Merge([training_stream, train_image_stream],
 
 # TODO: configure min-risk score func from the yaml config
 
-# METEOR
-trg_ivocab = {v:k for k,v in trg_vocab.items()}
-
 min_risk_score_func = exp_config.get('min_risk_score_func', 'bleu')
 
+# METEOR -- one METEOR process scores the samples for the whole run
 if min_risk_score_func == 'meteor':
-    sampling_transformer = MMMTSampleStreamTransformer(sampling_func,
-                                                       sentence_level_meteor,
+    meteor_scorer = MeteorScorer.from_config(exp_config)
+    sampling_transformer = MMMTSampleStreamTransformer(sampling_func.sample_batch,
+                                                       meteor_scorer.sentence_level_meteor,
                                                        num_samples=exp_config['n_samples'],
-                                                       trg_ivocab=trg_ivocab,
-                                                       lang=exp_config['target_lang'],
-                                                       meteor_directory=exp_config['meteor_directory']
+                                                       trg_vocab=trg_vocab
                                                       )
 # BLEU
 else:
-    sampling_transformer = MMMTSampleStreamTransformer(sampling_func,
+    sampling_transformer = MMMTSampleStreamTransformer(sampling_func.sample_batch,
                                                        sentence_level_bleu,
                                                        num_samples=exp_config['n_samples'])
 
 
-training_stream = Mapping(training_stream, sampling_transformer, add_sources=('samples', 'scores'))
-
-
 # Build a batched version of stream to read k batches ahead
 training_stream = Batch(training_stream,
                         iteration_scheme=ConstantScheme(
                         exp_config['batch_size']*exp_config['sort_k_batches']))
 
+# Sample the whole read-ahead block with one call of the sampling function
+training_stream = Mapping(training_stream, sampling_transformer, add_sources=('samples', 'scores'))
+
 # TODO: add read-ahead shuffling Mapping similar to SortMapping
 # Sort all samples in the read-ahead batch
 training_stream = Mapping(training_stream, SortMapping(_length))
@@ -315,7 +319,7 @@ expanded_source_stream = CopySourceAndContextNTimes(flat_sample_stream, n_sample
 # Note: some sources can be excluded from the padding Op, but since blocks matches sources with input variable
 # Note: names, it's not critical
 # TODO: add mask sources?
-masked_stream = PaddingWithEOS(
+masked_stream = PaddingWithEOSContext(
     expanded_source_stream, [exp_config['src_vocab_size'] - 1, exp_config['trg_vocab_size'] - 1])
 
 # create the model for training
@@ -406,8 +410,8 @@ def main(model, cost, config, tr_stream, dev_stream, use_bokeh=False):
         FinishAfter(after_n_batches=config['finish_after']),
         TrainingDataMonitoring([cost], after_batch=True),
         Printing(after_batch=True),
-         CheckpointNMT(config['saveto'],
-                       every_n_batches=config['save_freq'])
+         AsyncCheckpointNMT(config['saveto'],
+                            every_n_batches=config['save_freq'])
     ]
 
     # Set up beam search and sampling computation graphs if necessary
@@ -433,28 +437,20 @@ def main(model, cost, config, tr_stream, dev_stream, use_bokeh=False):
     #                every_n_batches=config['sampling_freq'],
     #                src_vocab_size=config['src_vocab_size']))
 
-    # Add early stopping based on bleu
-    # TODO: use multimodal meteor and BLEU validator
-    # Add early stopping based on bleu
+    # Add early stopping based on BLEU and/or METEOR, both are computed from the same decoding of the dev set
+    validation_metrics = []
     if config.get('bleu_script', None) is not None:
-        logger.info("Building bleu validator")
-        extensions.append(
-            BleuValidator(theano_sampling_source_input, theano_sampling_context_input,
-                          samples=samples, config=config,
-                          model=search_model, data_stream=dev_stream,
-                          src_vocab=src_vocab,
-                          trg_vocab=trg_vocab,
-                          normalize=config['normalized_bleu'],
-                          every_n_batches=config['bleu_val_freq']))
-
-
-    # Add early stopping based on Meteor
+        validation_metrics.append(BleuMetric(config, trg_vocab=trg_vocab))
     if config.get('meteor_directory', None) is not None:
-        logger.info("Building meteor validator")
+        validation_metrics.append(MeteorMetric(config))
+
+    if validation_metrics:
+        logger.info("Building validator for {}".format(', '.join(metric.key for metric in validation_metrics)))
+        validator_class = AsyncMultiMetricValidator if config.get('async_validation', False) else MultiMetricValidator
         extensions.append(
-            MeteorValidator(theano_sampling_source_input, theano_sampling_context_input,
-                            samples=samples,
-                            config=config,
+            validator_class(theano_sampling_source_input, theano_sampling_context_input,
+                            samples=samples, config=config,
+                            metrics=validation_metrics,
                             model=search_model, data_stream=dev_stream,
                             src_vocab=src_vocab,
                             trg_vocab=trg_vocab,
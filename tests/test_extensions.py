@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import closing
+
+import numpy
+from six.moves import cPickle
+
+from blocks.log import TrainingLog
+from blocks.serialization import BRICK_DELIMITER, load
+
+from mmmt.extensions import AsyncCheckpointNMT
+
+
+class FakeModel(object):
+
+    def __init__(self, param_values):
+        self.param_values = param_values
+
+    def get_parameter_values(self):
+        return dict((name, value.copy()) for name, value in self.param_values.items())
+
+
+class FakeMainLoop(object):
+
+    def __init__(self, param_values, iteration_state, log):
+        self.model = FakeModel(param_values)
+        self.iteration_state = iteration_state
+        self.log = log
+
+
+class TestAsyncCheckpointNMT(unittest.TestCase):
+
+    def setUp(self):
+        self.saveto = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.saveto)
+
+    def test_files_are_read_back_by_the_loaders_of_load_nmt(self):
+        log = TrainingLog()
+        log.status['iterations_done'] = 10
+        log[10]['train_cost'] = 1.5
+        param_values = {'/decoder/W': numpy.arange(6, dtype='float32').reshape(2, 3)}
+        main_loop = FakeMainLoop(param_values, {'epoch': 1, 'position': 20}, log)
+
+        checkpoint = AsyncCheckpointNMT(self.saveto)
+        checkpoint.dump(main_loop)
+        checkpoint.checkpoint_writer.wait()
+
+        with closing(numpy.load(checkpoint.path_to_parameters)) as params:
+            numpy.testing.assert_array_equal(params['/decoder/W'.replace('/', BRICK_DELIMITER)],
+                                             param_values['/decoder/W'])
+        with open(checkpoint.path_to_iteration_state, 'rb') as source:
+            self.assertEqual(load(source), {'epoch': 1, 'position': 20})
+        with open(checkpoint.path_to_log, 'rb') as source:
+            loaded_log = cPickle.load(source)
+        self.assertEqual(loaded_log.status['iterations_done'], 10)
+        self.assertEqual(loaded_log[10]['train_cost'], 1.5)
+        self.assertEqual(sorted(os.listdir(self.saveto)),
+                         sorted(os.path.basename(path) for path in (checkpoint.path_to_parameters,
+                                                                    checkpoint.path_to_iteration_state,
+                                                                    checkpoint.path_to_log)))
+
+
+if __name__ == '__main__':
+    unittest.main()